@@ -6,20 +6,80 @@ import glob
 import re
 from pathlib import Path
 import datetime
-import cdsapi
-from cdo import Cdo, CDOException
-cdo = Cdo()
+import calendar
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from downloader import download_result, request_id
+from grib_scan import check_grib_cached, split_grib, merge_grib, concat_grib, month_expvers, GribError
+from state import product_key, file_checksum, month_expver, WHOLE_YEAR
+from nc_convert import grib_to_netcdf, UnsupportedGrid
+from metrics import span
 
+# default maximum number of fields of a single CDS request
+MAX_FIELDS = 120000
 
-# check with cdo is the file is complete (approximately correct)
-def is_file_complete(filename, minimum_steps):
+
+_local = threading.local()
+
+
+def cds_client():
+    """Get the CDS API client of the current worker thread, created once and reused for all its requests"""
+    if not hasattr(_local, 'client'):
+        import cdsapi  # pylint: disable=import-outside-toplevel
+        _local.client = cdsapi.Client()
+    return _local.client
+
+
+@functools.lru_cache(maxsize=None)
+def get_cdo(debug=False):
+    """Get the Cdo bindings, created on first use since they probe the cdo binary and its operators"""
+    from cdo import Cdo  # pylint: disable=import-outside-toplevel
+    cdo = Cdo()
+    cdo.debug = debug
+    return cdo
+
+
+def run_requests(requests, fetch, workers=1):
+    """
+    Run fetch(kind, retrieve_dict, outfile) for each request of a year,
+    with up to workers concurrent requests (e.g. the months of a year).
+    """
+    if workers <= 1 or len(requests) <= 1:
+        for kind, retrieve_dict, outfile in requests:
+            fetch(kind, retrieve_dict, outfile)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() raises the first error of the requests
+        list(executor.map(lambda args: fetch(*args), requests))
+
+
+def cdo_exception():
+    """The exception raised by the Cdo bindings"""
+    from cdo import CDOException  # pylint: disable=import-outside-toplevel
+    return CDOException
+
+
+# check if the file is complete, scanning the GRIB headers or with cdo (approximately correct)
+def is_file_complete(filename, minimum_steps, expected=None, nfields=1, granularity='hour'):
     """
     Is a file that we want to download complete?
 
+    If the expected times are provided, the GRIB headers are scanned and every
+    time must have nfields fields. The verdict is cached for unchanged files.
+    Otherwise cdo is used to count the timesteps.
+
     Returns:
       a boolean, True if the file is ok, False if the file need to be downloaded
 
     """
+    with span('check', file=Path(filename).name) as info:
+        info['complete'] = _check_file(filename, minimum_steps, expected, nfields, granularity)
+    return info['complete']
+
+
+def _check_file(filename, minimum_steps, expected=None, nfields=1, granularity='hour'):
+    """Body of is_file_complete"""
 
     # set it false by default
     filename = str(filename)
@@ -27,9 +87,23 @@ def is_file_complete(filename, minimum_steps):
     # if file exists
     if os.path.exists(filename):
 
+        if expected is not None:
+            try:
+                complete, message = check_grib_cached(filename, expected, nfields, granularity)
+            except (GribError, ValueError, OSError) as e:
+                print(f'{filename} is corrupted: {e}')
+                return False
+
+            if not complete:
+                print(f'The file {filename} looks incomplete: {message}')
+                return False
+
+            print(f'{filename} is complete ({message})! Going to next one...')
+            return True
+
         try:
             # cdo ntime return a list with the length of the timesteps, select the first one
-            nt = int(cdo.ntime(input=filename, options='-s')[0])
+            nt = int(get_cdo().ntime(input=filename, options='-s')[0])
             print(f'The file has {nt} timesteps...')
 
             # if the number of steps is not enough...
@@ -40,7 +114,7 @@ def is_file_complete(filename, minimum_steps):
             print(filename + ' is complete! Going to next one...')
             return True
 
-        except (KeyError, CDOException):
+        except (KeyError, cdo_exception()):
             print(filename + ' is corrupted')
             return False
 
@@ -48,12 +122,46 @@ def is_file_complete(filename, minimum_steps):
     print(filename + ' is missing')
     return False
 
-# big function for retrieval
-def year_retrieve(dataset, var, freq, year, grid, levelout, area, outdir, request='yearly'):
-    """Function to download a single year of a ERA5 dataset"""
+# define the times expected in a yearly file
+def expected_times(freq, year, months=None):
+    """
+    Define the times expected in a file of a given year
+
+    Returns:
+        tuple: A tuple containing:
+            - expected (set): the expected (year, month) or (year, month, day, hour) keys
+            - granularity (str): 'month' for monthly means, 'hour' otherwise
+    """
+
+    _, day, time, _, _ = define_time(freq)
+    if months is None:
+        months = range(1, 12+1)
+
+    if freq == 'mon':
+        return {(int(year), int(month)) for month in months}, 'month'
+
+    expected = set()
+    for month in months:
+        ndays = calendar.monthrange(int(year), int(month))[1]
+        for d in day:
+            if int(d) <= ndays:
+                expected.update((int(year), int(month), int(d), int(t[0:2])) for t in time)
+    return expected, 'hour'
+
+# build the request for a single chunk
+def build_request(dataset, var, freq, year, grid, levelout, area, month, day=None, level=None):
+    """
+    Build the CDS dataset name and the request dictionary for a chunk.
+    The days and the levels of the frequency and of levelout can be restricted.
+
+    Returns:
+        tuple: A tuple containing:
+            - kind (str): the name of the CDS dataset
+            - retrieve_dict (dict): the request to be sent to the CDS API
+    """
 
     # Level configuration
-    level, level_kind = define_level(levelout)
+    all_levels, level_kind = define_level(levelout)
 
     if dataset == 'ERA5':
         kind = 'reanalysis-era5-' + level_kind
@@ -63,77 +171,435 @@ def year_retrieve(dataset, var, freq, year, grid, levelout, area, outdir, reques
         raise ValueError(f'Unknown dataset {dataset} requested')
 
     # extract time information
-    product_type, day, time, time_kind, minimum_steps = define_time(freq)
+    product_type, all_days, time, time_kind, _ = define_time(freq)
     kind = kind + time_kind
+    if day is None:
+        day = all_days
+    if level is None:
+        level = all_levels
+
+    # special feature for preliminary back extension
+    # if int(year) < year_preliminary and dataset == 'ERA5':
+    #    kind = kind + '-preliminary-back-extension'
+    #    product_type = 'reanalysis-monthly-means-of-daily-means' # hack
+
+    retrieve_dict = {
+        'product_type': product_type,
+        'format': 'grib',
+        'variable': var,
+        'year': year,
+        'month': month,
+        'day': day,
+        'time': time,
+    }
+
+    if grid not in ['full']:
+        # get right grid for the API call
+        gridapi = grid.split('x')[0]
+        retrieve_dict['grid'] = [gridapi, gridapi]
+
+    if level_kind == 'pressure-levels':
+        retrieve_dict['pressure_level'] = level
+
+    if area != 'global':
+        retrieve_dict['area'] = area
+
+    return kind, retrieve_dict
+
+# split a list in groups of similar size
+def split_even(items, size):
+    """Split a list in the minimum number of groups of at most size elements, with similar sizes"""
+    ngroups = -(-len(items) // size)
+    return [items[i * len(items) // ngroups:(i + 1) * len(items) // ngroups] for i in range(ngroups)]
+
+# set up the chunks loop
+def define_chunks(freq, levelout, request='yearly', max_fields=MAX_FIELDS, nvars=1):
+    """
+    Define the chunks of a yearly retrieval.
+
+    'yearly' and 'monthly' give fixed chunks, while 'auto' splits the year along
+    months, then groups of pressure levels and then ranges of days, to get the
+    largest chunks whose number of fields is below max_fields.
+
+    Returns:
+        list of dict: each chunk has the 'month', 'day' and 'level' selections and the 'suffix' of its file
+    """
+
+    _, day, time, _, _ = define_time(freq)
+    level, _ = define_level(levelout)
+    months = [str(i).zfill(2) for i in range(1, 12+1)]
 
-    # set up the months loop
     if request == 'yearly':
-        months = [[str(i).zfill(2) for i in range(1, 12+1)]]
-    elif request == 'monthly':
-        months = [str(i).zfill(2) for i in range(1, 12+1)]
-    else:
+        return [{'month': months, 'day': day, 'level': level, 'suffix': ''}]
+    if request == 'monthly':
+        return [{'month': month, 'day': day, 'level': level, 'suffix': month} for month in months]
+    if request != 'auto':
         sys.exit('Wrong download request!')
 
+    nlevels = 1 if level == 'sfc' else len(level)
+    per_day = len(time) * nvars
+    month_groups, level_groups, day_groups = [months], [level], [day]
+
+    nmonths = max_fields // (len(day) * per_day * nlevels)
+    if nmonths >= 1:
+        month_groups = split_even(months, min(nmonths, 12))
+    else:
+        month_groups = [[month] for month in months]
+        nlev = max_fields // (len(day) * per_day)
+        if level != 'sfc' and nlev >= 1:
+            level_groups = split_even(level, nlev)
+        else:
+            if level != 'sfc':
+                level_groups = [[lev] for lev in level]
+            day_groups = split_even(day, max(1, max_fields // per_day))
+
+    chunks = []
+    for chunk_months in month_groups:
+        for chunk_levels in level_groups:
+            for chunk_days in day_groups:
+                chunks.append({'month': chunk_months, 'day': chunk_days, 'level': chunk_levels,
+                               'suffix': f'_c{len(chunks):03d}'})
+    return chunks
+
+# count the fields of a request
+def request_fields(retrieve_dict):
+    """Count the number of fields of a CDS request, as counted by the CDS for its limits"""
+    count = 1
+    for key in ['variable', 'month', 'day', 'time', 'pressure_level']:
+        # e.g. the surface requests have no pressure_level
+        if key not in retrieve_dict:
+            continue
+        value = retrieve_dict[key]
+        count = count * (len(value) if isinstance(value, list) else 1)
+    return count
+
+# name of a group of variables
+def group_name(var):
+    """Name used in the files of a variable or of a group of variables retrieved together"""
+    if isinstance(var, list):
+        return '+'.join(var)
+    return var
+
+# check the yearly grib file
+def year_complete(dataset, var, freq, year, grid, levelout, area, outdir):
+    """Check if the yearly grib file has all the expected times and levels"""
+
+    _, _, _, _, minimum_steps = define_time(freq)
+    expected, granularity = expected_times(freq, year)
+    level, _ = define_level(levelout)
+    nfields = 1 if level == 'sfc' else len(level)
+    if isinstance(var, list):
+        nfields = nfields * len(var)
+
+    basicname = create_filename(dataset, group_name(var), freq, grid, levelout, area, year)
+    return is_file_complete(Path(outdir, basicname + '.grib'), minimum_steps,
+                            expected=expected, nfields=nfields, granularity=granularity)
+
+# list the requests of a year
+def plan_requests(dataset, var, freq, year, grid, levelout, area, outdir, request='yearly',
+                  max_fields=MAX_FIELDS):
+    """
+    List the CDS requests of a single year, without checking what is already available.
+    var can be a list of variables to be retrieved with the same request.
+
+    Returns:
+      a list of (kind, retrieve_dict, outfile) tuples
+    """
+
+    basicname = create_filename(dataset, group_name(var), freq, grid, levelout, area, year)
+    nvars = len(var) if isinstance(var, list) else 1
+
+    requests = []
+    for chunk in define_chunks(freq, levelout, request, max_fields, nvars):
+        kind, retrieve_dict = build_request(dataset, var, freq, year, grid, levelout, area,
+                                            chunk['month'], day=chunk['day'], level=chunk['level'])
+        requests.append((kind, retrieve_dict, Path(outdir, basicname + chunk['suffix'] + '.grib')))
+
+    return requests
+
+# list the requests needed for a year
+def year_requests(dataset, var, freq, year, grid, levelout, area, outdir, request='yearly', state=None,
+                  max_fields=MAX_FIELDS):
+    """
+    List the CDS requests needed to complete a single year of a ERA5 dataset.
+    var can be a list of variables to be retrieved with the same request.
+
+    Returns:
+      a list of (kind, retrieve_dict, outfile) tuples, empty if the yearly file is already complete
+    """
+
     # check if yearly file is complete
+    basicname = create_filename(dataset, group_name(var), freq, grid, levelout, area, year)
+    if year_complete(dataset, var, freq, year, grid, levelout, area, outdir):
+        if state is not None:
+            state.mark(product_key(dataset, var, freq, grid, levelout, area), year, 'verified',
+                       path=str(Path(outdir, basicname + '.grib')))
+        return []
+
+    return plan_requests(dataset, var, freq, year, grid, levelout, area, outdir, request, max_fields)
+
+# keep track of a downloaded chunk
+def record_download(state, product, year, retrieve_dict, outfile, result, nbytes):
+    """Record a downloaded chunk in the state database"""
+    if state is None:
+        return
+    month = retrieve_dict['month'] if isinstance(retrieve_dict['month'], str) else WHOLE_YEAR
+    state.mark(product, year, 'downloaded', month=month, path=str(outfile), nbytes=nbytes,
+               request_id=request_id(result), checksum=file_checksum(outfile))
+
+# cat together the files and remove the monthly ones
+def assemble_year(dataset, var, freq, grid, levelout, area, year, outdir, request='monthly'):
+    """Concatenate the monthly (or auto) chunks into the yearly file"""
     basicname = create_filename(dataset, var, freq, grid, levelout, area, year)
-    check = is_file_complete(Path(outdir, basicname + '.grib'), minimum_steps)
-
-    if not check:
-        for month in months:
-
-            if request == 'monthly':
-                filename = basicname + month + '.grib'
-            elif request == 'yearly':
-                filename = basicname + '.grib'
-            else:
-                raise ValueError(f'Unknow request frequency {request} requested')
-
-            outfile = Path(outdir, filename)
-
-            # special feature for preliminary back extension
-            # if int(year) < year_preliminary and dataset == 'ERA5':
-            #    kind = kind + '-preliminary-back-extension'
-            #    product_type = 'reanalysis-monthly-means-of-daily-means' # hack
-
-            retrieve_dict = {
-                'product_type': product_type,
-                'format': 'grib',
-                'variable': var,
-                'year': year,
-                'month': month,
-                'day': day,
-                'time': time,
-            }
-
-            if grid not in ['full']:
-                # get right grid for the API call
-                gridapi = grid.split('x')[0]
-                retrieve_dict['grid'] = [gridapi, gridapi]
-
-            if level_kind == 'pressure-levels':
-                retrieve_dict['pressure_level'] = level
-
-            if area != 'global':
-                retrieve_dict['area'] = area
-
-            # pprint(kind)
-            # pprint(level_kind)
-            # pprint(retrieve_dict)
-            # run the API
-            c = cdsapi.Client()
-            c.retrieve(
+    yearfile = Path(outdir, basicname + '.grib')
+    if request == 'auto':
+        # chunks may be split by levels: merge them sorted by time
+        pieces = sorted(glob.glob(str(Path(outdir, basicname + '_c*.grib'))))
+        merge_grib(pieces, yearfile)
+        for f in pieces:
+            os.remove(f)
+        return
+    # GRIB messages are self-delimiting: the months are simply concatenated in order
+    pieces = sorted(glob.glob(str(Path(outdir, basicname + '??.grib'))))
+    concat_grib(pieces, yearfile)
+    for f in pieces:
+        os.remove(f)
+
+# assemble and verify a retrieved year
+def finish_year(dataset, var, freq, year, grid, levelout, area, outdir, request='yearly', state=None):
+    """Assemble the monthly chunks, verify the yearly file and record its status"""
+
+    if request in ['monthly', 'auto']:
+        assemble_year(dataset, var, freq, grid, levelout, area, year, outdir, request)
+
+    if state is None:
+        return
+    product = product_key(dataset, var, freq, grid, levelout, area)
+    outfile = Path(outdir, create_filename(dataset, var, freq, grid, levelout, area, year) + '.grib')
+    if year_complete(dataset, var, freq, year, grid, levelout, area, outdir):
+        record_expvers(state, product, year, outfile)
+        state.mark(product, year, 'verified', path=str(outfile), nbytes=outfile.stat().st_size)
+    else:
+        state.mark(product, year, 'downloaded', path=str(outfile))
+
+# record the experiment version of the months of a yearly file
+def record_expvers(state, product, year, gribfile):
+    """
+    Record the experiment version read from the fields of each month of a verified yearly file,
+    so that the months of preliminary ERA5T data are known to be updated later.
+    """
+
+    for (fyear, month), expvers in month_expvers(gribfile).items():
+        if fyear == int(year):
+            state.mark(product, year, 'verified', month=month, expver=month_expver(expvers), path=str(gribfile))
+
+# list the requests needed for a year of a group of variables
+def group_requests(dataset, varlist, freq, year, grid, levelout, area, tmpdir, request='yearly', state=None,
+                   max_fields=MAX_FIELDS):
+    """
+    List the CDS requests needed to complete a single year of several variables retrieved together
+
+    Returns:
+        tuple: A tuple containing:
+            - needed (list): the variables whose yearly file is not complete
+            - requests (list): the (kind, retrieve_dict, outfile) tuples of the combined requests
+    """
+
+    needed = []
+    for var in varlist:
+        outdir = Path(tmpdir, var)
+        if year_complete(dataset, var, freq, year, grid, levelout, area, outdir):
+            if state is not None:
+                filename = create_filename(dataset, var, freq, grid, levelout, area, year) + '.grib'
+                state.mark(product_key(dataset, var, freq, grid, levelout, area), year, 'verified',
+                           path=str(Path(outdir, filename)))
+        else:
+            needed.append(var)
+
+    if not needed:
+        return needed, []
+
+    groupdir = Path(tmpdir, group_name(needed))
+    groupdir.mkdir(parents=True, exist_ok=True)
+    return needed, year_requests(dataset, needed, freq, year, grid, levelout, area, groupdir, request,
+                                 max_fields=max_fields)
+
+# split a combined download into the files of each variable
+def split_group(dataset, varlist, freq, year, grid, levelout, area, tmpdir, outfile):
+    """
+    Split the GRIB of a combined request by parameter into the files of each variable
+
+    Returns:
+        dict: variable -> file written
+    """
+
+    if len(varlist) == 1:
+        return {varlist[0]: Path(outfile)}
+
+    pieces = group_pieces(dataset, varlist, freq, year, grid, levelout, area, tmpdir, outfile)
+    split_grib(outfile, {PARAM_IDS[var]: piece for var, piece in pieces.items()})
+    os.remove(outfile)
+    return pieces
+
+# files of each variable of a combined download
+def group_pieces(dataset, varlist, freq, year, grid, levelout, area, tmpdir, outfile):
+    """The file of each variable of a combined request, in its own folder with the suffix of the request"""
+
+    basicname = create_filename(dataset, group_name(varlist), freq, grid, levelout, area, year)
+    suffix = Path(outfile).name[len(basicname):]
+    return {var: Path(tmpdir, var, create_filename(dataset, var, freq, grid, levelout, area, year) + suffix)
+            for var in varlist}
+
+# download a single request, unless it is served by the cache
+def fetch_request(kind, retrieve_dict, outfile, name, year, streams=1, scratch=None, cache=None):
+    """
+    Retrieve a CDS request into outfile, looking it up in the request cache first and storing it there once downloaded
+
+    Returns:
+        the result of the CDS request, None if served by the cache
+    """
+
+    result = None
+    # identical requests are served from the cache
+    if cache is None or cache.fetch(kind, retrieve_dict, outfile, scratch) is None:
+        # run the API and download the result into a .part file renamed when complete
+        with span('cds_request', var=name, year=year, file=Path(outfile).name) as info:
+            c = cds_client()
+            result = c.retrieve(
                 kind,
-                retrieve_dict,
-                outfile)
+                retrieve_dict)
+            info['request_id'] = request_id(result)
+        download_result(result, outfile, streams=streams, scratch=scratch)
+        if cache is not None:
+            cache.store(kind, retrieve_dict, outfile)
+    return result
+
+# retrieve alone the variables of a combined request which cannot be split
+def retrieve_pieces(kind, retrieve_dict, pieces, year, streams=1, scratch=None, cache=None):
+    """
+    Retrieve each variable of a combined request alone, e.g. when the CDS delivers some of them
+    in GRIB2, whose parameters are not in PARAM_IDS and cannot be split
 
-        # cat together the files and rmove the monthly ones
-        if request == 'monthly':
-            flist = str(Path(outdir, basicname + '??.grib'))
-            cdo.cat(input=flist, output=str(Path(outdir, basicname + '.grib')))
-            for f in glob.glob(flist):
-                os.remove(f)
+    Returns:
+        dict: variable -> result of its CDS request, None if served by the cache
+    """
 
+    return {var: fetch_request(kind, {**retrieve_dict, 'variable': var}, piece, var, year, streams, scratch, cache)
+            for var, piece in pieces.items()}
+
+# retrieval of several variables at once
+def group_retrieve(dataset, varlist, freq, year, grid, levelout, area, tmpdir, request='yearly', streams=1,
+                   state=None, max_fields=MAX_FIELDS, month_workers=1, scratch=None, cache=None):
+    """Function to download a single year of several variables with the same requests, split locally"""
+
+    needed, requests = group_requests(dataset, varlist, freq, year, grid, levelout, area, tmpdir, request, state,
+                                      max_fields)
+
+    def fetch(kind, retrieve_dict, outfile):
+        result = fetch_request(kind, retrieve_dict, outfile, group_name(needed), year, streams, scratch, cache)
+        try:
+            pieces = split_group(dataset, needed, freq, year, grid, levelout, area, tmpdir, outfile)
+            results = dict.fromkeys(pieces, result)
+        except GribError as e:
+            print(f'{outfile.name} cannot be split ({e}), retrieving its variables alone')
+            os.remove(outfile)
+            pieces = group_pieces(dataset, needed, freq, year, grid, levelout, area, tmpdir, outfile)
+            results = retrieve_pieces(kind, retrieve_dict, pieces, year, streams, scratch, cache)
+        for var, piece in pieces.items():
+            record_download(state, product_key(dataset, var, freq, grid, levelout, area), year,
+                            retrieve_dict, piece, results[var], piece.stat().st_size)
+
+    with span('retrieve', var=group_name(varlist), year=year, requests=len(requests)):
+        run_requests(requests, fetch, month_workers)
+
+    for var in needed:
+        finish_year(dataset, var, freq, year, grid, levelout, area, Path(tmpdir, var), request, state)
+
+# big function for retrieval
+def year_retrieve(dataset, var, freq, year, grid, levelout, area, outdir, request='yearly', streams=1, state=None,
+                  max_fields=MAX_FIELDS, month_workers=1, scratch=None, cache=None):
+    """
+    Function to download a single year of a ERA5 dataset, with month_workers concurrent chunks.
+    With a managed scratch each download waits until its size can be written.
+    With a request cache the requests already retrieved by any configuration are not sent to the CDS.
+    """
 
+    requests = year_requests(dataset, var, freq, year, grid, levelout, area, outdir, request, state, max_fields)
+    product = product_key(dataset, var, freq, grid, levelout, area)
+
+    def fetch(kind, retrieve_dict, outfile):
+        # pprint(kind)
+        # pprint(retrieve_dict)
+        result = fetch_request(kind, retrieve_dict, outfile, var, year, streams, scratch, cache)
+        record_download(state, product, year, retrieve_dict, outfile, result, Path(outfile).stat().st_size)
+
+    with span('retrieve', var=var, year=year, requests=len(requests)):
+        run_requests(requests, fetch, month_workers)
+
+    # cat together the files, rmove the chunks and verify
+    if requests:
+        finish_year(dataset, var, freq, year, grid, levelout, area, outdir, request, state)
+
+
+
+# datasets delivered by the CDS in GRIB2, whose parameters are not identified by PARAM_IDS
+GRIB2_DATASETS = ['ERA5-Land']
+
+# GRIB parameter IDs of the variables which can be retrieved with a single request and split locally
+PARAM_IDS = {
+    # single levels
+    'sea_ice_cover': 31,
+    'sea_surface_temperature': 34,
+    '10m_wind_gust_since_previous_post_processing': 49,
+    'geopotential': 129,
+    'surface_pressure': 134,
+    'total_column_water_vapour': 137,
+    'snow_depth': 141,
+    'large_scale_precipitation': 142,
+    'convective_precipitation': 143,
+    'snowfall': 144,
+    'surface_sensible_heat_flux': 146,
+    'surface_latent_heat_flux': 147,
+    'mean_sea_level_pressure': 151,
+    'boundary_layer_height': 159,
+    'total_cloud_cover': 164,
+    '10m_u_component_of_wind': 165,
+    '10m_v_component_of_wind': 166,
+    '2m_temperature': 167,
+    '2m_dewpoint_temperature': 168,
+    'surface_solar_radiation_downwards': 169,
+    'land_sea_mask': 172,
+    'surface_thermal_radiation_downwards': 175,
+    'surface_net_solar_radiation': 176,
+    'surface_net_thermal_radiation': 177,
+    'top_net_solar_radiation': 178,
+    'top_net_thermal_radiation': 179,
+    'evaporation': 182,
+    'maximum_2m_temperature_since_previous_post_processing': 201,
+    'minimum_2m_temperature_since_previous_post_processing': 202,
+    'runoff': 205,
+    'total_column_ozone': 206,
+    'toa_incident_solar_radiation': 212,
+    'total_precipitation': 228,
+    'skin_temperature': 235,
+    'instantaneous_10m_wind_gust': 228029,
+    '100m_u_component_of_wind': 228246,
+    '100m_v_component_of_wind': 228247,
+    # pressure levels
+    'potential_vorticity': 60,
+    'temperature': 130,
+    'u_component_of_wind': 131,
+    'v_component_of_wind': 132,
+    'specific_humidity': 133,
+    'vertical_velocity': 135,
+    'vorticity': 138,
+    'divergence': 155,
+    'relative_humidity': 157,
+    'ozone_mass_mixing_ratio': 203,
+    'specific_cloud_liquid_water_content': 246,
+    'specific_cloud_ice_water_content': 247,
+    'fraction_of_cloud_cover': 248,
+}
 
 plevs = {'ERA5' : ['1000', '975', '950', '925',
                     '900', '875', '850', '825',
@@ -249,6 +715,15 @@ def define_level(levelout):
 
 
 
+# estimate the size of a request
+def estimate_fields(freq, levelout, nvars=1, request='yearly'):
+    """Estimate the number of fields of a yearly or monthly CDS request, as counted by the CDS for its limits"""
+    _, day, time, _, _ = define_time(freq)
+    level, _ = define_level(levelout)
+    nlevels = 1 if level == 'sfc' else len(level)
+    nmonths = 12 if request == 'yearly' else 1
+    return nmonths * len(day) * len(time) * nlevels * nvars
+
 # define properties for time
 
 
@@ -267,9 +742,10 @@ def define_time(freq):
         if freq == '6hrs':
             time = [str(i).zfill(2)+':00' for i in range(0, 24, 6)]
             minimum_steps = 365*4
-        # 1hr case
-        time = [str(i).zfill(2)+':00' for i in range(0, 24)]
-        minimum_steps = 365*24
+        else:
+            # 1hr case
+            time = [str(i).zfill(2)+':00' for i in range(0, 24)]
+            minimum_steps = 365*24
     elif freq == 'instant':
         product_type = 'reanalysis'
         time_kind = ''
@@ -293,11 +769,25 @@ def create_filename(dataset, var, freq, grid, levelout, area, year1, year2=None)
     return filename
 
 # wrapper for simple parallel function for conversion to netcdf
-def year_convert(infile, outfile, debug=False):
-    """Convert with cdo the grib to netcdf4 zip"""
-    cdo.debug = debug
-    cdo.copy(input=str(infile), output=str(outfile),
-             options='-t ecmwf -f nc4 -z zip --eccodes')
+def year_convert(infile, outfile, debug=False, backend='cdo', options=None):
+    """
+    Convert the grib to netcdf4 zip, with cdo or in-process with eccodes and netCDF4.
+
+    Parameters:
+        infile (str or Path): the GRIB file
+        outfile (str or Path): the NetCDF4 file
+        backend (str): 'cdo' or 'native'
+        options (dict): compression, chunking and quantization of the native backend (see NC_OPTIONS)
+    """
+    with span('convert', file=Path(infile).name, backend=backend, nbytes=os.path.getsize(infile)):
+        if backend == 'native':
+            try:
+                grib_to_netcdf(infile, outfile, options)
+                return
+            except UnsupportedGrid as e:
+                print(f'{e}, converting {infile} with cdo')
+        get_cdo(debug).copy(input=str(infile), output=str(outfile),
+                            options='-t ecmwf -f nc4 -z zip --eccodes')
 
 # get the first and last year from files of a given folder
 def first_last_year(filepattern):
@@ -313,13 +803,28 @@ def first_last_year(filepattern):
     return first_year, last_year
 
 # for autosearch of the missing years
-def which_new_years_download(storedir, dataset, var, freq, grid, levelout, area):
-    """Identify which years we need to download if something is already found"""
-
-    destdir = Path(storedir, var, freq)
-    filepattern = Path(destdir, create_filename(dataset, var, freq, grid,
-                                                levelout, area, '????', '????') + '.nc')
-    _, year1 = first_last_year(filepattern)
-    year1 = int(year1) + 1
+def which_new_years_download(storedir, dataset, var, freq, grid, levelout, area, state=None, record=True):
+    """
+    Identify which years we need to download if something is already found.
+
+    The state database is queried first. If it has no completed year for the product
+    the archive is detected from the filenames and, with record, recorded in the database.
+    """
+
+    product = product_key(dataset, var, freq, grid, levelout, area)
+    done = 'merged' if freq == 'mon' else 'converted'
+
+    years = state.years(product, done) if state is not None else []
+    if years:
+        year1 = years[-1] + 1
+    else:
+        destdir = Path(storedir, var, freq)
+        filepattern = Path(destdir, create_filename(dataset, var, freq, grid,
+                                                    levelout, area, '????', '????') + '.nc')
+        first_year, year1 = first_last_year(filepattern)
+        if state is not None and record:
+            for year in range(int(first_year), int(year1) + 1):
+                state.mark(product, year, done)
+        year1 = int(year1) + 1
     year2 = datetime.datetime.now().year - 1
     return year1, year2
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
 # basic python3 scripts to retrieve ERA5 data from the CDS, to replace old Bash scripts
-# Parallel retrieval is done as a function of the years (set nprocs)
-# A single variable at time can be retrieved
+# Parallel retrieval is done on a single pool of workers fed with all the (variable, year) tasks (set nprocs)
+# Multiple variables sharing the same properties can be retrieved
 # Data are downloaded in grib and then archived in netcdf4 zip using CDO bindings
 # Monthly means as well as hourly data can be downloaded
 # Multiple grids are supported
@@ -12,17 +12,27 @@
 
 import os
 import sys
+import time
+import functools
 from pathlib import Path
-from cdo import Cdo
-import shutil
-from multiprocessing import Process
-import glob
 
-from CDS_retriever import year_retrieve, year_convert, create_filename, first_last_year, which_new_years_download
+from CDS_retriever import year_retrieve, group_retrieve, group_name, year_convert, create_filename, \
+    which_new_years_download
 from config import parser, load_config, print_config
-
-
-cdo = Cdo()
+from scheduler import Task, run_tasks, run_stages
+from async_retrieve import retrieve_async
+from state import StateDB, STATE_NAME, product_key, reached
+from scratch import Scratch
+from request_cache import RequestCache
+from leases import Leases, LEASES_NAME, leased, SKIPPED
+from throttle import ADAPTIVE_OPTIONS, cpu_workers
+from regrid import convert_and_derive, WEIGHTS_NAME
+from resample import derive_frequency, hourly_source, needs_next_year, DERIVED_FREQS, ACCUMULATED
+from nrt import nrt_retrieve, plan_update, update_years, NRT_OPTIONS
+from planner import group_variables, print_plan
+from postproc import merge_monthly, aggregate_daily, aggregate_zarr
+import metrics
+from metrics import METRICS_NAME
 
 
 def main():
@@ -55,6 +65,13 @@ def main():
         do_retrieve = config['do_retrieve']
         do_postproc = config['do_postproc']
         do_align = config['do_align']
+        retrieve_mode = config['retrieve_mode']
+
+        # point cdsapi to a different endpoint (e.g. a local mock CDS)
+        if config['cds_url']:
+            os.environ['CDSAPI_URL'] = config['cds_url']
+        if config['cds_key']:
+            os.environ['CDSAPI_KEY'] = config['cds_key']
 
         # Override config with command line args
         if args.nprocs:
@@ -68,133 +85,385 @@ def main():
         if isinstance(varlist, str):
             varlist = [varlist]
 
+        # the CDS concurrency is adapted to its behaviour, within bounds
+        adaptive = None
+        if config['adaptive']:
+            if retrieve_mode != 'async':
+                sys.exit('The adaptive concurrency requires the async retrieve mode!')
+            adaptive = {**ADAPTIVE_OPTIONS, **(config['adaptive_options'] or {})}
+
+        # the daily data are not provided by the CDS, they can only be derived from the 1hr archive
+        if freq == 'day' and not config['derive_time']:
+            sys.exit('The day frequency requires derive_time!')
+
+        # in update mode the recent years can be updated by months and days
+        nrt = None
+        if config['nrt'] and update:
+            if retrieve_mode != 'blocking':
+                sys.exit('The near-real-time updates require the blocking retrieve mode!')
+            nrt = {**NRT_OPTIONS, **(config['nrt_options'] or {})}
+
+        # the conversion is CPU bound: it is sized on the local cores, not on the CDS concurrency
+        convert_workers = config['convert_workers'] or cpu_workers()
+
+        # several jobs sharing the same folders claim their tasks with leases
+        leases = None
+        if config['distributed']:
+            if config['pipeline'] or retrieve_mode != 'blocking':
+                sys.exit('The distributed mode requires the blocking retrieve mode without pipeline!')
+            if not args.plan:
+                leases = Leases(config['lease_dir'] or Path(storedir, LEASES_NAME), config['lease_ttl'])
+
+        # the state of every chunk, queried to plan the work: a dry run only reads it, if it exists
+        state_path = Path(config['state_db'] or Path(storedir, STATE_NAME))
+        if args.plan:
+            state = StateDB(state_path, readonly=True) if state_path.exists() else None
+        else:
+            Path(storedir).mkdir(parents=True, exist_ok=True)
+            state = StateDB(state_path, shared=config['distributed'])
+
+            # structured events of every process, summarized at the end of the run
+            metrics_file = config['metrics_file'] or Path(storedir, METRICS_NAME)
+            metrics.enable(metrics_file)
+        start = time.time()
+
+        # define the years and the actions for each variable
+        years, converted_years, ranges, hourly, nrt_years = {}, {}, {}, {}, {}
+        retrieve_vars, postproc_vars = [], []
         for var in varlist:
 
+            # the recent years missing some days or months, or with ERA5T months made final
+            nrt_years[var] = []
+            if nrt is not None:
+                product = product_key(dataset, var, freq, grid, levelout, area)
+                for year in update_years(state, product, nrt):
+                    # the corrupted files are removed by the update tasks, not while planning
+                    requests = plan_update(dataset, var, freq, year, grid, levelout, area, Path(tmpdir, var), state,
+                                           nrt, config['max_fields'], remove=False)
+                    if requests:
+                        nrt_years[var].append(str(year))
+                    for _, retrieve_dict, outfile, _ in requests:
+                        print(f"Update of {var} {year}: months {retrieve_dict['month']}, "
+                              f"days {retrieve_dict['day']} into {outfile.name}")
+
+            var_year1, var_year2 = year1, year2
+            var_retrieve, var_postproc = do_retrieve, do_postproc
             if update:
-                print("Update flag is true, detection of years...")
-                year1, year2 = which_new_years_download(storedir, dataset, var, freq, grid, levelout, area)
-                print(year1, year2)
-                if year1 > year2:
-                    print('Everything you want has been already downloaded, disabling retrieve...')
-                    do_retrieve = False
+                print(f"Update flag is true, detection of years for {var}...")
+                var_year1, var_year2 = which_new_years_download(storedir, dataset, var, freq, grid, levelout, area,
+                                                                state=state, record=not args.plan)
+                print(var_year1, var_year2)
+                if var_year1 > var_year2 and not nrt_years[var]:
+                    print(f'Everything you want for {var} has been already downloaded, disabling retrieve...')
+                    var_retrieve = False
                     if (freq == 'mon'):
-                        print('Everything you want has been already postprocessed, disabling postproc...')
-                        do_postproc = False
-
-            # create list of years
-            years = [str(i) for i in range(year1, year2+1)]
-
-            # define the out dir and file
+                        print(f'Everything you want for {var} has been already postprocessed, disabling postproc...')
+                        var_postproc = False
+
+            # create list of years, skipping those already converted
+            ranges[var] = sorted(set(range(var_year1, var_year2+1)) | {int(year) for year in nrt_years[var]})
+            statuses = state.statuses(product_key(dataset, var, freq, grid, levelout, area)) if state else {}
+            years[var] = [str(i) for i in range(var_year1, var_year2+1)
+                          if not reached(statuses.get(i), 'converted') and str(i) not in nrt_years[var]]
+            years[var] += nrt_years[var]
+            converted_years[var] = [i for i in range(var_year1, var_year2+1) if reached(statuses.get(i), 'converted')]
+            if converted_years[var] and not args.plan:
+                print(f'{len(converted_years[var])} years of {var} already converted, skipping them')
+
+            # the years available in the 1hr archive are derived locally instead of being retrieved
+            hourly[var] = {}
+            if config['derive_time'] and freq in DERIVED_FREQS and \
+                    not (freq == '6hrs' and dataset == 'ERA5-Land' and var in ACCUMULATED):
+                for year in [year for year in years[var] if year not in nrt_years[var]]:
+                    source = hourly_source(storedir, dataset, var, grid, levelout, area, year)
+                    nextfile = hourly_source(storedir, dataset, var, grid, levelout, area, int(year) + 1)
+                    if source.exists() and (nextfile.exists() or not needs_next_year(var)):
+                        hourly[var][year] = (source, nextfile if nextfile.exists() else None)
+                    elif source.exists() or freq == 'day':
+                        # the accumulations of the last hour of the year are in the next year
+                        reason = 'the next year is' if source.exists() else 'it is'
+                        print(f'{var} {year} cannot be derived since {reason} not in the 1hr archive yet, skipping it')
+                        years[var].remove(year)
+                if hourly[var] and not args.plan:
+                    print(f'{len(hourly[var])} years of {var} derived from the 1hr archive')
+
+            # define the out dir
             savedir = Path(tmpdir, var)
-            print(f'Creating directory {savedir} if it does not exist')
-            Path(savedir).mkdir(parents=True, exist_ok=True)
-
-            # retrieve block
-            if do_retrieve:
-
-                # loop on the years create the parallel process
-                processes = []
-                yearlist = [years[i:i + nprocs] for i in range(0, len(years), nprocs)]
-                for lyears in yearlist:
-                    print(f"Working on years {lyears}\n")
-                    for year in lyears:
-                        # print(year)
-                        p = Process(target=year_retrieve, args=(dataset, var, freq, year, grid, levelout,
-                                                                area, savedir, download_request))
-                        p.start()
-                        processes.append(p)
-
-                    # wait for all the processes to end
-                    for process in processes:
-                        process.join()
+            if not args.plan:
+                print(f'Creating directory {savedir} if it does not exist')
+                Path(savedir).mkdir(parents=True, exist_ok=True)
+
+            if var_retrieve and any(year not in hourly[var] for year in years[var]):
+                retrieve_vars.append(var)
+            if var_postproc and years[var]:
+                postproc_vars.append(var)
+
+        destdir = Path(storedir, freq)
+        if args.plan and not retrieve_vars:
+            print_plan([], config['max_fields'], state, destdir, converted_years)
+            print('Nothing to retrieve!')
+            return
+
+        # the retrieve tasks: one for each (variable, year), or for each (group of variables, year)
+        if config['coalesce']:
+            # merge the variables needed for the same year into combined requests
+            by_year = {}
+            for var in retrieve_vars:
+                for year in years[var]:
+                    if year not in hourly[var] and year not in nrt_years[var]:
+                        by_year.setdefault(year, []).append(var)
+            groups = [(group, year) for year, yvars in sorted(by_year.items())
+                      for group in group_variables(yvars, freq, levelout, download_request,
+                                                   config['max_fields'], dataset)]
+        else:
+            groups = [([var], year) for var in retrieve_vars for year in years[var]
+                      if year not in hourly[var] and year not in nrt_years[var]]
+        members = {group_name(group): group for group, _ in groups}
+        members.update({var: [var] for var in retrieve_vars if nrt_years[var]})
+
+        chunks = []
+        for group, year in groups:
+            if len(group) == 1:
+                chunks.append((dataset, group[0], freq, year, grid, levelout, area,
+                               Path(tmpdir, group[0]), download_request))
+            else:
+                chunks.append((dataset, group, freq, year, grid, levelout, area, Path(tmpdir), download_request))
+        if chunks:
+            print(f'{len(chunks)} retrieve tasks for {sum(len(group) for group, _ in groups)} variable-years')
+
+        if args.plan:
+            print_plan(chunks, config['max_fields'], state, destdir, converted_years)
+            return
+
+        # the download folder with a byte budget, shared by all the retrieve tasks
+        scratch = None
+        if config['scratch_options']:
+            scratch = Scratch(tmpdir, state, [(dataset, var, freq, grid, levelout, area) for var in varlist],
+                              config['scratch_options'])
+
+        # the requests shared with other configurations and users
+        cache = None
+        if config['request_cache']:
+            cache = RequestCache(config['request_cache'], config['cache_options'])
+
+        def lease_task(task, lease, skip_if=None):
+            # in distributed mode the task runs only if no other job holds its lease
+            if leases is None:
+                return task
+            return Task(task.key, leased, (leases, lease, task.func) + tuple(task.args),
+                        {**(task.kwargs or {}), 'skip_if': skip_if})
+
+        def retrieve_task(chunk):
+            task = Task((group_name(chunk[1]), chunk[3]),
+                        group_retrieve if isinstance(chunk[1], list) else year_retrieve, chunk,
+                        {'streams': config['download_streams'], 'state': state,
+                         'max_fields': config['max_fields'], 'month_workers': config['month_workers'],
+                         'scratch': scratch, 'cache': cache})
+            return lease_task(task, ('retrieve',) + task.key,
+                              (state, [(product_key(dataset, var, freq, grid, levelout, area), int(chunk[3]))
+                                       for var in members[task.key[0]]], 'verified'))
+
+        def nrt_task(var, year):
+            task = Task((var, year), nrt_retrieve, (dataset, var, freq, year, grid, levelout, area, Path(tmpdir, var)),
+                        {'streams': config['download_streams'], 'state': state, 'max_fields': config['max_fields'],
+                         'scratch': scratch, 'options': nrt})
+            return lease_task(task, ('retrieve', var, year))
+
+        retrieve_tasks = [retrieve_task(chunk) for chunk in chunks]
+        retrieve_tasks += [nrt_task(var, year) for var in retrieve_vars for year in nrt_years[var]]
+
+        if postproc_vars:
+            Path(destdir).mkdir(parents=True, exist_ok=True)
+
+        # the other grids and areas derived locally from the retrieved one
+        targets = [(target['grid'], target.get('area', 'global')) for target in config['derive'] or []]
+
+        def convert_task(var, year):
+            filename = create_filename(dataset, var, freq, grid, levelout, area, year)
+            outfile = Path(destdir, filename + '.nc')
+            if year in hourly[var]:
+                # resampled from the 1hr archive instead of converted from the GRIB file
+                infile, nextfile = hourly[var][year]
+                convert = functools.partial(derive_frequency, dataset, var, freq, year)
+                convert_options = {'nextfile': nextfile}
+            else:
+                infile = Path(tmpdir, var, filename + '.grib')
+                convert = year_convert
+                convert_options = {'backend': config['convert_backend'], 'options': config['convert_options']}
+            if targets:
+                derived = [(Path(destdir, create_filename(dataset, var, freq, tgrid, levelout, tarea, year) + '.nc'),
+                            tgrid, tarea) for tgrid, tarea in targets]
+                task = Task((var, year), convert_and_derive,
+                            (infile, outfile, derived, config['weights_dir'] or Path(storedir, WEIGHTS_NAME),
+                             config['remap_method']), {'convert': convert, **convert_options})
+            else:
+                task = Task((var, year), convert, (infile, outfile), convert_options)
+            return lease_task(task, ('convert', var, year),
+                              (state, [(product_key(dataset, var, freq, grid, levelout, area), int(year))],
+                               'converted'))
+
+        def mark_converted(var, year):
+            for pgrid, parea in [(grid, area)] + targets:
+                filename = create_filename(dataset, var, freq, pgrid, levelout, parea, year)
+                state.mark(product_key(dataset, var, freq, pgrid, levelout, parea), year, 'converted',
+                           path=str(Path(destdir, filename + '.nc')))
+            # the GRIB files just converted can now be evicted
+            if scratch is not None:
+                scratch.trim()
+
+        def aggregate_tasks(var):
+            # the derived daily data are kept as yearly files
+            if freq == 'day' and config['output_format'] != 'zarr':
+                return []
+            # the retrieved product and each derived one, a single job runs the aggregation of each of them
+            tasks = [product_aggregation((var,), var, grid, area)]
+            tasks += [product_aggregation((var, tgrid, product_key(dataset, var, freq, tgrid, levelout, tarea)[-1]),
+                                          var, tgrid, tarea) for tgrid, tarea in targets]
+            return [lease_task(task, ('aggregate',) + task.key) for task in tasks]
+
+        def product_aggregation(key, var, grid, area):
+            # append the new years to the Zarr stores
+            if config['output_format'] == 'zarr':
+                return Task(key, aggregate_zarr, (dataset, var, freq, grid, levelout, area, destdir, tmpdir,
+                                                  storedir, do_align, state), {'options': config['zarr_options']})
+            # extra processing for monthly data
+            if freq == "mon":
+                return Task(key, merge_monthly, (dataset, var, freq, grid, levelout, area, destdir, tmpdir,
+                                                 update, do_align, state))
+            # extra processing for daily data
+            return Task(key, aggregate_daily, (dataset, var, freq, grid, levelout, area, destdir, storedir, state))
+
+        # keep track of the tasks which went wrong
+        failures = {}
+
+        # pipelined mode: each year is converted as soon as it is retrieved,
+        # and each variable is aggregated as soon as all its years are converted
+        if config['pipeline']:
+
+            if retrieve_mode != 'blocking':
+                sys.exit('The pipeline mode requires the blocking retrieve mode!')
+
+            remaining = {var: set(years[var]) for var in postproc_vars}
+            broken, converted = set(), set()
+
+            def aggregations(var):
+                if var not in remaining or remaining[var]:
+                    return []
+                del remaining[var]
+                if var in broken:
+                    print(f'Skipping aggregation of {var} since some of its tasks failed')
+                    return []
+                if var not in converted:
+                    print(f'No new years converted for {var}, skipping aggregation')
+                    return []
+                return [('aggregate', task) for task in aggregate_tasks(var)]
+
+            def on_done(stage, key, ok):
+                follow = []
+                if stage == 'retrieve':
+                    for var in members[key[0]]:
+                        if var not in remaining:
+                            continue
+                        if ok:
+                            follow.append(('convert', convert_task(var, key[1])))
+                        else:
+                            broken.add(var)
+                            remaining[var].discard(key[1])
+                            follow.extend(aggregations(var))
+                elif stage == 'convert':
+                    var, year = key
+                    remaining[var].discard(year)
+                    if ok:
+                        mark_converted(var, year)
+                        converted.add(var)
+                    else:
+                        broken.add(var)
+                    follow.extend(aggregations(var))
+                return follow
+
+            # years to be converted without being retrieved first
+            initial = [('retrieve', task) for task in retrieve_tasks]
+            initial += [('convert', convert_task(var, year)) for var in postproc_vars
+                        for year in years[var] if var not in retrieve_vars or year in hourly[var]]
+
+            _, failed = run_stages(initial, on_done,
+                                   {'retrieve': nprocs, 'convert': convert_workers, 'aggregate': convert_workers},
+                                   backpressure={'retrieve': ('convert', config['queue_size'] or 2*convert_workers)})
+            for key, error in failed['retrieve'].items():
+                failures.update({('retrieve', var, key[1]): error for var in members[key[0]]})
+            failures.update({('convert',) + key: error for key, error in failed['convert'].items()})
+            failures.update({('aggregate',) + key: error for key, error in failed['aggregate'].items()})
+
+        else:
+
+            # retrieve block: a single queue with all the (variable, year) tasks
+            if retrieve_vars:
+
+                if retrieve_mode == 'async':
+                    _, failed = retrieve_async(chunks, max_queued=config['max_queued'],
+                                               download_workers=config['download_workers'],
+                                               poll_interval=config['poll_interval'],
+                                               streams=config['download_streams'], state=state,
+                                               max_fields=config['max_fields'], scratch=scratch,
+                                               adaptive=adaptive, cache=cache)
+                elif retrieve_mode == 'blocking':
+                    _, failed = run_tasks(retrieve_tasks, nprocs, label='retrieve tasks')
+                    # report the failures of the groups for each of their variables
+                    failed = {(var, key[1]): error for key, error in failed.items() for var in members[key[0]]}
+                else:
+                    sys.exit(f'Unknown retrieve mode {retrieve_mode}!')
+                failures.update({('retrieve',) + key: error for key, error in failed.items()})
 
             #
-            if do_postproc:
-
-                cdo.debug = True
+            if postproc_vars:
 
                 print('Running postproc...')
-                destdir = Path(storedir, freq)
-                Path(destdir).mkdir(parents=True, exist_ok=True)
-
-                # loop on the years create the parallel process for a fast conversion
-                processes = []
-                yearlist = [years[i:i + nprocs] for i in range(0, len(years), nprocs)]
-                for lyears in yearlist:
-                    for year in lyears:
-                        print('Conversion of ' + year)
-                        filename = create_filename(dataset, var, freq, grid, levelout, area, year)
-                        infile = Path(savedir, filename + '.grib')
-                        outfile = Path(destdir, filename + '.nc')
-                        p = Process(target=year_convert, args=(infile, outfile))
-                        # p = Process(target=cdo.copy, args=(infile, outfile, '-f nc4 -z zip'))
-                        p.start()
-                        processes.append(p)
-
-                    # wait for all the processes to end
-                    for process in processes:
-                        process.join()
-
-                    print('Conversion complete!')
-
-                # extra processing for monthly data
-                if freq == "mon":
-                    print('Extra processing for monthly...')
-
-                    filepattern = str(Path(destdir, create_filename(dataset, var, freq, grid, levelout, area, '????') + '.nc'))
-                    first_year, last_year = first_last_year(filepattern)
-
-                    if update:
-                        # check if big file exists
-                        bigfile = str(Path(destdir, create_filename(dataset, var, freq,
-                                      grid, levelout, area, '????', '????') + '.nc'))
-                        filebase = glob.glob(bigfile)
-                        first_year, _ = first_last_year(bigfile)
-                        filepattern = filebase + glob.glob(filepattern)
-
-                    mergefile = str(Path(destdir, create_filename(dataset, var, freq, grid,
-                                    levelout, area, first_year + '-' + last_year) + '.nc'))
-                    print(mergefile)
-                    if os.path.exists(mergefile):
-                        print(f'Removing existing file {mergefile}...')
-                        os.remove(mergefile)
-                    print(f'Merging together into {mergefile}...')
-                    cdo.cat(input=filepattern, output=mergefile, options='-f nc4 -z zip')
-                    if isinstance(filepattern, str):
-                        loop = glob.glob(filepattern)
-                        for f in loop:
-                            os.remove(f)
-
-                    # HACK: set a common time axis for monthly data (roll back cumulated by 6hours). useful for catalog xarray loading
-                    if do_align:
-                        print('Aligningment required...')
-                        first_time = cdo.showtime(input=f'-seltimestep,1 {mergefile}')[0]
-                        if first_time != '00:00:00':
-                            tempfile = str(Path(tmpdir, 'temp_align.nc'))
-                            shutil.move(mergefile, tempfile)
-                            cdo.shifttime('-6hours', input=tempfile, output=mergefile, options='-f nc4 -z zip')
-                            os.remove(tempfile)
-
-                # extra processing for daily data
-                else:
-                    print('Extra processing for daily and 6hrs...')
-                    daydir, mondir = [Path(storedir, var, x) for x in ['day', 'mon']]
-                    Path(daydir).mkdir(parents=True, exist_ok=True)
-                    Path(mondir).mkdir(parents=True, exist_ok=True)
-
-                    filepattern = Path(destdir, create_filename(dataset, var, freq, grid, levelout, area, '????') + '.nc')
-                    first_year, last_year = first_last_year(filepattern)
-
-                    dayfile = str(Path(daydir, create_filename(dataset, var, 'day', grid,
-                                  levelout, area, first_year + '-' + last_year) + '.nc'))
-                    # monfile = str(Path(mondir, create_filename(var, 'mon', grid, levelout, area, first_year + '-' + last_year) + '.nc'))
-
-                    if os.path.exists(dayfile):
-                        os.remove(dayfile)
 
-                    cdo.daymean(input='-cat ' + str(filepattern), 
-                                output=dayfile, options='-f nc4 -z zip')
-                    # cdo.monmean(input = dayfile, output = monfile, options = '-f nc4 -z zip')
+                # a single queue for a fast conversion, skipping the years whose retrieval failed
+                tasks = []
+                for var in postproc_vars:
+                    for year in years[var]:
+                        if ('retrieve', var, year) in failures:
+                            print(f'Skipping conversion of {var} {year} since its retrieval failed')
+                            continue
+                        tasks.append(convert_task(var, year))
+                converted, failed = run_tasks(tasks, convert_workers, label='conversion tasks')
+                failures.update({('convert',) + key: error for key, error in failed.items()})
+                for (var, year), value in converted.items():
+                    if value != SKIPPED:
+                        mark_converted(var, year)
+                print('Conversion complete!')
+
+                # the variables are aggregated in parallel
+                tasks = []
+                for var in postproc_vars:
+
+                    # do not aggregate incomplete archives
+                    if any(key[1] == var for key in failures):
+                        print(f'Skipping aggregation of {var} since some of its tasks failed')
+                        continue
+
+                    # in distributed mode, the aggregation is left to the last job completing the years
+                    product = product_key(dataset, var, freq, grid, levelout, area)
+                    if leases is not None:
+                        if not all(reached(state.status(product, year), 'converted') for year in ranges[var]):
+                            print(f'Years of {var} still in progress in other jobs, leaving them the aggregation')
+                            continue
+
+                    # nothing new to aggregate
+                    elif not any(key[0] == var for key in converted):
+                        print(f'No new years converted for {var}, skipping aggregation')
+                        continue
+
+                    tasks.extend(aggregate_tasks(var))
+                if tasks:
+                    _, failed = run_tasks(tasks, convert_workers, label='aggregate tasks')
+                    failures.update({('aggregate',) + key: error for key, error in failed.items()})
+
+        metrics.report(metrics_file, start, config['metrics_prom'])
+
+        if failures:
+            sys.exit(f'{len(failures)} tasks failed, see the summary above')
 
     else:
         sys.exit('Error in loading the configuration!')
@@ -0,0 +1,329 @@
+"""Asynchronous submit-then-poll retrieval of the CDS requests"""
+
+import os
+import time
+import asyncio
+from pathlib import Path
+
+from CDS_retriever import year_requests, group_requests, split_group, group_pieces, retrieve_pieces, group_name, \
+    finish_year, record_download, MAX_FIELDS
+from downloader import download_result, request_id
+from grib_scan import GribError
+from state import product_key, WHOLE_YEAR
+from scheduler import task_name, report_tasks
+from metrics import event
+from throttle import RequestController, DownloadController, THROTTLE_CODES, TRANSIENT_CODES, backoff, \
+    status_code, transient_error
+
+# states of a CDS request as reported by the API
+QUEUED = 'queued'
+ACCEPTED = 'accepted'  # queued, as reported by the current CDS API
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+def async_client(retry=True):
+    """
+    Create a non-blocking CDS API client.
+
+    The endpoint and the key are taken from ~/.cdsapirc or from the
+    CDSAPI_URL and CDSAPI_KEY environment variables, so that a local
+    mock CDS can be used as well. Without retry the errors of the CDS are
+    raised at once instead of being retried by cdsapi, e.g. to adapt the concurrency.
+    """
+    import cdsapi  # pylint: disable=import-outside-toplevel
+    # a single try of the current CDS API, whose errors keep their response
+    options = {} if retry else {'retry_max': 1}
+    client = cdsapi.Client(wait_until_complete=False, delete=False, quiet=True, **options)
+    if not retry:
+        # the legacy cdsapi hides the status of the errors behind 'Could not connect' once out of retries
+        client.robust = raise_transient
+    return client
+
+
+def raise_transient(call):
+    """Wrap an HTTP call of cdsapi raising the transient errors at once, with their response"""
+    def wrapped(*args, **kwargs):
+        response = call(*args, **kwargs)
+        if response.status_code in TRANSIENT_CODES:
+            response.raise_for_status()
+        return response
+    return wrapped
+
+
+def request_state(result):
+    """Ask the CDS for the updated state of a submitted request"""
+    result.update()
+    return result.reply['state']
+
+
+def request_error(result):
+    """Get the error message of a failed request"""
+    error = result.reply.get('error', {})
+    return f"{error.get('message', 'request failed')} {error.get('reason', '')}".strip()
+
+
+async def run_async_retrieve(jobs, client, max_queued=None, download_workers=2, poll_interval=30, streams=1,
+                             state=None, scratch=None, adaptive=None, cache=None):
+    """
+    Submit the CDS requests, poll them in a single loop and download the results as they become ready.
+
+    The number of requests waiting in the CDS queue (max_queued) and the number of
+    concurrent downloads (download_workers) are tuned independently. With the adaptive
+    options both are adapted within their bounds to the behaviour of the CDS, and the
+    submissions refused because of its load are retried with backoff and jitter.
+
+    Parameters:
+        jobs (list of dict): each job has 'key', 'kind', 'request', 'outfile', 'group' (the variables
+                             of the request) and 'args' (those of year_retrieve or group_retrieve)
+        client: a non-blocking CDS API client
+        max_queued (int): maximum number of requests in the CDS at the same time, None for all
+        download_workers (int): number of concurrent downloads
+        poll_interval (float): seconds between two polls of the CDS
+        streams (int): number of parallel range streams for large files
+        state (StateDB): where the request IDs and the downloads are recorded
+        scratch (Scratch): where the size of each download is reserved before it starts
+        adaptive (dict): options of the adaptive concurrency (see ADAPTIVE_OPTIONS), None for fixed numbers
+        cache (RequestCache): where the requests are looked up before being submitted, and stored once downloaded
+
+    Returns:
+        tuple: A tuple containing:
+            - done (dict): job key -> downloaded file
+            - failed (dict): job key -> error message
+    """
+
+    done, failed = {}, {}
+    pending = list(reversed(jobs))
+    inflight = {}
+    submit_times = {}
+    ready = asyncio.Queue()
+    retrying, attempts, downloading = [], {}, set()
+
+    requests, downloads = None, None
+    if adaptive is not None:
+        requests = RequestController(adaptive['min_requests'], adaptive['max_requests'], adaptive['start_requests'],
+                                     adaptive['latency_factor'], adaptive['cooldown'])
+        downloads = DownloadController(adaptive['min_downloads'], adaptive['max_downloads'],
+                                       adaptive['start_downloads'])
+        download_workers = adaptive['max_downloads']
+
+    def can_submit():
+        limit = requests.limit if requests else max_queued
+        return pending and (limit is None or len(inflight) < limit)
+
+    def fetch(job, result):
+        nbytes = download_result(result, job['outfile'], streams, scratch)
+        if cache is not None:
+            cache.store(job['kind'], job['request'], job['outfile'])
+        return place(job, result, nbytes)
+
+    def place(job, result, nbytes):
+        dataset, _, freq, year, grid, levelout, area, tmpdir, _ = job['args']
+        if len(job['group']) == 1:
+            pieces = {job['group'][0]: job['outfile']}
+            results = {job['group'][0]: result}
+        else:
+            nbytes = None
+            try:
+                pieces = split_group(dataset, job['group'], freq, year, grid, levelout, area, tmpdir,
+                                     job['outfile'])
+                results = dict.fromkeys(pieces, result)
+            except GribError as e:
+                # the rare combined requests which cannot be split are retrieved again by variable, blocking
+                print(f"{job['outfile'].name} cannot be split ({e}), retrieving its variables alone")
+                os.remove(job['outfile'])
+                pieces = group_pieces(dataset, job['group'], freq, year, grid, levelout, area, tmpdir,
+                                      job['outfile'])
+                results = retrieve_pieces(job['kind'], job['request'], pieces, year, streams, scratch, cache)
+        total = 0
+        for var, piece in pieces.items():
+            total += nbytes or piece.stat().st_size
+            record_download(state, product_key(dataset, var, freq, grid, levelout, area), year,
+                            job['request'], piece, results[var], nbytes or piece.stat().st_size)
+        return total
+
+    def submitted(job, result):
+        dataset, _, freq, year, grid, levelout, area, _, _ = job['args']
+        month = job['request']['month'] if isinstance(job['request']['month'], str) else WHOLE_YEAR
+        for var in job['group']:
+            state.mark(product_key(dataset, var, freq, grid, levelout, area), year, 'submitted',
+                       month=month, request_id=request_id(result))
+
+    async def downloader():
+        while True:
+            item = await ready.get()
+            if item is None:
+                return
+            job, result = item
+            # wait for a free slot among the adaptive downloads
+            while downloads and len(downloading) >= downloads.limit:
+                await asyncio.sleep(1)
+            downloading.add(job['key'])
+            try:
+                print(f"Downloading {task_name(job['key'])} into {job['outfile']}...")
+                nbytes = await asyncio.to_thread(fetch, job, result)
+                done[job['key']] = job['outfile']
+                if downloads:
+                    downloads.downloaded(nbytes)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                if downloads and status_code(e) in THROTTLE_CODES:
+                    downloads.throttled(status_code(e))
+                failed[job['key']] = f'download failed: {e}'
+                print(f"Download of {task_name(job['key'])} FAILED: {e}")
+            finally:
+                downloading.discard(job['key'])
+
+    workers = [asyncio.create_task(downloader()) for _ in range(download_workers)]
+
+    while pending or inflight or retrying:
+
+        # the refused submissions whose backoff has expired
+        now = time.monotonic()
+        pending.extend(job for when, job in retrying if when <= now)
+        retrying = [(when, job) for when, job in retrying if when > now]
+
+        # submit as many requests as the CDS queue concurrency allows
+        while can_submit():
+            job = pending.pop()
+            # identical requests are served from the cache without taking a slot in the CDS
+            if cache is not None:
+                try:
+                    nbytes = await asyncio.to_thread(cache.fetch, job['kind'], job['request'], job['outfile'],
+                                                     scratch)
+                    if nbytes is not None:
+                        await asyncio.to_thread(place, job, None, nbytes)
+                        done[job['key']] = job['outfile']
+                        continue
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    failed[job['key']] = f'cache failed: {e}'
+                    print(f"Cached copy of {task_name(job['key'])} FAILED: {e}")
+                    continue
+            try:
+                result = await asyncio.to_thread(client.retrieve, job['kind'], job['request'])
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                attempts[job['key']] = attempts.get(job['key'], 0) + 1
+                if requests and transient_error(e) and attempts[job['key']] < adaptive['max_attempts']:
+                    if status_code(e) in THROTTLE_CODES:
+                        requests.throttled(status_code(e))
+                    wait = backoff(attempts[job['key']], adaptive['backoff_base'], adaptive['backoff_cap'])
+                    print(f"Submission of {task_name(job['key'])} refused ({e}), retrying in {wait:.0f}s")
+                    retrying.append((time.monotonic() + wait, job))
+                    continue
+                failed[job['key']] = f'submission failed: {e}'
+                print(f"Submission of {task_name(job['key'])} FAILED: {e}")
+                continue
+            inflight[job['key']] = (job, result)
+            submit_times[job['key']] = time.perf_counter()
+            if state is not None:
+                await asyncio.to_thread(submitted, job, result)
+            print(f"Submitted {task_name(job['key'])} with request ID {request_id(result)}")
+
+        # poll all the in-flight requests at once
+        polled = list(inflight.items())
+        states = await asyncio.gather(*(asyncio.to_thread(request_state, result) for _, (_, result) in polled),
+                                      return_exceptions=True)
+        counts = {QUEUED: 0, RUNNING: 0}
+        for (key, (job, result)), reply_state in zip(polled, states):
+            if isinstance(reply_state, Exception):
+                # a failed poll is not a failed request: try again at the next round
+                print(f'Polling of {task_name(key)} failed, will retry: {reply_state}')
+                if requests and status_code(reply_state) in THROTTLE_CODES:
+                    requests.throttled(status_code(reply_state))
+            elif reply_state == COMPLETED:
+                inflight.pop(key)
+                # time spent in the CDS queue and in the processing of the request
+                latency = time.perf_counter() - submit_times[key]
+                event('cds_request', duration=round(latency, 3), status='ok',
+                      var=key[0], year=key[1], request_id=request_id(result))
+                if requests:
+                    requests.completed(latency)
+                ready.put_nowait((job, result))
+            elif reply_state == FAILED:
+                inflight.pop(key)
+                failed[key] = request_error(result)
+                event('cds_request', duration=round(time.perf_counter() - submit_times[key], 3), status='error',
+                      var=key[0], year=key[1], request_id=request_id(result), error=failed[key])
+                print(f'Request {request_id(result)} for {task_name(key)} FAILED: {failed[key]}')
+            elif reply_state in [QUEUED, ACCEPTED]:
+                counts[QUEUED] += 1
+            elif reply_state == RUNNING:
+                counts[RUNNING] += 1
+        if requests and polled:
+            requests.polled(counts[QUEUED], counts[RUNNING])
+
+        if inflight and not can_submit():
+            await asyncio.sleep(poll_interval)
+        elif retrying and not inflight and not pending:
+            await asyncio.sleep(max(min(when for when, _ in retrying) - time.monotonic(), 0))
+
+    # let the downloaders drain the queue and stop
+    for _ in workers:
+        ready.put_nowait(None)
+    await asyncio.gather(*workers)
+
+    return done, failed
+
+
+def retrieve_async(chunks, max_queued=None, download_workers=2, poll_interval=30, streams=1, state=None,
+                   max_fields=MAX_FIELDS, scratch=None, adaptive=None, cache=None):
+    """
+    Retrieve all the years in submit-then-poll mode.
+
+    Parameters:
+        chunks (list of tuple): the arguments of year_retrieve for each year, or those of
+                                group_retrieve for groups of variables retrieved together
+        max_queued (int): maximum number of requests in the CDS at the same time, None for all
+        download_workers (int): number of concurrent downloads
+        poll_interval (float): seconds between two polls of the CDS
+        streams (int): number of parallel range streams for large files
+        state (StateDB): where the status of the chunks is recorded
+        max_fields (int): maximum number of fields of a single CDS request
+        scratch (Scratch): where the size of each download is reserved before it starts
+        adaptive (dict): options of the adaptive concurrency (see ADAPTIVE_OPTIONS), None for fixed numbers
+        cache (RequestCache): the shared cache of the requests, None to always ask the CDS
+
+    Returns:
+        tuple: A tuple containing:
+            - done (dict): (var, year) -> None
+            - failed (dict): (var, year) -> error message
+    """
+
+    # expand the years into the single CDS requests
+    jobs, plans = [], []
+    for args in chunks:
+        _, var, _, year, _, _, _, _, request = args
+        if isinstance(var, list):
+            group, requests = group_requests(*args, state=state, max_fields=max_fields)
+        else:
+            group, requests = [var], year_requests(*args, state=state, max_fields=max_fields)
+        plans.append((args, group))
+        for kind, retrieve_dict, outfile in requests:
+            key = (group_name(group), year) + ((outfile.name,) if request != 'yearly' else ())
+            jobs.append({'key': key, 'kind': kind, 'request': retrieve_dict, 'outfile': outfile,
+                         'group': group, 'args': args})
+
+    print(f'Submitting {len(jobs)} requests to the CDS...')
+    _, failed = asyncio.run(run_async_retrieve(jobs, async_client(retry=adaptive is None), max_queued=max_queued,
+                                               download_workers=download_workers,
+                                               poll_interval=poll_interval, streams=streams,
+                                               state=state, scratch=scratch, adaptive=adaptive,
+                                               cache=cache))
+
+    # fold back the requests into years and assemble the monthly chunks
+    year_done, year_failed = {}, {}
+    for args, group in plans:
+        dataset, var, freq, year, grid, levelout, area, outdir, request = args
+        name = group_name(group)
+        errors = [error for key, error in failed.items() if key[:2] == (name, year)]
+        for member in group:
+            if errors:
+                year_failed[(member, year)] = '; '.join(errors)
+                continue
+            if any(job['key'][:2] == (name, year) for job in jobs):
+                member_dir = Path(outdir, member) if isinstance(var, list) else outdir
+                finish_year(dataset, member, freq, year, grid, levelout, area, member_dir, request, state)
+            year_done[(member, year)] = None
+
+    report_tasks(year_done, year_failed, label='retrieve tasks')
+    return year_done, year_failed
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# benchmark of the GRIB to NetCDF4 conversion: cdo against the native backend
+# with different compression, chunking and quantization settings.
+# Throughput is given in MB/s of GRIB input, size as the NetCDF/GRIB ratio
+
+import os
+import time
+import argparse
+import tempfile
+import itertools
+from pathlib import Path
+
+from CDS_retriever import year_convert
+
+
+def bench(infile, outfile, backend, options, repeat):
+    """Convert a file repeat times and return the best wall time"""
+    best = None
+    for _ in range(repeat):
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        start = time.perf_counter()
+        year_convert(infile, outfile, backend=backend, options=options)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    """Run the benchmark"""
+
+    bparser = argparse.ArgumentParser(description="Benchmark of the GRIB to NetCDF4 conversion backends")
+    bparser.add_argument("gribfile", help="GRIB file to be converted, e.g. one year downloaded by the retriever")
+    bparser.add_argument("-r", "--repeat", type=int, default=3, help="Repetitions of each conversion")
+    bparser.add_argument("--complevel", type=int, nargs='+', default=[1, 4], help="zlib levels to be tested")
+    bparser.add_argument("--chunks", nargs='+', default=['map', 'time'], help="Chunk layouts to be tested")
+    bparser.add_argument("--digits", type=int, nargs='+', default=[], help="Significant digits to be tested")
+    bparser.add_argument("--no-cdo", action="store_true", help="Skip the cdo reference")
+    args = bparser.parse_args()
+
+    insize = os.path.getsize(args.gribfile)
+    runs = [] if args.no_cdo else [('cdo', None)]
+    for complevel, chunks, digits in itertools.product(args.complevel, args.chunks, [None] + args.digits):
+        runs.append(('native', {'complevel': complevel, 'chunks': chunks, 'significant_digits': digits}))
+
+    print(f'Converting {args.gribfile} ({insize / 1024**2:.1f} MB), best of {args.repeat}')
+    print(f"{'backend':8} {'options':60} {'seconds':>8} {'MB/s':>8} {'ratio':>6}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for backend, options in runs:
+            outfile = Path(tmpdir, 'bench.nc')
+            elapsed = bench(args.gribfile, outfile, backend, options, args.repeat)
+            ratio = os.path.getsize(outfile) / insize
+            print(f"{backend:8} {str(options or ''):60} {elapsed:8.2f} {insize / 1024**2 / elapsed:8.1f} {ratio:6.2f}")
+
+
+if __name__ == "__main__":
+    main()
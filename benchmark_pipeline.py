@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# end-to-end benchmark of the retrieve -> convert -> merge flow against a local fake CDS.
+# Each scenario runs ERA5_retrieve_postproc.py in a subprocess and records the wall time,
+# the time of each phase, the peak RSS and the bytes written, which are compared with
+# a baseline so that changes of the scheduler or of the conversion can be measured offline.
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+import yaml
+
+from fake_cds import start_server
+from metrics import METRICS_NAME, read_events, summarize
+
+HERE = Path(__file__).resolve().parent
+
+# default file of the baseline
+BASELINE = Path(HERE, 'benchmark_baseline.json')
+
+# representative configurations, overriding config.tmpl
+SCENARIOS = {
+    'mon-sfc': {
+        'dataset': 'ERA5', 'varlist': ['2m_temperature', 'total_precipitation'], 'freq': 'mon',
+        'levelout': 'sfc', 'grid': '0.25x0.25', 'area': 'global', 'year': {'begin': 2000, 'end': 2002},
+        'download_request': 'yearly',
+    },
+    '1hr-plev19': {
+        'dataset': 'ERA5', 'varlist': ['temperature'], 'freq': '1hr', 'levelout': 'plev19',
+        'grid': '2.5x2.5', 'area': [60, 0, 30, 40], 'year': {'begin': 2001, 'end': 2001},
+        'download_request': 'monthly',
+    },
+    'land-area': {
+        'dataset': 'ERA5-Land', 'varlist': ['2m_temperature'], 'freq': '1hr', 'levelout': 'sfc',
+        'grid': '0.1x0.1', 'area': [46, 7, 44, 12], 'year': {'begin': 2001, 'end': 2002},
+        'download_request': 'yearly',
+    },
+}
+
+# the progress messages opening and closing each phase, None for the end of the run
+PHASES = {
+    'retrieve': (['Submitting', 'retrieve tasks on'], 'Summary of retrieve tasks'),
+    'convert': (['conversion tasks on'], 'Summary of conversion tasks'),
+    'aggregate': (['Conversion complete!'], 'Summary of aggregate tasks'),
+    'pipeline': (['Running pipeline'], 'Summary of aggregate tasks'),
+}
+
+
+def tree_size(path):
+    """Total size of the files in a folder"""
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+
+def run_scenario(name, overrides, url, nprocs, workdir):
+    """
+    Run a scenario from scratch and measure it.
+
+    Returns:
+        dict: the metrics of the run
+    """
+
+    with open(Path(HERE, 'config.tmpl'), 'r', encoding='utf8') as file:
+        config = yaml.safe_load(file)
+    config.update(overrides)
+    config['year'] = {'update': False, **config['year']}
+    config.update(tmpdir=str(Path(workdir, 'tmp')), storedir=str(Path(workdir, 'store')),
+                  nprocs=nprocs, cds_url=url, cds_key='1:benchmark')
+    configfile = Path(workdir, 'config.yaml')
+    with open(configfile, 'w', encoding='utf8') as file:
+        yaml.safe_dump(config, file)
+
+    print(f'Running scenario {name}...')
+    env = {**os.environ, 'CDSAPI_URL': url, 'CDSAPI_KEY': '1:benchmark', 'PYTHONUNBUFFERED': '1'}
+    start = time.perf_counter()
+    marks = {}
+    with subprocess.Popen([sys.executable, str(Path(HERE, 'ERA5_retrieve_postproc.py')), '-c', str(configfile),
+                           '-n', str(nprocs)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                          env=env, cwd=workdir) as proc:
+        with open(Path(workdir, 'output.log'), 'w', encoding='utf8') as log:
+            for line in proc.stdout:
+                now = time.perf_counter() - start
+                log.write(line)
+                for phase, (opening, closing) in PHASES.items():
+                    if phase not in marks and any(text in line for text in opening):
+                        marks[phase] = [now, None]
+                    if phase in marks and closing is not None and closing in line:
+                        marks[phase][1] = now
+        # the resource usage of the run and of the processes it started
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - start
+    for phase, (_, closing) in PHASES.items():
+        if phase in marks and closing is None:
+            marks[phase][1] = wall
+
+    return {
+        'status': proc.returncode,
+        'wall_time': round(wall, 2),
+        'phases': {phase: round(end - begin, 2) for phase, (begin, end) in marks.items() if end is not None},
+        'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),
+        'bytes_written': usage.ru_oublock * 512,
+        'scratch_bytes': tree_size(Path(workdir, 'tmp')),
+        'store_bytes': tree_size(Path(workdir, 'store')),
+        # time of each stage summed over the processes, from the events of the run
+        'stages': {stage: round(stats['seconds'], 2) for stage, stats in
+                   summarize(read_events(Path(workdir, 'store', METRICS_NAME))).items()},
+    }
+
+
+def compare(results, baseline):
+    """Print the ratio of the results with the baseline"""
+    print(f"\n{'scenario':12} {'metric':20} {'baseline':>12} {'now':>12} {'ratio':>7}")
+    for name, metrics in results.items():
+        if name not in baseline:
+            print(f'{name:12} not in the baseline, store it again with --save-baseline', file=sys.stderr)
+            continue
+        old = baseline[name]
+        pairs = [(key, old.get(key), metrics[key]) for key in ['wall_time', 'peak_rss_mb', 'bytes_written']]
+        pairs += [(f'phase {phase}', old.get('phases', {}).get(phase), value)
+                  for phase, value in metrics['phases'].items()]
+        pairs += [(f'stage {stage}', old.get('stages', {}).get(stage), value)
+                  for stage, value in metrics['stages'].items()]
+        for key, before, now in pairs:
+            ratio = f'{now / before:7.2f}' if before else '      -'
+            print(f'{name:12} {key:20} {str(before):>12} {str(now):>12} {ratio}')
+
+
+def main():
+    """Run the benchmark"""
+
+    bparser = argparse.ArgumentParser(description="End-to-end benchmark against a local fake CDS")
+    bparser.add_argument("-s", "--scenario", nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS),
+                         help="Scenarios to be run")
+    bparser.add_argument("-n", "--nprocs", type=int, default=4, help="Number of parallel processes")
+    bparser.add_argument("--queue-delay", type=float, default=2, help="Seconds each request stays queued")
+    bparser.add_argument("--max-running", type=int, default=4, help="Requests processed at the same time")
+    bparser.add_argument("--bandwidth", type=float, help="Download bandwidth of each connection in MB/s")
+    bparser.add_argument("--max-active", type=int, help="Active requests beyond which submissions get HTTP 429")
+    bparser.add_argument("--baseline", default=BASELINE, help="File of the baseline")
+    bparser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    bparser.add_argument("--keep", action="store_true", help="Keep the working folders")
+    args = bparser.parse_args()
+
+    # the baseline depends on the host, so it is not shipped: the first run on a host creates it
+    first = not Path(args.baseline).exists()
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='cds_benchmark_') as tmp:
+        server = start_server(Path(tmp, 'server'), queue_delay=args.queue_delay, max_running=args.max_running,
+                              bandwidth=args.bandwidth, max_active=args.max_active)
+        try:
+            for name in args.scenario:
+                workdir = Path(tempfile.mkdtemp(prefix=f'{name}_', dir=tmp if not args.keep else None))
+                results[name] = run_scenario(name, SCENARIOS[name], server.url, args.nprocs, workdir)
+                print(json.dumps(results[name], indent=2))
+                if results[name]['status'] != 0:
+                    print(f'Scenario {name} FAILED, see {workdir}/output.log', file=sys.stderr)
+        finally:
+            server.shutdown()
+
+    if not first:
+        with open(args.baseline, 'r', encoding='utf8') as file:
+            compare(results, json.load(file)['results'])
+
+    failed = [name for name, result in results.items() if result['status'] != 0]
+    if first and not args.save_baseline:
+        print(f'No baseline in {args.baseline}, ' + ('storing these results as the baseline of this host' if not failed
+                                                     else 'not stored since some scenarios failed'))
+    if args.save_baseline or (first and not failed):
+        with open(args.baseline, 'w', encoding='utf8') as file:
+            json.dump({'host': platform.node(), 'python': platform.python_version(), 'nprocs': args.nprocs,
+                       'queue_delay': args.queue_delay, 'date': time.strftime('%Y-%m-%d %H:%M'),
+                       'results': results}, file, indent=2)
+        print(f'Baseline stored in {args.baseline}')
+
+    if failed:
+        sys.exit(f"Scenarios {', '.join(failed)} FAILED")
+
+
+if __name__ == "__main__":
+    main()
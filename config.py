@@ -3,6 +3,44 @@
 import argparse
 import yaml
 
+# default values for the optional keys of the configuration file
+DEFAULTS = {
+    'retrieve_mode': 'blocking',
+    'download_workers': 2,
+    'max_queued': None,
+    'poll_interval': 30,
+    'cds_url': None,
+    'cds_key': None,
+    'download_streams': 1,
+    'state_db': None,
+    'coalesce': False,
+    'max_fields': 120000,
+    'pipeline': False,
+    'convert_workers': None,
+    'adaptive': False,
+    'adaptive_options': None,
+    'queue_size': None,
+    'month_workers': 1,
+    'convert_backend': 'cdo',
+    'convert_options': None,
+    'scratch_options': None,
+    'request_cache': None,
+    'nrt': False,
+    'nrt_options': None,
+    'cache_options': None,
+    'distributed': False,
+    'lease_dir': None,
+    'lease_ttl': 600,
+    'derive': None,
+    'remap_method': 'bil',
+    'weights_dir': None,
+    'derive_time': False,
+    'output_format': 'netcdf',
+    'zarr_options': None,
+    'metrics_file': None,
+    'metrics_prom': None,
+}
+
 
 def parser():
     """
@@ -14,6 +52,9 @@ def parser():
     internal_parser.add_argument("-c", "--config", help="Path to the YAML configuration file")
     internal_parser.add_argument("-n", "--nprocs", type=int, help="Number of parallel processes")
     internal_parser.add_argument("-u", "--update", action="store_true", help="Update existing dataset")
+    internal_parser.add_argument("-p", "--plan", "--dry-run", dest="plan", action="store_true",
+                                 help="List the CDS requests, the output files and their estimated size and exit, "
+                                      "without using CDO or the network")
 
     # Parse the command-line arguments
     return internal_parser.parse_args()
@@ -28,7 +69,8 @@ def load_config(file_path):
     with open(file_path, 'r', encoding='utf8') as file:
         try:
             config = yaml.safe_load(file)
-            return config
+            # an empty file is loaded as None
+            return {**DEFAULTS, **(config or {})}
         except yaml.YAMLError as exc:
             print(f"Error loading config file: {exc}")
             return None
@@ -45,12 +87,45 @@ def print_config(conf_dict):
     print(f"Data range: {conf_dict['year']['begin']}-{conf_dict['year']['end']}")
     if conf_dict['year']['update']:
         print('Updating existing datasets...')
+        if conf_dict['nrt']:
+            print(f"Recent years updated by months and days with options {conf_dict['nrt_options'] or 'default'}")
     print(f"Vertical levels: {conf_dict['levelout']}")
     print(f"Data frequency: {conf_dict['freq']}")
     print(f"Grid selection: {conf_dict['grid']}")
     print(f"Area: {conf_dict['area']}")
+    for target in conf_dict['derive'] or []:
+        print(f"Derived locally with {conf_dict['remap_method']} remapping: grid {target['grid']}, "
+              f"area {target.get('area', 'global')}")
+    if conf_dict['derive_time']:
+        print("Years available in the 1hr archive derived locally instead of being retrieved")
     print(f"Number of parallel processes: {conf_dict['nprocs']}")
+    if conf_dict['pipeline']:
+        print("Pipelined retrieve, conversion and aggregation")
+    print(f"Number of conversion processes: {conf_dict['convert_workers'] or 'one per core'}")
+    if conf_dict['convert_backend'] == 'native':
+        print(f"In-process NetCDF4 conversion with options {conf_dict['convert_options'] or 'default'}")
+    if conf_dict['distributed']:
+        print(f"Distributed mode: tasks claimed with leases expiring after {conf_dict['lease_ttl']}s")
+    if conf_dict['scratch_options']:
+        print(f"Managed download folder with options {conf_dict['scratch_options']}")
+    if conf_dict['request_cache']:
+        print(f"Requests shared through the cache in {conf_dict['request_cache']} "
+              f"with options {conf_dict['cache_options'] or 'default'}")
+    if conf_dict['output_format'] == 'zarr':
+        print(f"Years appended to Zarr stores with options {conf_dict['zarr_options'] or 'default'}")
     print(f"Download {conf_dict['download_request']} chunks")
+    if conf_dict['month_workers'] > 1 and conf_dict['download_request'] != 'yearly':
+        print(f"Up to {conf_dict['month_workers']} concurrent chunks within each year")
+    if conf_dict['retrieve_mode'] == 'async':
+        print(f"Submit-then-poll retrieval with {conf_dict['download_workers']} download workers")
+    if conf_dict['adaptive']:
+        print(f"Adaptive CDS concurrency with options {conf_dict['adaptive_options'] or 'default'}")
+    if conf_dict['coalesce']:
+        print(f"Variables merged into requests of at most {conf_dict['max_fields']} fields")
+    if conf_dict['download_streams'] > 1:
+        print(f"Large files downloaded with {conf_dict['download_streams']} parallel streams")
+    if conf_dict['cds_url']:
+        print(f"CDS endpoint: {conf_dict['cds_url']}")
     print('Actions:')
     if conf_dict['do_retrieve']:
         print('\t - Retrieving data')
@@ -0,0 +1,229 @@
+"""Pooled, resumable and atomic downloads of the CDS results"""
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+from metrics import span
+from throttle import backoff
+
+# size of the blocks read from the network
+CHUNK_SIZE = 4 * 1024**2
+
+# files smaller than this are always fetched with a single stream
+MIN_STREAM_SIZE = 1024**3
+
+# save the progress of the parallel streams every this many bytes
+PROGRESS_EVERY = 64 * 1024**2
+
+_local = threading.local()
+
+
+def get_session():
+    """Get the HTTP session of the current worker, so that connections are reused"""
+    if not hasattr(_local, 'session'):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+    return _local.session
+
+
+def remote_size(url):
+    """
+    Ask the server for the size of a file and if it accepts range requests
+
+    Returns:
+        tuple: (size in bytes or None, True if HTTP Range requests are supported)
+    """
+    reply = get_session().head(url, allow_redirects=True, timeout=60)
+    reply.raise_for_status()
+    size = reply.headers.get('Content-Length')
+    ranges = reply.headers.get('Accept-Ranges', '') == 'bytes'
+    return (int(size) if size is not None else None), ranges
+
+
+def _fetch_range(url, part, start, end, progress=None):
+    """
+    Fetch the bytes start-end (inclusive, end=None for the end of file) into the part file.
+
+    Returns the number of bytes written. If the server ignores the range the
+    whole file is written from the beginning and -1 is returned.
+    """
+
+    headers = {}
+    if start > 0 or end is not None:
+        headers['Range'] = f"bytes={start}-{'' if end is None else end}"
+
+    written = 0
+    with get_session().get(url, headers=headers, stream=True, timeout=60) as reply:
+        reply.raise_for_status()
+        restart = bool(headers) and reply.status_code != 206
+        offset = 0 if restart else start
+        fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if restart:
+                os.ftruncate(fd, 0)
+            for block in reply.iter_content(chunk_size=CHUNK_SIZE):
+                os.pwrite(fd, block, offset + written)
+                written += len(block)
+                if progress is not None:
+                    progress(written)
+        finally:
+            os.close(fd)
+
+    return -1 if restart else written
+
+
+def _stream_download(url, part, size, streams):
+    """Fetch a file with several parallel range streams, keeping track of their progress"""
+
+    statefile = Path(str(part) + '.json')
+    bounds = [(i * size // streams, (i + 1) * size // streams - 1) for i in range(streams)]
+
+    # progress of each stream from a previous interrupted run
+    state = {}
+    if statefile.exists() and Path(part).exists():
+        with open(statefile, 'r', encoding='utf8') as file:
+            state = json.load(file)
+        if state.get('size') != size or state.get('streams') != streams:
+            state = {}
+    if not state:
+        state = {'size': size, 'streams': streams, 'done': [0] * streams}
+        with open(part, 'wb') as file:
+            file.truncate(size)
+
+    lock = threading.Lock()
+
+    def save_state():
+        tmp = Path(str(statefile) + '.tmp')
+        with open(tmp, 'w', encoding='utf8') as file:
+            json.dump(state, file)
+        os.replace(tmp, statefile)
+
+    def run(i):
+        start, end = bounds[i]
+        resume = start + state['done'][i]
+        if resume > end:
+            return
+        saved = [0]
+
+        def progress(written):
+            if written - saved[0] >= PROGRESS_EVERY:
+                with lock:
+                    state['done'][i] = resume - start + written
+                    save_state()
+                saved[0] = written
+
+        written = _fetch_range(url, part, resume, end, progress)
+        if written < 0:
+            raise IOError(f'Server ignored the range request for {url}')
+        with lock:
+            state['done'][i] = resume - start + written
+            save_state()
+
+    with ThreadPoolExecutor(max_workers=streams) as executor:
+        list(executor.map(run, range(streams)))
+
+    statefile.unlink()
+
+
+def download(url, target, size=None, streams=1, retries=5):
+    """
+    Download a file into a .part file, resuming interrupted transfers with HTTP Range requests.
+    The file is checked against the server-reported size and then atomically renamed to target.
+
+    Parameters:
+        url (str): the location of the file
+        target (str or Path): the final file
+        size (int): the expected size in bytes, asked to the server if None
+        streams (int): number of parallel range streams for large files
+        retries (int): number of attempts before giving up
+
+    Returns:
+        int: the size of the downloaded file
+    """
+
+    target = Path(target)
+    with span('download', file=target.name, streams=streams) as info:
+        info['nbytes'] = _download(url, target, size, streams, retries, info)
+    return info['nbytes']
+
+
+def _download(url, target, size, streams, retries, info):
+    """Body of download, counting the retries in info"""
+
+    part = Path(str(target) + '.part')
+
+    ranges = None
+    for attempt in range(1, retries + 1):
+        try:
+            # asked within the retries, so that a transient failure of the server is retried here too
+            if ranges is None:
+                server_size, ranges = remote_size(url)
+                if size is None:
+                    size = server_size
+            if streams > 1 and ranges and size is not None and size >= MIN_STREAM_SIZE:
+                _stream_download(url, part, size, streams)
+            else:
+                start = part.stat().st_size if part.exists() and ranges else 0
+                if size is not None and start > size:
+                    start = 0
+                if start == 0 or size is None or start < size:
+                    if start == 0 and part.exists():
+                        part.unlink()
+                    if start > 0:
+                        print(f'Resuming download of {target} from byte {start}...')
+                    _fetch_range(url, part, start, None)
+            break
+        except (requests.RequestException, IOError) as e:
+            if attempt == retries:
+                raise
+            info['retries'] = attempt
+            wait = backoff(attempt, 2, 60)
+            print(f'Download of {target} interrupted ({e}), retrying in {wait:.0f}s...')
+            time.sleep(wait)
+
+    # check the size before the atomic rename
+    got = part.stat().st_size
+    if size is not None and got != size:
+        raise IOError(f'Download of {target} incomplete: {got} bytes instead of {size}')
+    os.replace(part, target)
+    return got
+
+
+def result_file(result):
+    """
+    The URL and the size (None if unknown) of the file of a completed CDS request.
+    The requests submitted without waiting to the current CDS API (Remote) point to their Results.
+    """
+    if hasattr(result, 'make_results'):
+        result = result.make_results(wait=False)
+    return result.location, getattr(result, 'content_length', None)
+
+
+def download_result(result, target, streams=1, scratch=None):
+    """Download the file of a completed CDS request, reserving its size in the scratch if managed"""
+    url, size = result_file(result)
+    if scratch is None:
+        return download(url, target, size=size, streams=streams)
+    with scratch.reserve(size, target):
+        return download(url, target, size=size, streams=streams)
+
+
+def request_id(result):
+    """
+    The CDS request ID of a result of the legacy cdsapi (in its reply) or of the current CDS API
+    (request_uid of the submitted requests, in the URL of the results), None if unknown
+    """
+    uid = getattr(result, 'request_uid', None)
+    if uid is None and isinstance(getattr(result, 'reply', None), dict):
+        uid = result.reply.get('request_id')
+    if uid is None and str(getattr(result, 'url', '')).endswith('/results'):
+        uid = result.url.rstrip('/').split('/')[-2]
+    return uid
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+# local stand-in of the CDS API, compatible with the legacy cdsapi.Client protocol
+# (POST /resources/<dataset>, GET /tasks/<id>), serving synthetic GRIB1 files with
+# the fields of each request after a simulated queue delay.
+# Use a key in the uid:key form (e.g. 1:benchmark) so that cdsapi uses this protocol.
+
+import os
+import json
+import time
+import uuid
+import random
+import argparse
+import calendar
+import datetime
+import threading
+import tempfile
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# block size of the downloads
+BLOCK_SIZE = 1024**2
+
+# largest GRIB1 message without the ECMWF large-message coding
+MAX_MESSAGE = 0x800000
+
+
+def _signed(value, nbytes):
+    """Encode a GRIB1 signed integer (sign bit and magnitude)"""
+    sign = 1 << (8 * nbytes - 1) if value < 0 else 0
+    return (sign | abs(int(value))).to_bytes(nbytes, 'big')
+
+
+def _ibm_float(value):
+    """Encode a GRIB1 reference value as an IBM single precision float"""
+    if value == 0:
+        return bytes(4)
+    sign = 0x80000000 if value < 0 else 0
+    value, exponent = abs(value), 64
+    while value >= 1:
+        value /= 16
+        exponent += 1
+    while value < 1 / 16:
+        value *= 16
+        exponent -= 1
+    mantissa = int(round(value * 2**24))
+    if mantissa == 2**24:
+        mantissa, exponent = mantissa // 16, exponent + 1
+    return (sign | exponent << 24 | mantissa).to_bytes(4, 'big')
+
+
+def _param_id(var):
+    """GRIB parameter ID of a CDS variable name"""
+    try:
+        # pylint: disable=import-outside-toplevel
+        from CDS_retriever import PARAM_IDS
+    except ImportError:
+        PARAM_IDS = {}
+    if var in PARAM_IDS:
+        return PARAM_IDS[var]
+    # an arbitrary but stable parameter of the ECMWF local table 128
+    return 1 + sum(var.encode()) % 250
+
+
+def grib1_message(date, param, level, grid, rng, expver='0001'):
+    """
+    Build a decodable GRIB1 message on a regular lat-lon grid with 16 (or 8) bit random values,
+    with the ECMWF local definition 1 holding the experiment version as in the CDS files.
+
+    Parameters:
+        date (datetime): the reference and validity time of the field
+        param (int): GRIB parameter ID, table*1000+param for tables other than 128
+        level (int): pressure level in hPa, 0 for surface fields
+        grid (tuple): (north, west, south, east, increment) in degrees
+        rng (random.Random): source of the values
+        expver (str): the experiment version, '0001' for ERA5 and '0005' for ERA5T
+    """
+
+    north, west, south, east, step = grid
+    nlat = int(round((north - south) / step)) + 1
+    nlon = int(round((east - west) / step)) + 1
+    npoints = nlat * nlon
+    bits = 16 if 2 * npoints + 128 < MAX_MESSAGE else 8
+    if bits * npoints // 8 + 128 >= MAX_MESSAGE:
+        raise ValueError(f'Grid of {npoints} points is too large for a GRIB1 message')
+
+    table, number = (128, param) if param < 1000 else divmod(param, 1000)
+    century = (date.year - 1) // 100 + 1
+    pds = bytearray(52)
+    pds[0:3] = (52).to_bytes(3, 'big')
+    pds[3], pds[4], pds[5], pds[6], pds[7] = table, 98, 1, 255, 0x80
+    pds[8], pds[9] = number, 100 if level else 1
+    pds[10:12] = int(level).to_bytes(2, 'big')
+    pds[12], pds[13], pds[14], pds[15], pds[16] = date.year - (century - 1) * 100, date.month, date.day, date.hour, 0
+    pds[17], pds[20], pds[24] = 1, 0, century
+    # local definition 1: class ea, type an, stream oper and the expver
+    pds[40], pds[41], pds[42], pds[43:45], pds[45:49] = 1, 151, 2, (1025).to_bytes(2, 'big'), expver.encode()
+
+    gds = bytearray(32)
+    gds[0:3] = (32).to_bytes(3, 'big')
+    gds[4], gds[5] = 255, 0
+    gds[6:8], gds[8:10] = nlon.to_bytes(2, 'big'), nlat.to_bytes(2, 'big')
+    gds[10:13], gds[13:16] = _signed(north * 1000, 3), _signed(west * 1000, 3)
+    gds[16] = 0x80
+    gds[17:20], gds[20:23] = _signed(south * 1000, 3), _signed(east * 1000, 3)
+    gds[23:25] = gds[25:27] = int(round(step * 1000)).to_bytes(2, 'big')
+    gds[27] = 0
+
+    data = rng.randbytes(bits * npoints // 8)
+    length = 11 + len(data)
+    padding = length % 2
+    bds = (length + padding).to_bytes(3, 'big') + bytes([8 * padding]) + _signed(-8, 2) + _ibm_float(200.0) \
+        + bytes([bits]) + data + bytes(padding)
+
+    body = bytes(pds) + bytes(gds) + bds + b'7777'
+    return b'GRIB' + (8 + len(body)).to_bytes(3, 'big') + b'\x01' + body
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def request_grid(retrieve_dict, resolution):
+    """The (north, west, south, east, increment) of the synthetic fields of a request"""
+    step = float(_as_list(retrieve_dict['grid'])[0]) if 'grid' in retrieve_dict else resolution
+    if 'area' in retrieve_dict:
+        north, west, south, east = [float(x) for x in retrieve_dict['area']]
+    else:
+        north, west, south, east = 90.0, 0.0, -90.0, 360.0 - step
+    return north, west, south, east, step
+
+
+def synthetic_grib(retrieve_dict, target, resolution=1.0, seed=0, final_months=3):
+    """
+    Write a GRIB1 file with one field for each time, variable and level of a CDS request.
+    Days which do not exist in a month are skipped, as the CDS does. The fields of the last
+    final_months months and of the current one have the expver of the preliminary ERA5T data.
+
+    Returns:
+        int: the number of fields written
+    """
+
+    rng = random.Random(seed)
+    grid = request_grid(retrieve_dict, resolution)
+    year = int(_as_list(retrieve_dict['year'])[0])
+    params = [_param_id(var) for var in _as_list(retrieve_dict['variable'])]
+    levels = [int(level) for level in _as_list(retrieve_dict.get('pressure_level', 0))]
+    today = datetime.date.today()
+    index = today.year * 12 + today.month - 1 - final_months
+    preliminary = datetime.datetime(index // 12, index % 12 + 1, 1)
+    nfields = 0
+    with open(target, 'wb') as out:
+        for month in sorted(int(m) for m in _as_list(retrieve_dict['month'])):
+            ndays = calendar.monthrange(year, month)[1]
+            for day in sorted(int(d) for d in _as_list(retrieve_dict.get('day', '01'))):
+                if day > ndays:
+                    continue
+                for hour in sorted(int(t.split(':')[0]) for t in _as_list(retrieve_dict.get('time', '00:00'))):
+                    date = datetime.datetime(year, month, day, hour)
+                    expver = '0005' if date >= preliminary else '0001'
+                    for param in params:
+                        for level in levels:
+                            out.write(grib1_message(date, param, level, grid, rng, expver))
+                            nfields += 1
+    return nfields
+
+
+class FakeCDS(ThreadingHTTPServer):
+    """
+    HTTP server holding the submitted requests.
+
+    Parameters:
+        address (tuple): (host, port), port 0 for a free port
+        workdir (str or Path): where the results are written
+        queue_delay (float): seconds a request stays queued
+        resolution (float): grid increment of the requests without grid
+        max_running (int): requests processed at the same time, None for no limit
+        fail_rate (float): fraction of requests which fail
+        bandwidth (float): download bandwidth of each connection in MB/s, None for no limit
+        max_active (int): requests queued or running at the same time, beyond which the
+                          submissions are refused with HTTP 429, None for no limit
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, workdir, queue_delay=5, resolution=1.0, max_running=None, fail_rate=0,
+                 bandwidth=None, max_active=None):
+        super().__init__(address, Handler)
+        self.workdir = Path(workdir)
+        self.queue_delay = queue_delay
+        self.resolution = resolution
+        self.fail_rate = fail_rate
+        self.bandwidth = bandwidth
+        self.max_active = max_active
+        self.slots = threading.Semaphore(max_running) if max_running else None
+        self.tasks = {}
+        self.refused = 0
+        self.lock = threading.Lock()
+        self.rng = random.Random(0)
+
+    @property
+    def url(self):
+        """The API url to be used as CDSAPI_URL"""
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/api'
+
+    def active(self):
+        """Number of requests queued or running"""
+        return sum(1 for task in list(self.tasks.values()) if task['state'] in ['queued', 'running'])
+
+    def submit(self, dataset, retrieve_dict):
+        """Queue a request and process it in the background, None (counted in refused) if too many are active"""
+        rid = uuid.uuid4().hex
+        with self.lock:
+            if self.max_active and self.active() >= self.max_active:
+                self.refused += 1
+                return None
+            fails = self.rng.random() < self.fail_rate
+            self.tasks[rid] = {'state': 'queued', 'request_id': rid, 'dataset': dataset}
+        threading.Thread(target=self._process, args=(rid, retrieve_dict, fails), daemon=True).start()
+        return self.reply(rid)
+
+    def _process(self, rid, retrieve_dict, fails):
+        time.sleep(self.queue_delay)
+        if self.slots:
+            self.slots.acquire()  # pylint: disable=consider-using-with
+        try:
+            self.tasks[rid]['state'] = 'running'
+            if fails:
+                raise RuntimeError('simulated failure of the request')
+            target = Path(self.workdir, rid + '.grib')
+            synthetic_grib(retrieve_dict, target, self.resolution, seed=int(rid[:8], 16))
+            self.tasks[rid].update(state='completed', path=target, size=target.stat().st_size)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.tasks[rid].update(state='failed', error={'message': 'the request you have submitted is not valid',
+                                                          'reason': str(e)})
+        finally:
+            if self.slots:
+                self.slots.release()
+
+    def reply(self, rid):
+        """The reply of the API for a request"""
+        task = self.tasks[rid]
+        reply = {'state': task['state'], 'request_id': rid}
+        if task['state'] == 'completed':
+            reply.update(location=f'{self.url}/download/{rid}.grib', content_length=task['size'],
+                         content_type='application/x-grib')
+        elif task['state'] == 'failed':
+            reply['error'] = task['error']
+        return reply
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Endpoints of the legacy CDS API"""
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _json(self, content, code=200):
+        body = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _task(self):
+        rid = self.path.rstrip('/').split('/')[-1].split('.')[0]
+        return rid if rid in self.server.tasks else None
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Submit a request"""
+        if '/resources/' not in self.path:
+            self._json({'message': 'not found'}, 404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        dataset = self.path.rstrip('/').split('/')[-1]
+        reply = self.server.submit(dataset, request)
+        if reply is None:
+            self._json({'message': 'Too Many Requests', 'error': {'message': 'Too Many Requests',
+                                                                 'reason': 'too many active requests'}}, 429)
+            return
+        self._json(reply, 202)
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        """Delete a request and its result"""
+        rid = self._task()
+        if rid is None:
+            self._json({'message': 'not found'}, 404)
+            return
+        task = self.server.tasks.pop(rid)
+        if task.get('path') and task['path'].exists():
+            task['path'].unlink()
+        self._json({}, 200)
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        """Size of a result"""
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):  # pylint: disable=invalid-name,arguments-differ
+        """Status of the service, of a request, or download of a result"""
+        if self.path.endswith('/status.json'):
+            self._json({})
+            return
+        rid = self._task()
+        if rid is None:
+            self._json({'message': 'not found'}, 404)
+            return
+        if '/tasks/' in self.path:
+            self._json(self.server.reply(rid))
+            return
+        if '/download/' not in self.path or self.server.tasks[rid]['state'] != 'completed':
+            self._json({'message': 'not found'}, 404)
+            return
+
+        path, size = self.server.tasks[rid]['path'], self.server.tasks[rid]['size']
+        start, end = 0, size - 1
+        ranged = self.headers.get('Range', '').startswith('bytes=')
+        if ranged:
+            first, last = self.headers['Range'][6:].split('-')
+            start, end = int(first), int(last) if last else size - 1
+        self.send_response(206 if ranged else 200)
+        self.send_header('Content-Type', 'application/x-grib')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if ranged:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if not body:
+            return
+
+        with open(path, 'rb') as file:
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = file.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                began = time.perf_counter()
+                self.wfile.write(block)
+                remaining -= len(block)
+                if self.server.bandwidth:
+                    # throttle each connection to the requested bandwidth
+                    elapsed = time.perf_counter() - began
+                    time.sleep(max(0, len(block) / (self.server.bandwidth * 1024**2) - elapsed))
+
+
+def start_server(workdir=None, port=0, **options):
+    """
+    Start a fake CDS in a background thread.
+
+    Returns:
+        FakeCDS: the server, whose url attribute is the API endpoint
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix='fake_cds_')
+    os.makedirs(workdir, exist_ok=True)
+    server = FakeCDS(('127.0.0.1', port), workdir, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    """Run the fake CDS in the foreground"""
+
+    fparser = argparse.ArgumentParser(description="Local stand-in of the CDS API serving synthetic GRIB files")
+    fparser.add_argument("-p", "--port", type=int, default=8765, help="Port of the server")
+    fparser.add_argument("-w", "--workdir", help="Folder for the results (a temporary folder by default)")
+    fparser.add_argument("--queue-delay", type=float, default=5, help="Seconds each request stays queued")
+    fparser.add_argument("--resolution", type=float, default=1.0, help="Grid increment of the requests without grid")
+    fparser.add_argument("--max-running", type=int, help="Requests processed at the same time")
+    fparser.add_argument("--fail-rate", type=float, default=0, help="Fraction of the requests which fail")
+    fparser.add_argument("--bandwidth", type=float, help="Download bandwidth of each connection in MB/s")
+    fparser.add_argument("--max-active", type=int, help="Active requests beyond which submissions get HTTP 429")
+    args = fparser.parse_args()
+
+    server = start_server(args.workdir, args.port, queue_delay=args.queue_delay, resolution=args.resolution,
+                          max_running=args.max_running, fail_rate=args.fail_rate, bandwidth=args.bandwidth,
+                          max_active=args.max_active)
+    print(f'Fake CDS running at {server.url}, results in {server.workdir}')
+    print(f'Use it with: export CDSAPI_URL={server.url} CDSAPI_KEY=1:benchmark')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+"""Lightweight GRIB scanner reading the message headers without decoding the data"""
+
+import os
+import json
+import sqlite3
+import hashlib
+import datetime
+from contextlib import closing
+from pathlib import Path
+
+# name of the verdict index stored in each download folder
+INDEX_NAME = '.grib_index.sqlite'
+
+# length in seconds of the time units of GRIB1 and GRIB2
+TIME_UNITS = {
+    1: {0: 60, 1: 3600, 2: 86400, 10: 3*3600, 11: 6*3600, 12: 12*3600, 13: 900, 14: 1800, 254: 1},
+    2: {0: 60, 1: 3600, 2: 86400, 10: 3*3600, 11: 6*3600, 12: 12*3600, 13: 1},
+}
+
+# GRIB1 time range indicators where the field is valid at the end of the period P2
+GRIB1_END_OF_PERIOD = [2, 3, 4, 5]
+
+# offset of the end of the overall time interval in the section 4 of the GRIB2 templates of
+# statistically processed fields: 4.8, and 4.11 where it follows the octets of the ensemble member
+GRIB2_END_OF_INTERVAL = {8: 34, 11: 37}
+
+# the ECMWF centre, whose local sections hold the experiment version (expver)
+ECMWF = 98
+
+
+class GribError(Exception):
+    """Raised when a file is not a valid or complete GRIB file"""
+
+
+def _uint(data):
+    return int.from_bytes(data, 'big')
+
+
+def _grib1_fields(file, offset, length):
+    """Decode the section 1 of a GRIB1 message"""
+
+    file.seek(offset + 8)
+    pds = file.read(3)
+    pds += file.read(_uint(pds) - 3)
+    if len(pds) < 28:
+        raise GribError(f'Truncated section 1 at byte {offset}')
+
+    table, param, level_type = pds[3], pds[8], pds[9]
+    level = _uint(pds[10:12]) if level_type in [100, 103, 105, 107, 109, 113, 117, 119, 125, 160] else 0
+    century = pds[24]
+    reftime = datetime.datetime((century - 1) * 100 + pds[12], pds[13], pds[14], pds[15], pds[16])
+
+    unit, tri = pds[17], pds[20]
+    if tri == 10:
+        step = _uint(pds[18:20])
+    elif tri in GRIB1_END_OF_PERIOD:
+        step = pds[19]
+    elif tri in [0, 1]:
+        step = pds[18]
+    else:
+        # averages and other statistics are referred to the reference time
+        step = 0
+
+    validity = reftime + datetime.timedelta(seconds=step * TIME_UNITS[1].get(unit, 3600))
+
+    # the ECMWF local definitions have class, type, stream and expver after the standard octets
+    expver = None
+    if pds[4] == ECMWF and len(pds) >= 49:
+        expver = pds[45:49].decode('ascii', 'replace')
+    yield {
+        'offset': offset,
+        'length': length,
+        'edition': 1,
+        'param': param if table == 128 else table * 1000 + param,
+        'level': level,
+        'reftime': reftime,
+        'validity': validity,
+        'expver': expver,
+    }
+
+
+def _grib1_length(file, offset, length):
+    """Get the real length of ECMWF large GRIB1 messages (more than 8MB)"""
+
+    if not length & 0x800000:
+        return length
+
+    # the length is coded in units of 120 bytes and corrected with the section 4 length
+    length = (length & 0x7fffff) * 120
+    file.seek(offset + 8)
+    pos = offset + 8
+    pds = file.read(8)
+    flag = pds[7]
+    pos += _uint(pds[0:3])
+    for present in [flag & 0x80, flag & 0x40]:
+        if present:
+            file.seek(pos)
+            pos += _uint(file.read(3))
+    file.seek(pos)
+    bds_length = _uint(file.read(3))
+    if bds_length <= 120:
+        length = length - bds_length + 4
+    return length
+
+
+def _grib2_fields(file, offset, length, discipline):
+    """Decode the sections 1, 2 and 4 of a GRIB2 message"""
+
+    pos = offset + 16
+    end = offset + length - 4
+    reftime, centre, expver = None, None, None
+    while pos < end:
+        file.seek(pos)
+        header = file.read(5)
+        if len(header) < 5:
+            raise GribError(f'Truncated message at byte {offset}')
+        section_length, number = _uint(header[0:4]), header[4]
+        if section_length < 5:
+            raise GribError(f'Invalid section {number} at byte {pos}')
+
+        if number == 1:
+            sec = header + file.read(section_length - 5)
+            centre = _uint(sec[5:7])
+            reftime = datetime.datetime(_uint(sec[12:14]), sec[14], sec[15], sec[16], sec[17], sec[18])
+
+        elif number == 2 and centre == ECMWF:
+            # experimentVersionNumber of the ECMWF local section, after its definition, class, type and stream
+            sec = header + file.read(section_length - 5)
+            if len(sec) >= 15:
+                expver = sec[11:15].decode('ascii', 'replace')
+
+        elif number == 4:
+            sec = header + file.read(section_length - 5)
+            template = _uint(sec[7:9])
+            category, param = sec[9], sec[10]
+            unit, step = sec[17], _uint(sec[18:22])
+            level_type, scale, value = sec[22], sec[23], _uint(sec[24:28])
+            level = 0
+            if level_type == 100:
+                # isobaric levels are coded in Pa
+                level = int(round(value / 10**scale / 100))
+            # statistically processed fields are valid at the end of the interval
+            end_of_interval = GRIB2_END_OF_INTERVAL.get(template)
+            if end_of_interval is not None and len(sec) >= end_of_interval + 7:
+                eoi = sec[end_of_interval:end_of_interval + 7]
+                validity = datetime.datetime(_uint(eoi[0:2]), eoi[2], eoi[3], eoi[4], eoi[5], eoi[6])
+            else:
+                validity = reftime + datetime.timedelta(seconds=step * TIME_UNITS[2].get(unit, 3600))
+            yield {
+                'offset': offset,
+                'length': length,
+                'edition': 2,
+                'param': f'{discipline}.{category}.{param}',
+                'level': level,
+                'reftime': reftime,
+                'validity': validity,
+                'expver': expver,
+            }
+
+        pos += section_length
+
+
+def scan_grib(filename):
+    """
+    Walk the messages of a GRIB file reading only their headers.
+
+    Yields:
+        dict: one per field with offset, length, edition, param, level, reftime, validity
+              and expver (None if the message has no ECMWF local section)
+
+    Raises:
+        GribError: if the file is not GRIB or a message is truncated
+    """
+
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as file:
+        offset = 0
+        while offset < size:
+            file.seek(offset)
+            sec0 = file.read(16)
+            if sec0[0:4] != b'GRIB':
+                if not sec0.strip(b'\x00'):
+                    # some writers pad the end of the file
+                    return
+                raise GribError(f'No GRIB message found at byte {offset} of {filename}')
+
+            edition = sec0[7]
+            if edition == 1:
+                length = _grib1_length(file, offset, _uint(sec0[4:7]))
+                fields = _grib1_fields(file, offset, length)
+            elif edition == 2:
+                length = _uint(sec0[8:16])
+                fields = _grib2_fields(file, offset, length, sec0[6])
+            else:
+                raise GribError(f'Unknown GRIB edition {edition} at byte {offset} of {filename}')
+
+            if offset + length > size:
+                raise GribError(f'Truncated message at byte {offset} of {filename}')
+            file.seek(offset + length - 4)
+            if file.read(4) != b'7777':
+                raise GribError(f'Missing end of message at byte {offset} of {filename}')
+
+            yield from list(fields)
+            offset += length
+
+
+def time_key(date, granularity):
+    """Reduce a datetime to the granularity of the expected times"""
+    if granularity == 'month':
+        return (date.year, date.month)
+    return (date.year, date.month, date.day, date.hour)
+
+
+def check_grib(filename, expected, nfields=1, granularity='hour'):
+    """
+    Check that a GRIB file has all the expected times, each with the expected number of fields.
+
+    Parameters:
+        filename (str or Path): the GRIB file
+        expected (set): the expected times, as produced by time_key()
+        nfields (int): the number of fields (levels x variables) expected at each time
+        granularity (str): 'hour' to check validity times, 'month' to check reference months
+
+    Returns:
+        tuple: (True if the file is complete, description of the verdict)
+    """
+
+    counts = {}
+    for field in scan_grib(filename):
+        date = field['reftime'] if granularity == 'month' else field['validity']
+        key = time_key(date, granularity)
+        counts[key] = counts.get(key, 0) + 1
+
+    missing = [key for key in expected if counts.get(key, 0) < nfields]
+    if missing:
+        return False, f'{len(missing)} of {len(expected)} times missing or incomplete, first is {min(missing)}'
+    return True, f'{len(expected)} times with {nfields} fields each'
+
+
+def month_expvers(filename):
+    """
+    Read the experiment versions of the fields of a GRIB file, e.g. to tell
+    the final ERA5 data ('0001') from the preliminary ERA5T data ('0005').
+
+    Returns:
+        dict: (year, month) of the reference time -> set of the expvers of its fields
+    """
+
+    expvers = {}
+    for field in scan_grib(filename):
+        if field['expver'] is not None:
+            expvers.setdefault(time_key(field['reftime'], 'month'), set()).add(field['expver'])
+    return expvers
+
+
+def _expectation_digest(expected, nfields, granularity):
+    text = json.dumps([sorted(expected), nfields, granularity])
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _open_index(filename):
+    index = sqlite3.connect(Path(Path(filename).parent, INDEX_NAME), timeout=60)
+    index.execute('CREATE TABLE IF NOT EXISTS verdicts (path TEXT PRIMARY KEY, size INTEGER, '
+                  'mtime INTEGER, expectation TEXT, complete INTEGER, message TEXT)')
+    return index
+
+
+def check_grib_cached(filename, expected, nfields=1, granularity='hour'):
+    """
+    Same as check_grib(), but the verdict is stored in an index in the folder of the file,
+    keyed on path, size and modification time, so that unchanged files are not scanned again.
+    """
+
+    stat = os.stat(filename)
+    path = str(Path(filename).resolve())
+    digest = _expectation_digest(expected, nfields, granularity)
+
+    try:
+        with closing(_open_index(filename)) as index, index:
+            row = index.execute('SELECT complete, message FROM verdicts WHERE path=? AND size=? '
+                                'AND mtime=? AND expectation=?',
+                                (path, stat.st_size, stat.st_mtime_ns, digest)).fetchone()
+    except sqlite3.Error:
+        row = None
+    if row is not None:
+        return bool(row[0]), row[1] + ' (cached)'
+
+    complete, message = check_grib(filename, expected, nfields, granularity)
+
+    try:
+        with closing(_open_index(filename)) as index, index:
+            index.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?)',
+                          (path, stat.st_size, stat.st_mtime_ns, digest, int(complete), message))
+    except sqlite3.Error as e:
+        print(f'Cannot store the verdict for {filename} in the index: {e}')
+
+    return complete, message
+
+
+def split_grib(filename, outfiles):
+    """
+    Split the messages of a GRIB file into several files according to their parameter.
+    Messages are copied byte by byte, nothing is decoded.
+
+    Parameters:
+        filename (str or Path): the GRIB file with several parameters
+        outfiles (dict): parameter (as in scan_grib) -> output file
+
+    Returns:
+        dict: output file -> number of bytes written
+
+    Raises:
+        GribError: if a message has a parameter which is not in outfiles
+    """
+
+    # a GRIB2 message may hold more fields, copy it only once
+    messages = {}
+    for field in scan_grib(filename):
+        if field['param'] not in outfiles:
+            raise GribError(f"Unexpected parameter {field['param']} in {filename}")
+        messages[field['offset']] = (field['length'], field['param'])
+
+    written = {}
+    handles = {}
+    try:
+        with open(filename, 'rb') as file:
+            for offset, (length, param) in sorted(messages.items()):
+                outfile = outfiles[param]
+                if outfile not in handles:
+                    handles[outfile] = open(str(outfile) + '.part', 'wb')  # pylint: disable=consider-using-with
+                    written[outfile] = 0
+                file.seek(offset)
+                handles[outfile].write(file.read(length))
+                written[outfile] += length
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    for outfile in written:
+        os.replace(str(outfile) + '.part', outfile)
+    return written
+
+
+def merge_grib(infiles, outfile):
+    """
+    Merge several GRIB files into one, with the messages sorted by validity time.
+    Messages with the same time keep the order of the input files, so that chunks
+    split by levels are reassembled with all the fields of a time step together.
+
+    Returns:
+        int: the number of bytes written
+    """
+
+    messages = {}
+    for index, filename in enumerate(infiles):
+        for field in scan_grib(filename):
+            key = (index, field['offset'])
+            if key not in messages:
+                messages[key] = (field['validity'], field['length'])
+
+    order = sorted(messages, key=lambda key: (messages[key][0], key))
+    written = 0
+    handles = [open(filename, 'rb') for filename in infiles]  # pylint: disable=consider-using-with
+    try:
+        with open(str(outfile) + '.part', 'wb') as out:
+            for index, offset in order:
+                length = messages[(index, offset)][1]
+                handles[index].seek(offset)
+                out.write(handles[index].read(length))
+                written += length
+    finally:
+        for handle in handles:
+            handle.close()
+
+    os.replace(str(outfile) + '.part', outfile)
+    return written
+
+
+def concat_grib(infiles, outfile, blocksize=16 * 1024**2):
+    """
+    Concatenate several GRIB files into one, in the given order.
+    GRIB messages are self-delimiting, so the files are copied as streams of bytes.
+
+    Returns:
+        int: the number of bytes written
+    """
+
+    written = 0
+    with open(str(outfile) + '.part', 'wb') as out:
+        for filename in infiles:
+            with open(filename, 'rb') as file:
+                while True:
+                    block = file.read(blocksize)
+                    if not block:
+                        break
+                    out.write(block)
+                    written += len(block)
+
+    os.replace(str(outfile) + '.part', outfile)
+    return written
+
+
+def splice_grib(basefile, newfiles, outfile):
+    """
+    Splice the messages of newer files into a GRIB file, e.g. the days and months of an update.
+    The messages of basefile with the same parameter, level and times of a newer message are
+    replaced, the others are kept, and all of them are sorted by validity time as in merge_grib.
+
+    Parameters:
+        basefile (str or Path): the file to be updated, it may not exist
+        newfiles (list): the files with the new messages, the later ones taking precedence
+
+    Returns:
+        int: the number of bytes written
+    """
+
+    def field_key(field):
+        return (field['param'], field['level'], field['reftime'], field['validity'])
+
+    infiles = ([basefile] if os.path.exists(basefile) else []) + list(newfiles)
+    fields = [list(scan_grib(filename)) for filename in infiles]
+
+    # the most recent file of each field
+    owner = {}
+    for index, file_fields in enumerate(fields):
+        for field in file_fields:
+            owner[field_key(field)] = index
+
+    # a message is kept if its file is the most recent one of any of its fields
+    messages = {}
+    for index, file_fields in enumerate(fields):
+        for field in file_fields:
+            if owner[field_key(field)] == index and (index, field['offset']) not in messages:
+                messages[(index, field['offset'])] = (field['validity'], field['length'])
+
+    order = sorted(messages, key=lambda key: (messages[key][0], key))
+    written = 0
+    handles = [open(filename, 'rb') for filename in infiles]  # pylint: disable=consider-using-with
+    try:
+        with open(str(outfile) + '.part', 'wb') as out:
+            for index, offset in order:
+                length = messages[(index, offset)][1]
+                handles[index].seek(offset)
+                out.write(handles[index].read(length))
+                written += length
+    finally:
+        for handle in handles:
+            handle.close()
+
+    os.replace(str(outfile) + '.part', outfile)
+    return written
@@ -0,0 +1,135 @@
+"""Leases of the tasks, shared by several jobs through files in a common folder"""
+
+import os
+import time
+import uuid
+import fcntl
+import socket
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+from state import reached
+
+# default folder of the leases in the storedir
+LEASES_NAME = '.cds_retriever_leases'
+
+# value returned by the tasks completed by another worker
+SKIPPED = 'skipped'
+
+
+class LeaseBusy(Exception):
+    """Raised when a task is leased by another worker: it has to be run again later"""
+
+
+class Leases:
+    """
+    Leases of the tasks of several jobs (e.g. SLURM jobs on different nodes) sharing the same folders.
+
+    A lease is a file holding the name of its owner, created and removed under an
+    fcntl lock of the folder. Its holder renews its mtime while working: when the holder
+    dies the lease is not renewed anymore and any other worker can take it after ttl seconds.
+    Only the folder and the ttl are kept, so that the object can be passed to the worker processes.
+    """
+
+    def __init__(self, folder, ttl=600):
+        self.folder = str(folder)
+        self.ttl = ttl
+        Path(self.folder).mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _lock(self):
+        """Serialize the changes of the leases, POSIX locks also work across NFS clients"""
+        with open(Path(self.folder, 'lock'), 'a', encoding='utf8') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    def _path(self, lease):
+        return Path(self.folder, '_'.join(str(x) for x in lease).replace('/', '-') + '.lease')
+
+    def acquire(self, lease):
+        """
+        Take a lease if it is free or expired.
+
+        Returns:
+            str: the owner name, needed to renew and release the lease, or None if it is held by another worker
+        """
+        path = self._path(lease)
+        owner = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        with self._lock():
+            if path.exists():
+                age = time.time() - path.stat().st_mtime
+                if age < self.ttl:
+                    return None
+                print(f'Lease {path.name} of {path.read_text(encoding="utf8")} expired {age:.0f}s ago, taking it')
+            path.write_text(owner, encoding='utf8')
+        return owner
+
+    def owner(self, lease):
+        """The current owner of a lease, None if it is free"""
+        try:
+            return self._path(lease).read_text(encoding='utf8')
+        except FileNotFoundError:
+            return None
+
+    def renew(self, lease, owner):
+        """Extend a lease held by owner, under the lock so that a lease just taken over is not renewed"""
+        with self._lock():
+            if self.owner(lease) == owner:
+                os.utime(self._path(lease))
+
+    def release(self, lease, owner):
+        """Free a lease held by owner"""
+        with self._lock():
+            if self.owner(lease) == owner:
+                self._path(lease).unlink()
+
+    @contextmanager
+    def hold(self, lease):
+        """
+        Hold a lease while running a task, renewing it in the background.
+        LeaseBusy is raised if the lease is held by another worker.
+        """
+        owner = self.acquire(lease)
+        if owner is None:
+            raise LeaseBusy(f'{" ".join(str(x) for x in lease)} is leased by {self.owner(lease)}')
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.ttl / 4):
+                self.renew(lease, owner)
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield owner
+        finally:
+            stop.set()
+            thread.join()
+            self.release(lease, owner)
+
+
+def leased(leases, lease, func, *args, skip_if=None, **kwargs):
+    """
+    Run a task function under a lease, raising LeaseBusy if another worker holds it.
+
+    Parameters:
+        leases (Leases): the shared leases
+        lease (tuple): the name of the lease, e.g. ('convert', var, year)
+        func (callable): the task function, called with args and kwargs
+        skip_if (tuple): (state, chunks, status), the task is skipped if all the (product, year)
+                         chunks have already reached the status, e.g. when completed by another worker
+
+    Returns:
+        the value returned by func, or SKIPPED
+    """
+    with leases.hold(lease):
+        if skip_if is not None:
+            state, chunks, status = skip_if
+            if all(reached(state.status(product, year), status) for product, year in chunks):
+                print(f'{" ".join(str(x) for x in lease)} already done by another worker, skipping it')
+                return SKIPPED
+        return func(*args, **kwargs)
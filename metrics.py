@@ -0,0 +1,135 @@
+"""Structured events of the retrieval and the postprocessing, with a per-stage summary"""
+
+import os
+import json
+import time
+from contextlib import contextmanager
+
+# environment variable with the events file, inherited by the worker processes
+METRICS_ENV = 'CDS_RETRIEVER_METRICS'
+
+# default name of the events file in the storedir
+METRICS_NAME = '.cds_retriever_metrics.jsonl'
+
+
+def enable(path):
+    """Write the events of this process and of its workers into path (JSON lines)"""
+    os.environ[METRICS_ENV] = str(path)
+
+
+def event(name, **fields):
+    """
+    Record an event as a JSON line, if the events file is enabled.
+    Lines are appended with a single write, so that several processes can share the file.
+    """
+    path = os.environ.get(METRICS_ENV)
+    if not path:
+        return
+    record = {'time': round(time.time(), 3), 'pid': os.getpid(), 'event': name}
+    record.update({key: (str(value) if not isinstance(value, (int, float, bool, type(None))) else value)
+                   for key, value in fields.items()})
+    line = (json.dumps(record) + '\n').encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def span(stage, **fields):
+    """
+    Measure a stage and record it as an event with its duration and status.
+    The yielded dict can be filled with more fields (e.g. nbytes, request_id, retries).
+    """
+    fields = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as e:
+        event(stage, duration=round(time.perf_counter() - start, 3), status='error', error=repr(e), **fields)
+        raise
+    event(stage, duration=round(time.perf_counter() - start, 3), status='ok', **fields)
+
+
+def read_events(path, since=None):
+    """Read the events of a file, optionally only those after the since timestamp"""
+    events = []
+    if not os.path.exists(path):
+        return events
+    with open(path, 'r', encoding='utf8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if since is None or record['time'] >= since:
+                events.append(record)
+    return events
+
+
+def summarize(events):
+    """
+    Aggregate the events by stage.
+
+    Returns:
+        dict: stage -> count, errors, seconds (total), max_seconds, bytes and retries
+    """
+    summary = {}
+    for record in events:
+        stats = summary.setdefault(record['event'], {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                     'bytes': 0, 'retries': 0})
+        stats['count'] += 1
+        stats['errors'] += record.get('status') == 'error'
+        duration = record.get('duration') or 0
+        stats['seconds'] += duration
+        stats['max_seconds'] = max(stats['max_seconds'], duration)
+        stats['bytes'] += record.get('nbytes') or 0
+        stats['retries'] += record.get('retries') or 0
+    return summary
+
+
+def print_summary(summary, wall=None):
+    """Print the time spent in each stage, summed over all the processes"""
+    print('\nTime spent in each stage (summed over the parallel processes):')
+    print(f"\t{'stage':14} {'count':>6} {'errors':>6} {'seconds':>10} {'max':>8} {'MB':>10} {'MB/s':>8}")
+    for stage, stats in sorted(summary.items(), key=lambda item: -item[1]['seconds']):
+        speed = stats['bytes'] / 1024**2 / stats['seconds'] if stats['bytes'] and stats['seconds'] else 0
+        print(f"\t{stage:14} {stats['count']:6d} {stats['errors']:6d} {stats['seconds']:10.1f} "
+              f"{stats['max_seconds']:8.1f} {stats['bytes'] / 1024**2:10.1f} {speed:8.1f}")
+    if wall is not None:
+        print(f'\tWall time: {wall:.1f}s')
+
+
+def write_prometheus(summary, path, wall=None):
+    """Write the summary in the Prometheus textfile collector format"""
+    lines = []
+    metrics = [
+        ('seconds', 'cds_retriever_stage_seconds', 'Time spent in the stage during the last run'),
+        ('count', 'cds_retriever_stage_runs', 'Runs of the stage'),
+        ('errors', 'cds_retriever_stage_errors', 'Failed runs of the stage'),
+        ('bytes', 'cds_retriever_stage_bytes', 'Bytes processed by the stage'),
+        ('retries', 'cds_retriever_stage_retries', 'Retries of the stage'),
+    ]
+    for key, name, description in metrics:
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} gauge']
+        lines += [f'{name}{{stage="{stage}"}} {stats[key]}' for stage, stats in sorted(summary.items())]
+    if wall is not None:
+        lines += ['# HELP cds_retriever_wall_seconds Wall time of the last run',
+                  '# TYPE cds_retriever_wall_seconds gauge', f'cds_retriever_wall_seconds {wall:.3f}']
+    tmp = str(path) + '.tmp'
+    with open(tmp, 'w', encoding='utf8') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(tmp, path)
+
+
+def report(path, since, prom=None):
+    """Print the summary of the events of a run and optionally write it as a Prometheus textfile"""
+    wall = time.time() - since
+    summary = summarize(read_events(path, since))
+    if not summary:
+        return
+    print_summary(summary, wall)
+    if prom:
+        write_prometheus(summary, prom, wall)
+        print(f'Metrics written to {prom}')
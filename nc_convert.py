@@ -0,0 +1,191 @@
+"""In-process conversion of GRIB files to NetCDF4 with eccodes and netCDF4"""
+
+import os
+import datetime
+from pathlib import Path
+
+from grib_scan import scan_grib
+
+# default options of the native conversion
+NC_OPTIONS = {
+    'complevel': 1,             # zlib compression level, 0 for no compression
+    'shuffle': True,            # byte shuffle filter before compression
+    'chunks': 'map',            # 'map' for map-contiguous chunks, 'time' for time-contiguous chunks
+    'time_chunk': 168,          # length of the time chunks with 'time' chunks
+    'tile': 64,                 # size of the spatial tiles with 'time' chunks
+    'significant_digits': None, # lossy quantization, None to keep all the digits
+}
+
+TIME_UNITS = 'hours since 1900-01-01 00:00:00'
+
+
+class UnsupportedGrid(Exception):
+    """Raised for the grids which the native conversion does not handle, to be converted with CDO instead"""
+
+
+def _import_backend():
+    """Import the optional dependencies of the native conversion"""
+    try:
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        import eccodes
+        import netCDF4
+    except ImportError as e:
+        raise ImportError(f'The native conversion requires numpy, eccodes and netCDF4: {e}') from e
+    return np, eccodes, netCDF4
+
+
+def _chunk_shape(options, ntime, nlat, nlon, has_level):
+    """Define the chunk shape of a variable"""
+    if options['chunks'] == 'map':
+        shape = (1, nlat, nlon)
+    elif options['chunks'] == 'time':
+        shape = (min(options['time_chunk'], ntime), min(options['tile'], nlat), min(options['tile'], nlon))
+    else:
+        raise ValueError(f"Unknown chunks {options['chunks']}, use 'map' or 'time'")
+    if has_level:
+        shape = shape[0:1] + (1,) + shape[1:]
+    return shape
+
+
+def grib_to_netcdf(infile, outfile, options=None):
+    """
+    Convert a GRIB file with regular lat-lon fields to a compressed NetCDF4 file.
+
+    Fields are read one (parameter, level) at a time using the offsets of the
+    header scanner, so that only one time chunk of a single level is in memory
+    and each NetCDF chunk is written only once.
+
+    The variables are named after the eccodes shortName (e.g. 2t for the 2m temperature),
+    which is not always the name given by cdo -t ecmwf: the files of a product should
+    all be converted with the same backend, since the multi-year files are merged by name.
+
+    Parameters:
+        infile (str or Path): the GRIB file
+        outfile (str or Path): the NetCDF4 file
+        options (dict): overrides of NC_OPTIONS
+
+    Raises:
+        UnsupportedGrid: if the grid is not regular lat-lon
+    """
+
+    np, eccodes, netCDF4 = _import_backend()
+    options = {**NC_OPTIONS, **(options or {})}
+
+    # group the messages by parameter and level
+    groups, times, levels = {}, set(), set()
+    for field in scan_grib(infile):
+        groups.setdefault((field['param'], field['level']), {})[field['validity']] = (field['offset'], field['length'])
+        times.add(field['validity'])
+        levels.add(field['level'])
+    times = sorted(times)
+    time_index = {date: i for i, date in enumerate(times)}
+    params = sorted({param for param, _ in groups}, key=str)
+
+    with open(infile, 'rb') as grib:
+
+        def read(offset, length):
+            grib.seek(offset)
+            return eccodes.codes_new_from_message(grib.read(length))
+
+        # grid and level type from the first message
+        offset, length = next(iter(groups[next(iter(groups))].values()))
+        handle = read(offset, length)
+        try:
+            grid_type = eccodes.codes_get(handle, 'gridType')
+            if grid_type != 'regular_ll':
+                raise UnsupportedGrid(f'Grid {grid_type} is not supported by the native conversion')
+            nlat, nlon = eccodes.codes_get(handle, 'Nj'), eccodes.codes_get(handle, 'Ni')
+            lats = eccodes.codes_get_array(handle, 'distinctLatitudes')
+            lons = eccodes.codes_get_array(handle, 'distinctLongitudes')
+            isobaric = eccodes.codes_get(handle, 'typeOfLevel') == 'isobaricInhPa'
+            north_to_south = not eccodes.codes_get(handle, 'jScansPositively')
+        finally:
+            eccodes.codes_release(handle)
+        # keep the order of the GRIB fields
+        lats = np.sort(lats)
+        if north_to_south:
+            lats = lats[::-1]
+
+        tmpfile = Path(str(outfile) + '.part')
+        with netCDF4.Dataset(tmpfile, 'w', format='NETCDF4') as nc:
+            nc.Conventions = 'CF-1.6'
+            nc.history = f'{datetime.datetime.now():%c}: converted from {Path(infile).name} by CDS-retriever'
+
+            nc.createDimension('time', None)
+            nc.createDimension('lat', nlat)
+            nc.createDimension('lon', nlon)
+            time = nc.createVariable('time', 'f8', ('time',))
+            time.standard_name = 'time'
+            time.units = TIME_UNITS
+            time.calendar = 'proleptic_gregorian'
+            time.axis = 'T'
+            time[:] = netCDF4.date2num(times, TIME_UNITS, 'proleptic_gregorian')
+            lat = nc.createVariable('lat', 'f8', ('lat',))
+            lat.standard_name, lat.units, lat.axis = 'latitude', 'degrees_north', 'Y'
+            lat[:] = lats
+            lon = nc.createVariable('lon', 'f8', ('lon',))
+            lon.standard_name, lon.units, lon.axis = 'longitude', 'degrees_east', 'X'
+            lon[:] = lons
+
+            dims = ('time', 'lat', 'lon')
+            level_index = {}
+            if isobaric:
+                plevs = sorted(levels, reverse=True)
+                level_index = {level: i for i, level in enumerate(plevs)}
+                nc.createDimension('plev', len(plevs))
+                plev = nc.createVariable('plev', 'f8', ('plev',))
+                plev.standard_name, plev.units, plev.axis, plev.positive = 'air_pressure', 'Pa', 'Z', 'down'
+                plev[:] = np.array(plevs, dtype='f8') * 100
+                dims = ('time', 'plev', 'lat', 'lon')
+
+            chunks = _chunk_shape(options, len(times), nlat, nlon, isobaric)
+            tchunk = chunks[0]
+            encoding = {'chunksizes': chunks, 'shuffle': options['shuffle'], 'fill_value': np.float32(-9e33)}
+            if options['complevel']:
+                encoding.update(zlib=True, complevel=options['complevel'])
+            if options['significant_digits'] is not None:
+                # quantization is available from netCDF4 1.6
+                encoding['significant_digits'] = options['significant_digits']
+
+            for param in params:
+                variable = None
+                for level in sorted(level for p, level in groups if p == param):
+                    messages = groups[(param, level)]
+                    dates = sorted(messages)
+                    for start in range(0, len(dates), tchunk):
+                        block = dates[start:start + tchunk]
+                        data = np.full((len(block), nlat, nlon), np.nan, dtype='f4')
+                        for i, date in enumerate(block):
+                            handle = read(*messages[date])
+                            try:
+                                if variable is None:
+                                    variable = nc.createVariable(
+                                        eccodes.codes_get(handle, 'shortName'), 'f4', dims, **encoding)
+                                    variable.long_name = eccodes.codes_get(handle, 'name')
+                                    variable.units = eccodes.codes_get(handle, 'units')
+                                    variable.code = eccodes.codes_get(handle, 'paramId')
+                                values = eccodes.codes_get_values(handle)
+                                if eccodes.codes_get(handle, 'bitmapPresent'):
+                                    values[values == eccodes.codes_get(handle, 'missingValue')] = np.nan
+                                data[i] = values.reshape(nlat, nlon)
+                            finally:
+                                eccodes.codes_release(handle)
+
+                        # write consecutive times of the block at once
+                        index = [time_index[date] for date in block]
+                        first, last = index[0], index[-1] + 1
+                        data = np.ma.masked_invalid(data)
+                        if last - first == len(index):
+                            if isobaric:
+                                variable[first:last, level_index[level]] = data
+                            else:
+                                variable[first:last] = data
+                        else:
+                            for i, t in enumerate(index):
+                                if isobaric:
+                                    variable[t, level_index[level]] = data[i]
+                                else:
+                                    variable[t] = data[i]
+
+    os.replace(tmpfile, outfile)
@@ -0,0 +1,177 @@
+"""Near-real-time updates: the missing days and months of the recent years, and the ERA5T months made final"""
+
+import os
+import datetime
+import calendar
+from pathlib import Path
+
+from CDS_retriever import build_request, create_filename, define_level, define_time, expected_times, \
+    split_even, cds_client, year_complete, MAX_FIELDS
+from downloader import download_result, request_id
+from grib_scan import scan_grib, time_key, splice_grib, month_expvers, GribError
+from state import product_key, month_expver, PRELIMINARY
+from metrics import span
+
+# default options of the near-real-time updates
+NRT_OPTIONS = {
+    'lag_days': 5,       # days between a date and the availability of its preliminary ERA5T data
+    'final_months': 3,   # months after the end of a month when its ERA5T data are replaced by the final ERA5
+}
+
+
+def final_date(year, month, final_months):
+    """The first day when the final ERA5 data of a month are available"""
+    index = int(year) * 12 + int(month) + final_months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def is_preliminary(year, month, final_months, today=None):
+    """Check if the data of a month are still the preliminary ERA5T ones (expver 5)"""
+    return (today or datetime.date.today()) < final_date(year, month, final_months)
+
+
+def available_until(lag_days, today=None):
+    """The last day with data in the CDS"""
+    return (today or datetime.date.today()) - datetime.timedelta(days=lag_days)
+
+
+def period_end(key):
+    """The last day of an expected time, as produced by time_key()"""
+    if len(key) == 2:
+        return datetime.date(key[0], key[1], calendar.monthrange(key[0], key[1])[1])
+    return datetime.date(key[0], key[1], key[2])
+
+
+def update_years(state, product, options, today=None):
+    """
+    The years which may need an update: the current and the previous one, whose files are scanned
+    for the months of preliminary data, and the older ones with preliminary months recorded.
+    """
+    until = available_until(options['lag_days'], today)
+    first = until.year - 1
+    preliminary = state.preliminary_years(product) if state is not None else []
+    return sorted(set(range(first, until.year + 1)) | set(preliminary))
+
+
+def present_times(gribfile, granularity, nfields, remove=True):
+    """
+    The times of a GRIB file with all their fields, and the experiment versions of its months.
+    With remove a corrupted file is removed, so that it is retrieved again from scratch.
+
+    Returns:
+        tuple: (set of the complete times, (year, month) -> set of the expvers of its fields)
+    """
+    counts, expvers = {}, {}
+    try:
+        for field in scan_grib(gribfile):
+            key = time_key(field['reftime'] if granularity == 'month' else field['validity'], granularity)
+            counts[key] = counts.get(key, 0) + 1
+            if field['expver'] is not None:
+                expvers.setdefault(time_key(field['reftime'], 'month'), set()).add(field['expver'])
+    except FileNotFoundError:
+        return set(), {}
+    except (GribError, OSError) as e:
+        print(f'{gribfile} is corrupted ({e}), retrieving it again')
+        if remove:
+            os.remove(gribfile)
+        return set(), {}
+    return {key for key, count in counts.items() if count >= nfields}, expvers
+
+
+def plan_update(dataset, var, freq, year, grid, levelout, area, outdir, state=None, options=None,
+                max_fields=MAX_FIELDS, today=None, remove=True):
+    """
+    List the CDS requests updating a year: the months missing from the yearly GRIB file or whose
+    ERA5T data have been made final are retrieved whole, in as few requests as max_fields allows,
+    and only the missing days of the other months are retrieved, up to the last day available.
+    The ERA5T months are those whose fields have expver 5, or recorded as such in the state
+    if the file has no expver.
+    Without remove the corrupted yearly files are kept, e.g. to only plan the updates.
+
+    Returns:
+        list: (kind, retrieve_dict, outfile, months) tuples, empty if the year is up to date
+    """
+
+    options = {**NRT_OPTIONS, **(options or {})}
+    until = available_until(options['lag_days'], today)
+    basicname = create_filename(dataset, var, freq, grid, levelout, area, str(year))
+    level, _ = define_level(levelout)
+    nfields = 1 if level == 'sfc' else len(level)
+
+    expected, granularity = expected_times(freq, year)
+    expected = {key for key in expected if period_end(key) <= until}
+    present, found = present_times(Path(outdir, basicname + '.grib'), granularity, nfields, remove)
+    recorded = state.expvers(product_key(dataset, var, freq, grid, levelout, area), year) if state is not None else {}
+
+    whole, partial = [], {}
+    for month in sorted({key[1] for key in expected}):
+        keys = {key for key in expected if key[1] == month}
+        missing = keys - present
+        expver = month_expver(found.get((int(year), month))) or recorded.get(month)
+        made_final = expver == PRELIMINARY and not is_preliminary(year, month, options['final_months'], today)
+        # the month still in progress is requested by days, the later ones are not available yet
+        if made_final or (missing == keys and period_end((int(year), month)) <= until):
+            whole.append(month)
+        elif missing:
+            partial[month] = sorted({key[2] for key in missing})
+
+    _, _, time, _, _ = define_time(freq)
+    requests = []
+    if whole:
+        for months in split_even(whole, max(1, max_fields // (31 * len(time) * nfields))):
+            kind, retrieve_dict = build_request(dataset, var, freq, str(year), grid, levelout, area,
+                                                [str(month).zfill(2) for month in months])
+            requests.append((kind, retrieve_dict, Path(outdir, f'{basicname}_nrt{months[0]:02d}.grib'), months))
+    for month, days in partial.items():
+        kind, retrieve_dict = build_request(dataset, var, freq, str(year), grid, levelout, area, str(month).zfill(2),
+                                            day=[str(day).zfill(2) for day in days])
+        requests.append((kind, retrieve_dict, Path(outdir, f'{basicname}_nrt{month:02d}d.grib'), [month]))
+    return requests
+
+
+def nrt_retrieve(dataset, var, freq, year, grid, levelout, area, outdir, streams=1, state=None,
+                 max_fields=MAX_FIELDS, scratch=None, options=None):
+    """
+    Update a year with the days and months it misses and with the ERA5T months made final,
+    splicing them into the yearly GRIB file, which is then converted again.
+    The requests are not served by the request cache, since the same request gets
+    preliminary data first and final data later.
+
+    Returns:
+        int: the number of CDS requests
+    """
+
+    options = {**NRT_OPTIONS, **(options or {})}
+    requests = plan_update(dataset, var, freq, year, grid, levelout, area, outdir, state, options, max_fields)
+    if not requests:
+        print(f'{var} {year} is up to date')
+        return 0
+
+    product = product_key(dataset, var, freq, grid, levelout, area)
+    yearfile = Path(outdir, create_filename(dataset, var, freq, grid, levelout, area, str(year)) + '.grib')
+    until = available_until(options['lag_days'])
+    with span('nrt_update', var=var, year=year, requests=len(requests)):
+        for kind, retrieve_dict, outfile, _ in requests:
+            with span('cds_request', var=var, year=year, file=outfile.name) as info:
+                result = cds_client().retrieve(kind, retrieve_dict)
+                info['request_id'] = request_id(result)
+            download_result(result, outfile, streams=streams, scratch=scratch)
+        pieces = [outfile for _, _, outfile, _ in requests]
+        splice_grib(yearfile, pieces, yearfile)
+        for piece in pieces:
+            os.remove(piece)
+
+    if state is None:
+        return len(requests)
+    # the experiment version of the months updated, as found in the data
+    expvers = month_expvers(yearfile)
+    for _, _, _, months in requests:
+        for month in months:
+            status = 'verified' if period_end((int(year), month)) <= until else 'downloaded'
+            state.mark(product, year, status, month=month, expver=month_expver(expvers.get((int(year), month))),
+                       path=str(yearfile))
+    # the year is verified only once it is complete, until then it is updated and converted again
+    status = 'verified' if year_complete(dataset, var, freq, str(year), grid, levelout, area, outdir) \
+        else 'downloaded'
+    state.mark(product, year, status, path=str(yearfile), nbytes=yearfile.stat().st_size)
+    return len(requests)
@@ -0,0 +1,126 @@
+"""Planning of the CDS requests"""
+
+import time
+from pathlib import Path
+
+from CDS_retriever import PARAM_IDS, GRIB2_DATASETS, MAX_FIELDS, estimate_fields, plan_requests, request_fields, \
+    group_name, create_filename
+from state import product_key, reached
+
+# number of grid points of the native grids delivered by the CDS
+FULL_POINTS = {
+    'ERA5': 542080,  # reduced gaussian N320
+    'ERA5-Land': 3600 * 1801,  # regular 0.1x0.1
+}
+
+# approximate size of the GRIB sections besides the data
+GRIB_HEADER = 200
+
+
+def group_variables(varlist, freq, levelout, request='yearly', max_fields=MAX_FIELDS, dataset='ERA5'):
+    """
+    Merge compatible variables into groups which are retrieved with a single CDS request.
+
+    Only variables with a known GRIB1 parameter ID can be split locally, so the other ones
+    and those of the datasets delivered in GRIB2 are always retrieved alone.
+    Groups are filled up to max_fields.
+
+    Returns:
+        list: the groups, each one a list of variables
+    """
+
+    per_var = estimate_fields(freq, levelout, 1, request)
+    groups, current = [], []
+    for var in varlist:
+        if var not in PARAM_IDS or dataset in GRIB2_DATASETS:
+            groups.append([var])
+            continue
+        if current and (len(current) + 1) * per_var > max_fields:
+            groups.append(current)
+            current = []
+        current.append(var)
+    if current:
+        groups.append(current)
+    return groups
+
+
+def field_bytes(dataset, grid, area):
+    """Estimate the size of a GRIB field, packed with 16 bits per value as the CDS does"""
+    if grid == 'full':
+        points = FULL_POINTS.get(dataset, FULL_POINTS['ERA5'])
+        if area != 'global':
+            north, west, south, east = [float(x) for x in area]
+            points = points * (north - south) / 180 * (east - west) / 360
+    else:
+        step = float(grid.split('x')[0])
+        if area == 'global':
+            north, west, south, east = 90, 0, -90, 360 - step
+        else:
+            north, west, south, east = [float(x) for x in area]
+        points = (round((north - south) / step) + 1) * (round((east - west) / step) + 1)
+    return int(points * 2 + GRIB_HEADER)
+
+
+def print_plan(chunks, max_fields=MAX_FIELDS, state=None, destdir=None, done=None):
+    """
+    Print every CDS request of the retrieval with its estimated number of fields and size.
+    Nothing is downloaded and neither CDO nor the network are used.
+
+    Parameters:
+        chunks (list of tuple): the arguments of year_retrieve (or group_retrieve) for each year
+        max_fields (int): maximum number of fields of a single CDS request
+        state (StateDB): used to report the yearly files already verified
+        destdir (str or Path): folder of the NetCDF files, to list the output files
+        done (dict): variable -> years already converted, which are not retrieved again
+    """
+
+    start = time.perf_counter()
+    for var, years in sorted((done or {}).items()):
+        if years:
+            print(f'{var}: {len(years)} years already converted ({years[0]}-{years[-1]}), skipping them')
+
+    total, nrequests, nbytes = 0, 0, 0
+    print(f"{'dataset':<40} {'variables':<40} {'year':<5} {'months':<8} {'days':<8} {'levels':<8} {'fields':>8} "
+          f"{'MB':>9}  file")
+    for dataset, var, freq, year, grid, levelout, area, outdir, request in chunks:
+        members = var if isinstance(var, list) else [var]
+
+        # yearly files already verified are not retrieved again
+        verified = []
+        for member in members:
+            member_dir = Path(outdir, member) if isinstance(var, list) else outdir
+            yearfile = Path(member_dir, create_filename(dataset, member, freq, grid, levelout, area, year) + '.grib')
+            if state is not None and yearfile.exists() and \
+                    reached(state.status(product_key(dataset, member, freq, grid, levelout, area), year), 'verified'):
+                verified.append(member)
+                print(f"{'':<40} {member:<40} {year:<5} {'':<8} {'':<8} {'':<8} {'':>8} {'':>9}  "
+                      f'{yearfile} complete')
+        if len(verified) == len(members):
+            continue
+
+        size = field_bytes(dataset, grid, area)
+        for kind, retrieve_dict, outfile in plan_requests(dataset, var, freq, year, grid, levelout, area,
+                                                          outdir, request, max_fields):
+            nfields = request_fields(retrieve_dict)
+            nmonths, ndays = len(retrieve_dict['month']), len(retrieve_dict['day'])
+            if isinstance(retrieve_dict['month'], str):
+                nmonths = 1
+            nlevels = len(retrieve_dict.get('pressure_level', ['sfc']))
+            flag = ' OVER LIMIT' if nfields > max_fields else ''
+            if outfile.exists():
+                flag += ' exists'
+            print(f'{kind:<40} {group_name(var):<40} {year:<5} {nmonths:<8} {ndays:<8} {nlevels:<8} '
+                  f'{nfields:>8} {nfields * size / 1024**2:9.1f}  {outfile}{flag}')
+            total += nfields
+            nbytes += nfields * size
+            nrequests += 1
+
+        if destdir is not None:
+            for member in members:
+                ncfile = Path(destdir, create_filename(dataset, member, freq, grid, levelout, area, year) + '.nc')
+                print(f"{'':<40} {member:<40} {year:<5} {'':<8} {'':<8} {'':<8} {'':>8} {'':>9}  "
+                      f"{ncfile}{' exists' if ncfile.exists() else ''}")
+
+    print(f'\n{nrequests} requests, {total} fields in total, at most {max_fields} fields per request')
+    print(f'Estimated download size: {nbytes / 1024**3:.2f} GB')
+    print(f'Plan computed in {(time.perf_counter() - start) * 1000:.0f} ms')
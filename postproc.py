@@ -0,0 +1,324 @@
+"""Postprocessing of the yearly files: monthly merge, daily aggregation and Zarr output"""
+
+import os
+import glob
+from pathlib import Path
+
+from CDS_retriever import create_filename, get_cdo, cdo_exception
+from state import product_key
+from metrics import span
+from zarr_store import append_years, zarr_path
+
+
+def _import_netcdf():
+    """Import the optional dependency of the splicing of the updated years"""
+    try:
+        import netCDF4  # pylint: disable=import-outside-toplevel
+    except ImportError as e:
+        raise ImportError(f'Splicing the updated years requires netCDF4: {e}') from e
+    return netCDF4
+
+
+def _ntime(netCDF4, filename):
+    with netCDF4.Dataset(filename) as nc:
+        return len(nc['time'])
+
+
+def splice_years(bigfile, yearfiles):
+    """
+    Overwrite in place the records of a multi-year file from the first time of the yearly files on,
+    extending its unlimited time dimension, so that the last years updated (e.g. by the near-real-time
+    updates) are replaced without rewriting the years before them.
+
+    Parameters:
+        bigfile (str): the multi-year file
+        yearfiles (list): consecutive yearly files, sorted by time, reaching at least the end of bigfile
+    """
+    netCDF4 = _import_netcdf()
+    with netCDF4.Dataset(bigfile, 'a') as big:
+        btime = big['time']
+        for yearfile in yearfiles:
+            with netCDF4.Dataset(yearfile) as year:
+                ytime = year['time']
+                dates = netCDF4.num2date(ytime[:], ytime.units, getattr(ytime, 'calendar', 'standard'))
+                values = netCDF4.date2num(dates, btime.units, getattr(btime, 'calendar', 'standard'))
+                start = int((btime[:] < values[0]).sum())
+                if yearfile == yearfiles[0] and start + sum(_ntime(netCDF4, f) for f in yearfiles) < len(btime):
+                    raise ValueError(f'{bigfile} has records after {yearfiles[-1]}, it cannot be spliced')
+                for name, var in year.variables.items():
+                    if name in big.variables and var.dimensions and var.dimensions[0] == 'time':
+                        big[name][start:start + len(values)] = values if name == 'time' else var[:]
+
+
+def file_years(filename):
+    """The years of a multi-year file, from its YYYY-YYYY name"""
+    first, last = Path(filename).stem.split('_')[-1].split('-')
+    return list(range(int(first), int(last) + 1))
+
+
+def consecutive(years, end):
+    """Check if a sorted list of years has no gaps and reaches the end year"""
+    return bool(years) and years == list(range(years[0], years[-1] + 1)) and years[-1] >= end
+
+
+def align_monthly(infile, tmpdir):
+    """
+    Set a common time axis for monthly data (roll back cumulated by 6hours), useful for catalog xarray loading.
+    Only files whose first time step is not at 00:00 are shifted, so the function can be applied twice.
+
+    Returns:
+        str: the aligned file, either infile itself or a new file in tmpdir
+    """
+    cdo = get_cdo(debug=True)
+    first_time = cdo.showtime(input=f'-seltimestep,1 {infile}')[0]
+    if first_time == '00:00:00':
+        return str(infile)
+    aligned = str(Path(tmpdir, 'align_' + Path(infile).name))
+    cdo.shifttime('-6hours', input=str(infile), output=aligned, options='-f nc4 -z zip')
+    return aligned
+
+
+def merge_monthly(dataset, var, freq, grid, levelout, area, destdir, tmpdir, update, do_align, state):
+    """
+    Merge the yearly monthly-means files into a single multi-year file.
+
+    In update mode the new years are appended along the unlimited time dimension of
+    the existing multi-year file, which is then renamed to its new year range, so that
+    the years already merged are neither copied nor aligned again. If years before its
+    end have changed, the file is rebuilt without them and merged in time order with the
+    yearly files, and named after the real span of the result.
+    """
+
+    print('Extra processing for monthly...')
+    cdo = get_cdo(debug=True)
+
+    # the yearly files still to be merged and the years already in the big file
+    product = product_key(dataset, var, freq, grid, levelout, area)
+    statuses = state.statuses(product)
+    yearly = sorted(year for year, status in statuses.items() if status == 'converted')
+    merged = sorted(year for year, status in statuses.items() if status == 'merged')
+    if not yearly:
+        print(f'No new years of {var} to be merged')
+        return
+
+    def filename(years):
+        return str(Path(destdir, create_filename(dataset, var, freq, grid, levelout, area, years) + '.nc'))
+
+    yearfiles = [filename(str(year)) for year in yearly]
+
+    bigfile = None
+    if update:
+        # check if big file exists
+        if merged and os.path.exists(filename(f'{merged[0]}-{merged[-1]}')):
+            bigfile = filename(f'{merged[0]}-{merged[-1]}')
+        else:
+            filebase = glob.glob(filename('????-????'))
+            bigfile = sorted(filebase)[-1] if filebase else None
+
+    # the years of the big file which are not replaced by a yearly file, and the real span of the result
+    big_years = file_years(bigfile) if bigfile else []
+    kept = [year for year in big_years if year not in yearly]
+    first_year, last_year = str(min(kept + yearly)), str(max(kept + yearly))
+
+    if do_align:
+        print('Aligningment required...')
+        inputs = [align_monthly(f, tmpdir) for f in yearfiles]
+    else:
+        inputs = list(yearfiles)
+
+    mergefile = filename(first_year + '-' + last_year)
+    print(mergefile)
+    temporary = []
+    with span('merge', var=var, years=len(yearly), nbytes=sum(os.path.getsize(f) for f in inputs)):
+        if bigfile and yearly[0] > big_years[-1]:
+            # cdo cat appends the new records to the output file when it already exists
+            print(f'Appending {len(yearly)} years to {bigfile}...')
+            cdo.cat(input=inputs, output=bigfile, options='-f nc4 -z zip')
+            if bigfile != mergefile:
+                os.replace(bigfile, mergefile)
+        elif bigfile and yearly[0] >= big_years[0] and consecutive(yearly, big_years[-1]):
+            # the last years merged have been updated, e.g. by the near-real-time updates
+            print(f'Splicing {len(yearly)} years into {bigfile}...')
+            splice_years(bigfile, inputs)
+            if bigfile != mergefile:
+                os.replace(bigfile, mergefile)
+        else:
+            if kept:
+                # only the years of the big file which are not replaced, sorted with the yearly files by mergetime
+                big = align_monthly(bigfile, tmpdir) if do_align else bigfile
+                if big != bigfile:
+                    temporary.append(big)
+                replaced = [str(year) for year in yearly if year in big_years]
+                inputs.insert(0, f"-delete,year={','.join(replaced)} {big}" if replaced else big)
+            print(f'Merging together into {mergefile}...')
+            cdo.mergetime(input=inputs, output=mergefile + '.part', options='-f nc4 -z zip')
+            os.replace(mergefile + '.part', mergefile)
+            if bigfile and bigfile != mergefile:
+                os.remove(bigfile)
+
+    for f in yearfiles + inputs + temporary:
+        if f != mergefile and os.path.exists(f):
+            os.remove(f)
+
+    for year in range(int(first_year), int(last_year) + 1):
+        state.mark(product, year, 'merged', path=mergefile)
+
+
+def daily_means(dataset, var, freq, grid, levelout, area, destdir, storedir, state):
+    """
+    Compute the daily means of the years which have not been averaged yet, or whose
+    yearly file changed, and cache them in the yearly subfolder of the daily folder.
+
+    Returns:
+        tuple: the cache folder, the converted years and the years just averaged
+    """
+
+    cdo = get_cdo(debug=True)
+    cachedir = Path(storedir, var, 'day', 'yearly')
+    Path(cachedir).mkdir(parents=True, exist_ok=True)
+
+    years = state.years(product_key(dataset, var, freq, grid, levelout, area), 'converted')
+    daily = product_key(dataset, var, 'day', grid, levelout, area)
+    cached = set(state.years(daily, 'converted'))
+    computed = []
+    for year in years:
+        yearfile = Path(cachedir, create_filename(dataset, var, 'day', grid, levelout, area, str(year)) + '.nc')
+        infile = Path(destdir, create_filename(dataset, var, freq, grid, levelout, area, str(year)) + '.nc')
+        # the yearly files already appended to a Zarr store have been removed
+        if year in cached and yearfile.exists() and \
+                (not infile.exists() or yearfile.stat().st_mtime >= infile.stat().st_mtime):
+            continue
+        print(f'Computing daily means of {var} for {year}...')
+        computed.append(year)
+        with span('daymean', var=var, year=year, nbytes=infile.stat().st_size):
+            cdo.daymean(input=str(infile), output=str(yearfile) + '.part', options='-f nc4 -z zip')
+            os.replace(str(yearfile) + '.part', yearfile)
+        state.mark(daily, year, 'converted', path=str(yearfile))
+    return cachedir, years, computed
+
+
+def aggregate_daily(dataset, var, freq, grid, levelout, area, destdir, storedir, state):
+    """
+    Compute the multi-year daily means from the yearly files.
+
+    The daily means of each year are computed only once and cached in the yearly
+    subfolder of the daily folder, then only the new years are appended to the
+    multi-year file, which is renamed to its new year range.
+    """
+
+    print('Extra processing for daily and 6hrs...')
+    cdo = get_cdo(debug=True)
+    daydir, mondir = [Path(storedir, var, x) for x in ['day', 'mon']]
+    Path(mondir).mkdir(parents=True, exist_ok=True)
+    cachedir, years, computed = daily_means(dataset, var, freq, grid, levelout, area, destdir, storedir, state)
+    daily = product_key(dataset, var, 'day', grid, levelout, area)
+    if not years:
+        print(f'No years of {var} to be averaged')
+        return
+
+    def yearfiles(years):
+        return [str(Path(cachedir, create_filename(dataset, var, 'day', grid, levelout, area, str(year)) + '.nc'))
+                for year in years]
+
+    # the multi-year file built so far, if any
+    merged = state.years(daily, 'merged')
+    oldfile = None
+    if merged:
+        oldfile = str(Path(daydir, create_filename(dataset, var, 'day', grid, levelout, area,
+                                                   f'{merged[0]}-{merged[-1]}') + '.nc'))
+    new = [year for year in years if year not in merged or year in computed]
+    allyears = sorted(set(years + merged))
+    first_year, last_year = str(min(years + merged)), str(max(years + merged))
+    dayfile = str(Path(daydir, create_filename(dataset, var, 'day', grid,
+                  levelout, area, first_year + '-' + last_year) + '.nc'))
+    # monfile = str(Path(mondir, create_filename(var, 'mon', grid, levelout, area, first_year + '-' + last_year) + '.nc'))
+
+    appended = False
+    if not new and oldfile and os.path.exists(oldfile):
+        print(f'{dayfile} is up to date')
+        return
+    with span('daily_merge', var=var, years=len(new)):
+        if new and oldfile and os.path.exists(oldfile) and min(new) > merged[-1]:
+            # cdo cat appends to the output file when it already exists
+            print(f'Appending {len(new)} years to {oldfile}...')
+            try:
+                cdo.cat(input=yearfiles(new), output=oldfile, options='-f nc4 -z zip')
+                appended = True
+            except cdo_exception() as e:
+                print(f'Cannot append to {oldfile}, rebuilding it: {e}')
+        elif new and oldfile and os.path.exists(oldfile) and consecutive(sorted(new), merged[-1]):
+            # the last years merged have been updated, e.g. by the near-real-time updates
+            print(f'Splicing {len(new)} years into {oldfile}...')
+            try:
+                splice_years(oldfile, yearfiles(sorted(new)))
+                appended = True
+            except (ImportError, ValueError) as e:
+                print(f'Cannot splice into {oldfile}, rebuilding it: {e}')
+        if appended:
+            os.replace(oldfile, dayfile)
+        else:
+            # first run, or years changed before the end of the file: rebuild from the cached daily means
+            print(f'Building {dayfile} from the daily means of {len(allyears)} years...')
+            cdo.cat(input=yearfiles(allyears), output=dayfile + '.part', options='-f nc4 -z zip')
+            os.replace(dayfile + '.part', dayfile)
+            if oldfile and oldfile != dayfile and os.path.exists(oldfile):
+                os.remove(oldfile)
+
+    for year in allyears:
+        state.mark(daily, year, 'merged', path=dayfile)
+    # cdo.monmean(input = dayfile, output = monfile, options = '-f nc4 -z zip')
+
+
+def aggregate_zarr(dataset, var, freq, grid, levelout, area, destdir, tmpdir, storedir, do_align, state,
+                   options=None):
+    """
+    Append the converted years to the Zarr stores of a variable, in place of the multi-year NetCDF files.
+
+    The yearly files go to the store of the product in destdir and, for the hourly data,
+    their daily means go to the daily store in the day folder of the variable. The yearly
+    files are removed once appended, the cached daily means are kept.
+    """
+
+    print(f'Appending the new years of {var} to Zarr...')
+    product = product_key(dataset, var, freq, grid, levelout, area)
+
+    def yearfile(year):
+        return str(Path(destdir, create_filename(dataset, var, freq, grid, levelout, area, str(year)) + '.nc'))
+
+    targets = [(product, freq, destdir, yearfile)]
+    if freq not in ['mon', 'day']:
+        cachedir, _, _ = daily_means(dataset, var, freq, grid, levelout, area, destdir, storedir, state)
+        targets.append((product_key(dataset, var, 'day', grid, levelout, area), 'day', Path(storedir, var, 'day'),
+                        lambda year: str(Path(cachedir, create_filename(dataset, var, 'day', grid, levelout, area,
+                                                                        str(year)) + '.nc'))))
+
+    for key, kfreq, folder, infile in targets:
+        statuses = state.statuses(key)
+        new = sorted(year for year, status in statuses.items() if status == 'converted')
+        store = zarr_path(dataset, var, kfreq, grid, levelout, area, folder)
+        if not new:
+            print(f'{store} is up to date')
+            continue
+
+        # the store is truncated before the first new year: the later years are appended
+        # again if their yearly file is still available, otherwise they are retrieved again
+        later = sorted(year for year, status in statuses.items() if status == 'merged' and year > new[0])
+        for year in later:
+            if os.path.exists(infile(year)):
+                new.append(year)
+            else:
+                print(f'Year {year} of {var} is dropped from {store} and will be retrieved again')
+                state.mark(key, year, 'planned')
+        new.sort()
+
+        files = [infile(year) for year in new]
+        inputs = [align_monthly(f, tmpdir) for f in files] if kfreq == 'mon' and do_align else files
+        with span('zarr_append', var=var, freq=kfreq, years=len(new),
+                  nbytes=sum(os.path.getsize(f) for f in inputs)):
+            append_years(inputs, store, kfreq, options)
+        for year in new:
+            state.mark(key, year, 'merged', path=str(store))
+
+        if kfreq != 'day':
+            for f in set(files + inputs):
+                os.remove(f)
@@ -0,0 +1,89 @@
+"""Local derivation of other grids and areas from a full-resolution global retrieval, with cached remap weights"""
+
+import os
+import hashlib
+from pathlib import Path
+
+from CDS_retriever import get_cdo, year_convert
+from metrics import span
+
+# default folder of the remap weights in the storedir
+WEIGHTS_NAME = '.cds_retriever_weights'
+
+# interpolation methods, each one with its cdo gen<method> operator
+REMAP_METHODS = ['bil', 'bic', 'con', 'dis', 'nn']
+
+
+def target_griddes(grid, area):
+    """CDO description of the regular lat-lon grid the CDS would deliver for a grid and an area"""
+    xinc, yinc = [float(x) for x in grid.split('x')]
+    if area == 'global':
+        north, west, south, east = 90, 0, -90, 360 - xinc
+    else:
+        north, west, south, east = [float(x) for x in area]
+    return '\n'.join(['gridtype = lonlat',
+                      f'xsize = {round((east - west) / xinc) + 1}',
+                      f'ysize = {round((north - south) / yinc) + 1}',
+                      f'xfirst = {west}', f'xinc = {xinc}',
+                      f'yfirst = {north}', f'yinc = {-yinc}']) + '\n'
+
+
+def _write_once(path, text):
+    """Write a small file atomically, if it does not exist yet"""
+    if not Path(path).exists():
+        part = f'{path}.{os.getpid()}.part'
+        with open(part, 'w', encoding='utf8') as file:
+            file.write(text)
+        os.replace(part, path)
+
+
+def derive_year(infile, outfile, grid, area, weightsdir, method='bil', debug=False):
+    """
+    Remap a yearly NetCDF file to another grid and area.
+
+    The weights are computed once for each pair of source and target grids and cached
+    in weightsdir, so that they are reused for every year and for every variable on the same grid.
+
+    Parameters:
+        infile (str or Path): the yearly file on the retrieved grid
+        outfile (str or Path): the yearly file on the target grid and area
+        grid (str): target grid, e.g. '1x1'
+        area (list or str): target area in the North, West, South, East order, or 'global'
+        weightsdir (str or Path): the cache of the weights
+        method (str): interpolation method, one of REMAP_METHODS
+    """
+
+    if method not in REMAP_METHODS:
+        raise ValueError(f'Unknown remap method {method}')
+    cdo = get_cdo(debug)
+    Path(weightsdir).mkdir(parents=True, exist_ok=True)
+    with span('derive', file=Path(outfile).name, nbytes=os.path.getsize(infile)):
+        first = f'-seltimestep,1 {infile}'
+        target = target_griddes(grid, area)
+        source = '\n'.join(cdo.griddes(input=first))
+        key = hashlib.blake2b('\n'.join([source, target, method]).encode(), digest_size=12).hexdigest()
+        gridfile, weights = Path(weightsdir, key + '.grid'), Path(weightsdir, key + '.nc')
+        _write_once(gridfile, target)
+        if not weights.exists():
+            print(f'Computing the {method} remap weights to {grid} {area}...')
+            part = f'{weights}.{os.getpid()}.part'
+            getattr(cdo, 'gen' + method)(str(gridfile), input=first, output=part)
+            os.replace(part, weights)
+        cdo.remap(str(gridfile), str(weights), input=str(infile), output=str(outfile) + '.part',
+                  options='-f nc4 -z zip')
+        os.replace(str(outfile) + '.part', outfile)
+
+
+def convert_and_derive(infile, outfile, derived, weightsdir, method='bil', convert=year_convert,
+                       **convert_options):
+    """
+    Convert a yearly file and derive the other grids and areas from the NetCDF file.
+
+    Parameters:
+        derived (list of tuple): (outfile, grid, area) of each derived product
+        convert (callable): convert(infile, outfile, **convert_options) writing the NetCDF file
+        convert_options: e.g. backend and options of year_convert
+    """
+    convert(infile, outfile, **convert_options)
+    for target, grid, area in derived:
+        derive_year(outfile, target, grid, area, weightsdir, method)
@@ -0,0 +1,248 @@
+"""Content-addressed cache of the CDS requests, shared by several configurations and users"""
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+from pathlib import Path
+from contextlib import contextmanager
+
+from state import file_checksum
+from metrics import span, event
+
+# default options of the request cache
+CACHE_OPTIONS = {
+    'size': None,        # maximum size of the cache in GB, least recently used requests evicted first
+    'verify': True,      # check the checksum of a cached file before serving it, otherwise only its size
+    'link': 'auto',      # 'auto': hardlink, else reflink, else copy. 'hardlink', 'reflink' or 'copy' to force one
+}
+
+# keys of the requests whose order matters, the other lists are sorted
+ORDERED_KEYS = ['area', 'grid']
+
+# ioctl cloning a file on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+GB = 1024**3
+
+
+def request_hash(kind, retrieve_dict):
+    """
+    Canonical hash of a CDS request: single values and lists, numbers and strings
+    and the order of the months, days, times, levels and variables do not matter.
+    """
+    canonical = {}
+    for key, value in retrieve_dict.items():
+        values = [str(x) for x in (value if isinstance(value, (list, tuple)) else [value])]
+        canonical[key] = values if key in ORDERED_KEYS else sorted(values)
+    text = json.dumps([kind, canonical], sort_keys=True)
+    return hashlib.blake2b(text.encode(), digest_size=20).hexdigest()
+
+
+def _reflink(source, target):
+    """Clone a file sharing its blocks, on filesystems supporting it"""
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def place_file(source, target, link='auto'):
+    """
+    Make source available as target, without copying the data if possible.
+
+    Returns:
+        str: the method used, 'hardlink', 'reflink' or 'copy'
+    """
+    part = f'{target}.{os.getpid()}.part'
+    methods = ['hardlink', 'reflink', 'copy'] if link == 'auto' else [link]
+    for method in methods:
+        try:
+            if method == 'hardlink':
+                os.link(source, part)
+            elif method == 'reflink':
+                _reflink(source, part)
+            else:
+                shutil.copyfile(source, part)
+        except OSError:
+            # e.g. another filesystem, protected hardlinks of another user, no reflink support
+            Path(part).unlink(missing_ok=True)
+            if method == methods[-1]:
+                raise
+            continue
+        os.replace(part, target)
+        return method
+    raise ValueError(f'Unknown link method {link}')
+
+
+def _shared_dir(folder, parents=False):
+    """Create a folder writable by the group (setgid, so that its files keep the group), if missing"""
+    try:
+        Path(folder).mkdir(parents=parents)
+    except FileExistsError:
+        return
+    os.chmod(folder, 0o2775)
+
+
+class RequestCache:
+    """
+    Files of the CDS requests stored by the hash of the request, so that the same request of any
+    configuration or user sharing the folder is served from the local disk instead of the CDS.
+
+    Each entry is a GRIB file with a JSON description of its request, size and checksum,
+    and a stamp file whose mtime is its last use. The copies are read-only, while the hardlinks
+    are left to the permissions of the downloaded file which they share. The folders are group-writable,
+    so that the users of the same group can add and evict entries. Only the folder and the options are kept,
+    so that the object can be passed to the worker processes.
+    """
+
+    def __init__(self, folder, options=None):
+        self.folder = str(folder)
+        self.options = {**CACHE_OPTIONS, **(options or {})}
+        if self.options['link'] not in ['auto', 'hardlink', 'reflink', 'copy']:
+            raise ValueError(f"Unknown link method {self.options['link']}")
+        _shared_dir(self.folder, parents=True)
+        try:
+            Path(self.folder, 'lock').touch(exist_ok=False)
+            os.chmod(Path(self.folder, 'lock'), 0o666)
+        except FileExistsError:
+            pass
+
+    @contextmanager
+    def _lock(self):
+        """Serialize the changes of the entries, POSIX locks also work across NFS clients"""
+        with open(Path(self.folder, 'lock'), 'a', encoding='utf8') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    def _paths(self, key):
+        """The data, description and stamp files of an entry"""
+        folder = Path(self.folder, key[:2])
+        return folder / (key + '.grib'), folder / (key + '.json'), folder / (key + '.used')
+
+    def _drop(self, key):
+        for path in self._paths(key):
+            path.unlink(missing_ok=True)
+
+    def _valid(self, key):
+        """Check the size and optionally the checksum of an entry, returning its description"""
+        data, info, _ = self._paths(key)
+        try:
+            meta = json.loads(info.read_text(encoding='utf8'))
+            if data.stat().st_size != meta['nbytes']:
+                raise ValueError(f"{data.stat().st_size} bytes instead of {meta['nbytes']}")
+            if self.options['verify'] and file_checksum(data) != meta['checksum']:
+                raise ValueError('checksum mismatch')
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Cached request {key} is corrupted ({e}), dropping it')
+            event('cache_corrupted', key=key)
+            try:
+                self._drop(key)
+            except OSError:
+                pass
+            return None
+        return meta
+
+    def fetch(self, kind, retrieve_dict, target, scratch=None):
+        """
+        Serve a request from the cache, reserving its size in the scratch if managed.
+
+        Returns:
+            int: the size of the file placed in target, None if the request is not cached
+        """
+        key = request_hash(kind, retrieve_dict)
+        with span('cache_fetch', key=key, file=Path(target).name) as info:
+            meta = self._valid(key)
+            info['hit'] = meta is not None
+            if meta is None:
+                return None
+            data, _, used = self._paths(key)
+            try:
+                if scratch is None:
+                    info['method'] = place_file(data, target, self.options['link'])
+                else:
+                    with scratch.reserve(meta['nbytes'], target):
+                        info['method'] = place_file(data, target, self.options['link'])
+            except FileNotFoundError:
+                # evicted meanwhile by another process
+                info['hit'] = False
+                return None
+            info['nbytes'] = meta['nbytes']
+            try:
+                os.utime(used)
+            except OSError:
+                pass
+        print(f"Request for {Path(target).name} served from the cache ({info['method']})")
+        return meta['nbytes']
+
+    def store(self, kind, retrieve_dict, source):
+        """Add the file of a request just downloaded to the cache, evicting old entries if needed"""
+        key = request_hash(kind, retrieve_dict)
+        data, info, used = self._paths(key)
+        if data.exists():
+            return
+        nbytes = os.path.getsize(source)
+        if self.options['size'] is not None and nbytes > self.options['size'] * GB:
+            return
+        with span('cache_store', key=key, file=Path(source).name, nbytes=nbytes):
+            _shared_dir(data.parent)
+            meta = {'kind': kind, 'request': retrieve_dict, 'nbytes': nbytes,
+                    'checksum': file_checksum(source), 'created': time.time()}
+            with self._lock():
+                if self.options['size'] is not None:
+                    self.evict(self.usage() + nbytes - self.options['size'] * GB)
+                # read-only copies, since they may be linked in the download folders: a hardlink
+                # shares the inode of the downloaded file, which would become read-only as well
+                if place_file(source, data, self.options['link']) != 'hardlink':
+                    os.chmod(data, 0o444)
+                info.write_text(json.dumps(meta), encoding='utf8')
+                used.touch()
+                os.chmod(used, 0o666)
+
+    def entries(self):
+        """
+        The entries of the cache, least recently used first.
+
+        Returns:
+            list: (key, size) of the entries
+        """
+        entries = []
+        for data in Path(self.folder).glob('*/*.grib'):
+            _, _, used = self._paths(data.stem)
+            try:
+                entries.append((used.stat().st_mtime, data.stem, data.stat().st_size))
+            except FileNotFoundError:
+                continue
+        entries.sort()
+        return [(key, size) for _, key, size in entries]
+
+    def usage(self):
+        """Size of the cached files"""
+        return sum(size for _, size in self.entries())
+
+    def evict(self, need):
+        """
+        Remove the least recently used entries until need bytes are freed.
+
+        Returns:
+            int: the bytes freed
+        """
+        freed = 0
+        for key, size in self.entries():
+            if freed >= need:
+                break
+            try:
+                self._drop(key)
+            except OSError as e:
+                print(f'Cannot evict cached request {key}: {e}')
+                continue
+            freed += size
+        if freed:
+            print(f'Evicted {freed / GB:.2f} GB from the request cache')
+            event('cache_evict', nbytes=freed)
+        return freed
@@ -0,0 +1,115 @@
+"""Local derivation of the 6hrs, daily and monthly products from the yearly files of the 1hr archive"""
+
+import os
+from pathlib import Path
+
+from CDS_retriever import get_cdo, create_filename
+from metrics import span
+
+# frequencies which can be derived from the 1hr archive
+DERIVED_FREQS = ['6hrs', 'day', 'mon']
+
+# variables accumulated over the hour ending at their time step (over the day so far in ERA5-Land)
+ACCUMULATED = [
+    'total_precipitation', 'large_scale_precipitation', 'convective_precipitation', 'snowfall',
+    'large_scale_snowfall', 'convective_snowfall', 'snowmelt', 'evaporation', 'potential_evaporation',
+    'snow_evaporation', 'runoff', 'surface_runoff', 'sub_surface_runoff',
+    'surface_sensible_heat_flux', 'surface_latent_heat_flux',
+    'surface_solar_radiation_downwards', 'surface_thermal_radiation_downwards',
+    'surface_net_solar_radiation', 'surface_net_thermal_radiation',
+    'surface_net_solar_radiation_clear_sky', 'surface_net_thermal_radiation_clear_sky',
+    'surface_solar_radiation_downward_clear_sky', 'surface_thermal_radiation_downward_clear_sky',
+    'total_sky_direct_solar_radiation_at_surface', 'clear_sky_direct_solar_radiation_at_surface',
+    'top_net_solar_radiation', 'top_net_thermal_radiation', 'toa_incident_solar_radiation',
+    'top_net_solar_radiation_clear_sky', 'top_net_thermal_radiation_clear_sky',
+    'eastward_turbulent_surface_stress', 'northward_turbulent_surface_stress',
+    'eastward_gravity_wave_surface_stress', 'northward_gravity_wave_surface_stress',
+    'gravity_wave_dissipation', 'boundary_layer_dissipation',
+]
+
+# extremes over the hour ending at their time step, reduced with their own statistic
+EXTREMES = {
+    'maximum_2m_temperature_since_previous_post_processing': 'max',
+    'minimum_2m_temperature_since_previous_post_processing': 'min',
+    '10m_wind_gust_since_previous_post_processing': 'max',
+}
+
+
+def hourly_source(storedir, dataset, var, grid, levelout, area, year):
+    """The yearly file of the 1hr archive a year is derived from"""
+    return Path(storedir, '1hr', create_filename(dataset, var, '1hr', grid, levelout, area, str(year)) + '.nc')
+
+
+def needs_next_year(var):
+    """Check if the last period of a year of a variable ends in the first time step of the next year"""
+    return var in ACCUMULATED or var in EXTREMES
+
+
+def reduction(dataset, var, freq, year, infile, nextfile=None):
+    """
+    Build the cdo operator chain deriving a frequency from the hourly file of a year.
+
+    Instantaneous variables are subsampled (6hrs) or averaged (day, mon). Accumulated variables
+    and extremes refer to the hour ending at their time step: they are shifted back by one hour, so
+    that each value falls in its period, and the first time step of the next year (nextfile) closes the last period.
+    Accumulations are summed over 6hrs and days, and monthly means are mean daily accumulations
+    as in the CDS monthly means. Periods are labelled with their first time step.
+    ERA5-Land accumulates over the day: the daily totals are the values at 00 of the next day.
+
+    Returns:
+        str: the cdo input, without the output options
+
+    Raises:
+        ValueError: without the next year of accumulated variables and extremes, and
+                    for the 6hrs accumulations of ERA5-Land
+    """
+
+    if needs_next_year(var) and nextfile is None:
+        raise ValueError(f'{var} {year} cannot be derived without the first time step of the next year')
+    series = f'-selyear,{year} -shifttime,-1hour -mergetime [ {infile} -seltimestep,1 {nextfile} ]'
+
+    if var in EXTREMES:
+        stat = EXTREMES[var]
+        if freq == '6hrs':
+            return f'-timsel{stat},6 {series}'
+        if freq == 'day':
+            return f'-day{stat} {series}'
+        return f'-monmean -day{stat} {series}'
+
+    if var in ACCUMULATED:
+        if dataset == 'ERA5-Land':
+            if freq == '6hrs':
+                raise ValueError(f'{var} {year}: the 6hrs accumulations of {dataset} cannot be derived from the '
+                                 'daily accumulations of the 1hr archive, retrieve them from the CDS')
+            daily = f'-shifttime,-23hours -selhour,23 {series}'
+            return daily if freq == 'day' else f'-monmean {daily}'
+        if freq == '6hrs':
+            return f'-timselsum,6 {series}'
+        if freq == 'day':
+            return f'-daysum {series}'
+        return f'-mulc,24 -monmean {series}'
+
+    if freq == '6hrs':
+        return f'-selhour,0,6,12,18 {infile}'
+    if freq == 'day':
+        return f'-daymean {infile}'
+    return f'-monmean {infile}'
+
+
+def derive_frequency(dataset, var, freq, year, infile, outfile, nextfile=None, debug=False):
+    """
+    Derive a yearly file of a coarser frequency from the yearly file of the 1hr archive.
+
+    Parameters:
+        infile (str or Path): the 1hr yearly file
+        outfile (str or Path): the derived yearly file
+        nextfile (str or Path): the 1hr yearly file of the next year, whose first time step
+                                closes the last period of accumulated variables and extremes
+    """
+    if freq not in DERIVED_FREQS:
+        raise ValueError(f'The {freq} frequency cannot be derived from the 1hr archive')
+    with span('resample', file=Path(outfile).name, freq=freq, nbytes=os.path.getsize(infile)):
+        print(f'Deriving {outfile} from {infile}...')
+        get_cdo(debug).copy(input=reduction(dataset, var, freq, year, infile, nextfile),
+                            output=str(outfile) + '.part', options='-f nc4 -z zip --timestat_date first')
+        os.replace(str(outfile) + '.part', outfile)
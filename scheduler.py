@@ -0,0 +1,233 @@
+"""Bounded work-queue scheduler for the retrieve and postproc tasks"""
+
+import sys
+import time
+import traceback
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from leases import LeaseBusy
+
+# a unit of work: key is a tuple such as (var, year) used for reporting
+Task = namedtuple('Task', ['key', 'func', 'args', 'kwargs'], defaults=[None])
+
+
+def task_name(key):
+    """Human readable name of a task key"""
+    return ' '.join(str(k) for k in key)
+
+
+def error_message(error):
+    """One-line description of the exception raised by a task"""
+    return ''.join(traceback.format_exception_only(type(error), error)).strip()
+
+
+def run_tasks(tasks, nprocs, label='tasks', retry=60):
+    """
+    Run every task on a single pool of nprocs workers.
+
+    Tasks are taken from one queue and a worker slot is refilled as soon
+    as it frees up, so a slow task never holds back the others. Tasks leased
+    by another job are put back in the queue and tried again after retry seconds.
+    When a worker process dies (e.g. killed for its memory) the tasks running in
+    the pool are failed and the remaining ones run in a new pool.
+
+    Parameters:
+        tasks (list of Task): the tasks to be executed
+        nprocs (int): maximum number of concurrent tasks
+        label (str): description used in the progress messages
+        retry (float): seconds before a task leased by another job is tried again
+
+    Returns:
+        tuple: A tuple containing:
+            - done (dict): task key -> value returned by the task
+            - failed (dict): task key -> error message
+    """
+
+    done, failed = {}, {}
+    queue = list(tasks)
+    queue.reverse()
+    total = len(queue)
+    if total == 0:
+        return done, failed
+
+    print(f'Running {total} {label} on {nprocs} parallel processes...')
+    executor = ProcessPoolExecutor(max_workers=nprocs)
+    running, deferred = {}, []
+    try:
+        while queue or running or deferred:
+
+            # the leased tasks whose retry time has come
+            now = time.monotonic()
+            queue[:0] = [task for when, task in deferred if when <= now]
+            deferred = [(when, task) for when, task in deferred if when > now]
+
+            # refill the free slots
+            crashed = None
+            while queue and len(running) < nprocs:
+                task = queue.pop()
+                try:
+                    running[executor.submit(task.func, *task.args, **(task.kwargs or {}))] = task
+                except BrokenProcessPool as e:
+                    queue.append(task)
+                    crashed = e
+                    break
+
+            if crashed is None and not running:
+                time.sleep(max(min(when for when, _ in deferred) - now, 0))
+                continue
+            finished = []
+            if crashed is None:
+                timeout = min(when for when, _ in deferred) - now if deferred else None
+                finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                try:
+                    done[task.key] = future.result()
+                    print(f'[{len(done) + len(failed)}/{total}] {task_name(task.key)} done')
+                except LeaseBusy as e:
+                    print(f'{task_name(task.key)} postponed: {e}')
+                    deferred.append((time.monotonic() + retry, task))
+                except BrokenProcessPool as e:
+                    failed[task.key] = f'worker process crashed: {error_message(e)}'
+                    print(f'[{len(done) + len(failed)}/{total}] {task_name(task.key)} FAILED: {failed[task.key]}')
+                    crashed = e
+                except BaseException as e:  # pylint: disable=broad-exception-caught
+                    # SystemExit raised by sys.exit() in the workers lands here too
+                    failed[task.key] = error_message(e)
+                    print(f'[{len(done) + len(failed)}/{total}] {task_name(task.key)} FAILED: {failed[task.key]}')
+
+            if crashed is not None:
+                # the whole pool is broken: its running tasks are lost, the queued ones go to a new pool
+                for task in running.values():
+                    failed[task.key] = f'worker process crashed: {error_message(crashed)}'
+                    print(f'[{len(done) + len(failed)}/{total}] {task_name(task.key)} FAILED: {failed[task.key]}')
+                running.clear()
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=nprocs)
+    finally:
+        executor.shutdown()
+
+    report_tasks(done, failed, label)
+    return done, failed
+
+
+def run_stages(initial, on_done, workers, backpressure=None, retry=60):
+    """
+    Run the tasks of several stages connected by queues, each stage with its own pool.
+
+    A task can start as soon as the tasks it depends on are finished: when a task
+    ends on_done() is called in the main process and returns the new tasks to be queued.
+    Tasks leased by another job are tried again after retry seconds, and when a worker
+    process dies the tasks running in the pool of its stage are failed and the stage gets a new pool.
+
+    Parameters:
+        initial (list): the (stage, Task) tuples available at the beginning
+        on_done (callable): on_done(stage, key, ok) returning a list of (stage, Task) tuples
+        workers (dict): stage -> number of workers, in the order of the pipeline
+        backpressure (dict): stage -> (downstream stage, n), do not start new tasks of a
+                             stage while more than n tasks of the downstream stage are waiting
+        retry (float): seconds before a task leased by another job is tried again
+
+    Returns:
+        tuple: A tuple containing:
+            - done (dict): stage -> task key -> value returned by the task
+            - failed (dict): stage -> task key -> error message
+    """
+
+    backpressure = backpressure or {}
+    queues = {stage: deque() for stage in workers}
+    done = {stage: {} for stage in workers}
+    failed = {stage: {} for stage in workers}
+    for stage, task in initial:
+        queues[stage].append(task)
+
+    print('Running pipeline with ' + ', '.join(f'{n} {stage} workers' for stage, n in workers.items()) + '...')
+    executors = {stage: ProcessPoolExecutor(max_workers=n) for stage, n in workers.items()}
+    running, deferred = {}, []
+
+    def finish(stage, task, error=None):
+        if error is None:
+            print(f'{stage} {task_name(task.key)} done')
+        else:
+            failed[stage][task.key] = error
+            print(f'{stage} {task_name(task.key)} FAILED: {error}')
+        for next_stage, next_task in on_done(stage, task.key, error is None):
+            queues[next_stage].append(next_task)
+
+    try:
+        while running or deferred or any(queues.values()):
+
+            # the leased tasks whose retry time has come
+            now = time.monotonic()
+            for _, stage, task in [item for item in deferred if item[0] <= now]:
+                queues[stage].append(task)
+            deferred = [item for item in deferred if item[0] > now]
+
+            # refill the free slots of each stage, unless the downstream queue is too long
+            crashed = {}
+            for stage, nworkers in workers.items():
+                if stage in backpressure:
+                    downstream, limit = backpressure[stage]
+                    if len(queues[downstream]) > limit:
+                        continue
+                busy = sum(1 for s, _ in running.values() if s == stage)
+                while queues[stage] and busy < nworkers:
+                    task = queues[stage].popleft()
+                    try:
+                        future = executors[stage].submit(task.func, *task.args, **(task.kwargs or {}))
+                    except BrokenProcessPool as e:
+                        queues[stage].appendleft(task)
+                        crashed[stage] = e
+                        break
+                    running[future] = (stage, task)
+                    busy += 1
+
+            if not crashed and not running:
+                time.sleep(max(min(when for when, _, _ in deferred) - now, 0))
+                continue
+            finished = []
+            if not crashed:
+                timeout = min(when for when, _, _ in deferred) - now if deferred else None
+                finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, task = running.pop(future)
+                try:
+                    done[stage][task.key] = future.result()
+                except LeaseBusy as e:
+                    print(f'{stage} {task_name(task.key)} postponed: {e}')
+                    deferred.append((time.monotonic() + retry, stage, task))
+                    continue
+                except BrokenProcessPool as e:
+                    crashed[stage] = e
+                    finish(stage, task, f'worker process crashed: {error_message(e)}')
+                    continue
+                except BaseException as e:  # pylint: disable=broad-exception-caught
+                    finish(stage, task, error_message(e))
+                    continue
+                finish(stage, task)
+
+            # the broken pools lose their running tasks, the queued ones go to a new pool
+            for stage, error in crashed.items():
+                for future, (task_stage, task) in list(running.items()):
+                    if task_stage == stage:
+                        del running[future]
+                        finish(stage, task, f'worker process crashed: {error_message(error)}')
+                executors[stage].shutdown(wait=False)
+                executors[stage] = ProcessPoolExecutor(max_workers=workers[stage])
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+
+    for stage in workers:
+        report_tasks(done[stage], failed[stage], label=f'{stage} tasks')
+    return done, failed
+
+
+def report_tasks(done, failed, label='tasks'):
+    """Print a summary of the task results"""
+
+    print(f'\nSummary of {label}: {len(done)} succeeded, {len(failed)} failed')
+    for key, error in sorted(failed.items()):
+        print(f'\t - {task_name(key)}: {error}', file=sys.stderr)
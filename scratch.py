@@ -0,0 +1,212 @@
+"""Managed download folder: a byte budget, eviction of the converted GRIB files and disk back-pressure"""
+
+import os
+import time
+import uuid
+import fcntl
+import shutil
+import socket
+from pathlib import Path
+from contextlib import contextmanager
+
+from CDS_retriever import create_filename
+from state import product_key
+from metrics import event
+
+# default options of the scratch management
+SCRATCH_OPTIONS = {
+    'budget': None,     # maximum size of the download folder in GB, e.g. the quota of the scratch filesystem
+    'min_free': 1,      # GB always left free on the filesystem
+    'policy': 'lru',    # 'lru': least recently used files first. 'year': oldest years first.
+                        # 'eager': every file as soon as it is converted
+    'keep_years': 0,    # most recent converted years of each variable which are never evicted
+    'poll': 60,         # seconds between two checks of the free space while downloads are blocked
+}
+
+# folder of the reservations of the running downloads, in the download folder
+RESERVED_DIR = '.reserved'
+
+GB = 1024**3
+
+
+class Scratch:
+    """
+    Byte budget of the download folder, shared by all the processes retrieving into it.
+
+    Before a download starts its size is reserved, evicting the GRIB files already converted
+    if needed, or waiting for the space to be freed. Only paths and options are kept,
+    so that the object can be passed to the worker processes as the StateDB.
+    """
+
+    def __init__(self, tmpdir, state, products, options=None):
+        """
+        Parameters:
+            tmpdir (str or Path): the download folder
+            state (StateDB): where the converted years are found
+            products (list of tuple): (dataset, var, freq, grid, levelout, area) of the yearly GRIB files
+            options (dict): overrides of SCRATCH_OPTIONS
+        """
+        self.tmpdir = str(tmpdir)
+        self.state = state
+        self.products = [tuple(product) for product in products]
+        self.options = {**SCRATCH_OPTIONS, **(options or {})}
+        if self.options['policy'] not in ['lru', 'year', 'eager']:
+            raise ValueError(f"Unknown eviction policy {self.options['policy']}")
+        Path(self.tmpdir, RESERVED_DIR).mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _lock(self):
+        """Serialize the reservations of all the processes"""
+        with open(Path(self.tmpdir, RESERVED_DIR, 'lock'), 'w', encoding='utf8') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def usage(self):
+        """Size of the files of the download folder"""
+        return sum(f.stat().st_size for f in Path(self.tmpdir).rglob('*')
+                   if f.is_file() and f.parent.name != RESERVED_DIR)
+
+    def reserved(self):
+        """
+        Bytes reserved by the running downloads and not written yet.
+        Reservations of the dead processes of this host are dropped.
+        """
+        total = 0
+        for path in Path(self.tmpdir, RESERVED_DIR).glob('*.res'):
+            host, pid, _ = path.stem.rsplit('-', 2)
+            if host == socket.gethostname() and not _alive(int(pid)):
+                path.unlink(missing_ok=True)
+                continue
+            try:
+                nbytes, target = path.read_text(encoding='utf8').split('\n', 1)
+            except (OSError, ValueError):
+                continue
+            written = sum(f.stat().st_size for f in [Path(target), Path(target + '.part')] if f.exists())
+            total += max(int(nbytes) - written, 0)
+        return total
+
+    def available(self, usage=None):
+        """Bytes which can be written without exceeding the budget nor filling the filesystem"""
+        available = shutil.disk_usage(self.tmpdir).free - self.options['min_free'] * GB
+        if self.options['budget'] is not None:
+            usage = self.usage() if usage is None else usage
+            available = min(available, self.options['budget'] * GB - usage)
+        return available - self.reserved()
+
+    def evictable(self):
+        """
+        The yearly GRIB files which have been converted, in eviction order,
+        without the most recent keep_years years of each variable.
+
+        Returns:
+            list: (path, size) of the files
+        """
+        files = []
+        for dataset, var, freq, grid, levelout, area in self.products:
+            years = self.state.years(product_key(dataset, var, freq, grid, levelout, area), 'converted')
+            if self.options['keep_years']:
+                years = years[:-self.options['keep_years']]
+            for year in years:
+                path = Path(self.tmpdir, var, create_filename(dataset, var, freq, grid, levelout, area,
+                                                              str(year)) + '.grib')
+                if path.exists():
+                    stat = path.stat()
+                    files.append((year, max(stat.st_atime, stat.st_mtime), path, stat.st_size))
+        if self.options['policy'] == 'year':
+            files.sort(key=lambda f: (f[0], f[1]))
+        else:
+            files.sort(key=lambda f: f[1])
+        return [(path, size) for _, _, path, size in files]
+
+    def evict(self, need):
+        """
+        Remove converted GRIB files until need bytes are freed (all of them with the eager policy).
+
+        Returns:
+            int: the bytes freed
+        """
+        freed = 0
+        for path, size in self.evictable():
+            if freed >= need and self.options['policy'] != 'eager':
+                break
+            print(f'Evicting {path} ({size / 1024**2:.0f} MB) from the scratch')
+            try:
+                linked = path.stat().st_nlink > 1
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            # the files hardlinked into the request cache keep their blocks on the disk
+            if not linked:
+                freed += size
+        if freed:
+            event('scratch_evict', nbytes=freed)
+        return freed
+
+    def trim(self):
+        """Bring the download folder back within its budget, e.g. after new years have been converted"""
+        with self._lock():
+            if self.options['policy'] == 'eager':
+                self.evict(0)
+            elif self.options['budget'] is not None:
+                self.evict(self.usage() - self.options['budget'] * GB)
+
+    @contextmanager
+    def reserve(self, nbytes, target):
+        """
+        Reserve the space of a download before it starts: converted files are evicted if needed,
+        otherwise the download waits until enough space is freed by the other processes.
+        IOError is raised when it would never fit: beyond the budget, or with nothing left
+        to evict and no other download running.
+
+        Parameters:
+            nbytes (int): the size of the download, 0 if unknown
+            target (str or Path): the file being downloaded
+        """
+
+        nbytes = nbytes or 0
+        if self.options['budget'] is not None and nbytes > self.options['budget'] * GB:
+            raise IOError(f"Download of {target} needs {nbytes / GB:.2f} GB, "
+                          f"beyond the budget of {self.options['budget']} GB of the scratch")
+        path, waiting, start = None, False, time.perf_counter()
+        while path is None:
+            with self._lock():
+                available = self.available()
+                if available < nbytes or self.options['policy'] == 'eager':
+                    self.evict(nbytes - available)
+                    # measured again: the hardlinked files leave the budget but free no disk
+                    available = self.available()
+                if available >= nbytes:
+                    path = Path(self.tmpdir, RESERVED_DIR,
+                                f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex}.res')
+                    path.write_text(f'{nbytes}\n{target}', encoding='utf8')
+                elif not self.evictable() and not self.reserved():
+                    raise IOError(f'Download of {target} needs {nbytes / GB:.2f} GB, only {max(available, 0) / GB:.2f} '
+                                  f'GB available in the scratch with nothing to evict nor other downloads running')
+            if path is None:
+                if not waiting:
+                    print(f'Download of {target} blocked: {nbytes / GB:.2f} GB needed, '
+                          f'{max(available, 0) / GB:.2f} GB available in the scratch')
+                    waiting = True
+                time.sleep(self.options['poll'])
+        if waiting:
+            print(f'Download of {target} unblocked')
+            event('scratch_wait', duration=round(time.perf_counter() - start, 3), nbytes=nbytes,
+                  file=Path(target).name)
+        try:
+            yield
+        finally:
+            path.unlink(missing_ok=True)
+
+
+def _alive(pid):
+    """Check if a process of this host is running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,157 @@
+"""Persistent state of the retrieval, stored in a sqlite database"""
+
+import time
+import sqlite3
+import hashlib
+from contextlib import closing
+
+# default name of the state database in the storedir
+STATE_NAME = '.cds_retriever_state.sqlite'
+
+# the life cycle of a chunk, in order
+STATUSES = ['planned', 'submitted', 'downloaded', 'verified', 'converted', 'merged']
+
+# month used for the chunks covering a whole year
+WHOLE_YEAR = 0
+
+# experiment versions of the final ERA5 data and of the preliminary ERA5T data
+FINAL = '0001'
+PRELIMINARY = '0005'
+
+
+def month_expver(expvers):
+    """The experiment version of a month from those of its fields: preliminary if any of them is, None if unknown"""
+    if not expvers:
+        return None
+    return PRELIMINARY if PRELIMINARY in expvers else min(expvers)
+
+
+def product_key(dataset, var, freq, grid, levelout, area):
+    """Define the key of a product in the state database, with the same area naming of create_filename"""
+    strarea = area if area == 'global' else '_'.join([str(x) for x in area])
+    return (dataset, var, freq, grid, levelout, strarea)
+
+
+def file_checksum(filename, blocksize=16 * 1024**2):
+    """Compute the blake2b checksum of a file"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as file:
+        while True:
+            block = file.read(blocksize)
+            if not block:
+                return digest.hexdigest()
+            digest.update(block)
+
+
+class StateDB:
+    """
+    Status of every planned chunk (dataset, var, freq, grid, level, area, year, month),
+    and of the experiment version (final ERA5 or preliminary ERA5T) of the monthly chunks.
+
+    Only the path of the database is kept, and a connection is opened for each
+    operation, so that the object can be safely passed to the worker processes.
+    With shared=True the rollback journal is used instead of WAL, which needs
+    memory shared by all the clients and does not work across the nodes of a cluster.
+    With readonly=True an existing database is only queried, e.g. to plan a dry run.
+    """
+
+    def __init__(self, path, shared=False, readonly=False):
+        self.path = str(path)
+        self.journal = 'DELETE' if shared else 'WAL'
+        self.readonly = readonly
+        if readonly:
+            return
+        with closing(self._connect()) as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS chunks ('
+                       'dataset TEXT, var TEXT, freq TEXT, grid TEXT, level TEXT, area TEXT, '
+                       'year INTEGER, month INTEGER, status TEXT, request_id TEXT, nbytes INTEGER, '
+                       'checksum TEXT, path TEXT, updated REAL, '
+                       'PRIMARY KEY (dataset, var, freq, grid, level, area, year, month))')
+            # the databases created before the near-real-time updates have no expver
+            columns = [row[1] for row in db.execute('PRAGMA table_info(chunks)')]
+            if 'expver' not in columns:
+                db.execute('ALTER TABLE chunks ADD COLUMN expver TEXT')
+
+    def _connect(self):
+        if self.readonly:
+            return sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, timeout=120)
+        db = sqlite3.connect(self.path, timeout=120)
+        db.execute(f'PRAGMA journal_mode={self.journal}')
+        return db
+
+    def mark(self, product, year, status, month=WHOLE_YEAR, **fields):
+        """
+        Set the status of a chunk, with optional request_id, nbytes, checksum, path and expver.
+        Fields which are not provided keep their previous value.
+        """
+
+        if status not in STATUSES:
+            raise ValueError(f'Unknown status {status}')
+        key = tuple(product) + (int(year), int(month))
+        values = {name: fields.get(name) for name in ['request_id', 'nbytes', 'checksum', 'path', 'expver']}
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT INTO chunks (dataset, var, freq, grid, level, area, year, month, status, '
+                       'request_id, nbytes, checksum, path, updated, expver) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                       'ON CONFLICT (dataset, var, freq, grid, level, area, year, month) '
+                       'DO UPDATE SET status=excluded.status, '
+                       'request_id=coalesce(excluded.request_id, request_id), '
+                       'nbytes=coalesce(excluded.nbytes, nbytes), '
+                       'checksum=coalesce(excluded.checksum, checksum), '
+                       'path=coalesce(excluded.path, path), updated=excluded.updated, '
+                       'expver=coalesce(excluded.expver, expver)',
+                       key + (status, values['request_id'], values['nbytes'], values['checksum'],
+                              values['path'], time.time(), values['expver']))
+
+    def status(self, product, year, month=WHOLE_YEAR):
+        """Get the status of a chunk, None if it has never been planned"""
+        with closing(self._connect()) as db:
+            row = db.execute('SELECT status FROM chunks WHERE dataset=? AND var=? AND freq=? AND grid=? '
+                             'AND level=? AND area=? AND year=? AND month=?',
+                             tuple(product) + (int(year), int(month))).fetchone()
+        return row[0] if row else None
+
+    def statuses(self, product):
+        """Get the status of all the whole-year chunks of a product, as a year -> status dict"""
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT year, status FROM chunks WHERE dataset=? AND var=? AND freq=? AND grid=? '
+                              'AND level=? AND area=? AND month=?', tuple(product) + (WHOLE_YEAR,)).fetchall()
+        return dict(rows)
+
+    def expvers(self, product, year):
+        """Get the experiment version of the monthly chunks of a year, as a month -> expver dict"""
+        try:
+            with closing(self._connect()) as db:
+                rows = db.execute('SELECT month, expver FROM chunks WHERE dataset=? AND var=? AND freq=? AND grid=? '
+                                  'AND level=? AND area=? AND year=? AND month!=? AND expver IS NOT NULL',
+                                  tuple(product) + (int(year), WHOLE_YEAR)).fetchall()
+        except sqlite3.OperationalError:
+            # a read-only database created before the expver column
+            return {}
+        return dict(rows)
+
+    def preliminary_years(self, product):
+        """List the years of a product with some months of preliminary data"""
+        try:
+            with closing(self._connect()) as db:
+                rows = db.execute('SELECT DISTINCT year FROM chunks WHERE dataset=? AND var=? AND freq=? AND grid=? '
+                                  'AND level=? AND area=? AND expver=? ORDER BY year',
+                                  tuple(product) + (PRELIMINARY,)).fetchall()
+        except sqlite3.OperationalError:
+            # a read-only database created before the expver column
+            return []
+        return [row[0] for row in rows]
+
+    def years(self, product, status):
+        """List the years of a product whose whole-year chunk has reached at least a status"""
+        reached = STATUSES[STATUSES.index(status):]
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT year FROM chunks WHERE dataset=? AND var=? AND freq=? AND grid=? '
+                              f"AND level=? AND area=? AND month=? AND status IN ({','.join('?' * len(reached))}) "
+                              'ORDER BY year', tuple(product) + (WHOLE_YEAR,) + tuple(reached)).fetchall()
+        return [row[0] for row in rows]
+
+
+def reached(status, target):
+    """Check if a status has reached at least the target status"""
+    return status is not None and STATUSES.index(status) >= STATUSES.index(target)
@@ -0,0 +1,6 @@
+"""The modules of the repository are flat, make them importable by the tests"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,90 @@
+"""Tests of the splitting of the yearly retrievals into chunks"""
+
+import itertools
+
+import pytest
+
+from CDS_retriever import define_chunks, split_even
+
+LEVELS = ['850', '500', '200']
+DAYS = [f'{day:02d}' for day in range(1, 32)]
+MONTHS = [f'{month:02d}' for month in range(1, 13)]
+
+
+def chunk_fields(chunk, hours=24):
+    levels = 1 if chunk['level'] == 'sfc' else len(chunk['level'])
+    return len(chunk['month']) * len(chunk['day']) * hours * levels
+
+
+def covered(chunks):
+    """All the (month, level, day) of the chunks, each of them once"""
+    cells = [cell for chunk in chunks for cell in itertools.product(chunk['month'], chunk['level'], chunk['day'])]
+    assert len(cells) == len(set(cells))
+    return set(cells)
+
+
+@pytest.mark.parametrize('items, size, sizes', [
+    (list(range(10)), 4, [3, 3, 4]),
+    (list(range(12)), 5, [4, 4, 4]),
+    (list(range(31)), 20, [15, 16]),
+    (list(range(3)), 2, [1, 2]),
+    # a single chunk, and more chunks than items
+    (list(range(12)), 12, [12]),
+    (list(range(3)), 100, [3]),
+    (list(range(3)), 1, [1, 1, 1]),
+    ([], 3, []),
+])
+def test_split_even(items, size, sizes):
+    groups = split_even(items, size)
+    assert [len(group) for group in groups] == sizes
+    assert sum(groups, []) == items
+
+
+def test_fixed_chunks():
+    yearly, = define_chunks('1hr', 'sfc')
+    assert yearly['month'] == MONTHS and yearly['suffix'] == ''
+    monthly = define_chunks('1hr', 'sfc', 'monthly')
+    assert [chunk['month'] for chunk in monthly] == MONTHS
+    assert [chunk['suffix'] for chunk in monthly] == MONTHS
+
+
+def test_auto_single_chunk():
+    chunk, = define_chunks('1hr', LEVELS, 'auto', max_fields=12 * 31 * 24 * 3)
+    assert chunk['month'] == MONTHS and chunk['level'] == LEVELS and chunk['day'] == DAYS
+    assert chunk['suffix'] == '_c000'
+
+
+def test_auto_months():
+    chunks = define_chunks('1hr', 'sfc', 'auto', max_fields=5 * 31 * 24)
+    assert [chunk['month'] for chunk in chunks] == [MONTHS[0:4], MONTHS[4:8], MONTHS[8:12]]
+    # the variables of a group retrieved together count as well
+    chunks = define_chunks('1hr', 'sfc', 'auto', max_fields=5 * 31 * 24, nvars=2)
+    assert len(chunks) == 6 and all(len(chunk['month']) == 2 for chunk in chunks)
+
+
+def test_auto_uneven_levels():
+    chunks = define_chunks('1hr', LEVELS, 'auto', max_fields=2 * 31 * 24)
+    assert len(chunks) == 24
+    assert [chunk['level'] for chunk in chunks[:2]] == [['850'], ['500', '200']]
+    assert all(chunk_fields(chunk) <= 2 * 31 * 24 for chunk in chunks)
+    assert covered(chunks) == set(itertools.product(MONTHS, LEVELS, DAYS))
+    assert len({chunk['suffix'] for chunk in chunks}) == 24
+
+
+def test_auto_uneven_days():
+    chunks = define_chunks('1hr', 'sfc', 'auto', max_fields=500)
+    assert [len(chunk['day']) for chunk in chunks[:2]] == [15, 16]
+    assert len(chunks) == 24 and all(chunk_fields(chunk) <= 500 for chunk in chunks)
+
+    # single levels and ranges of days
+    chunks = define_chunks('1hr', LEVELS, 'auto', max_fields=100)
+    assert len(chunks) == 12 * 3 * 8
+    assert all(len(chunk['level']) == 1 and chunk_fields(chunk) <= 100 for chunk in chunks)
+    assert covered(chunks) == set(itertools.product(MONTHS, LEVELS, DAYS))
+
+
+def test_auto_below_a_day():
+    # a day of a level is the smallest chunk, even if beyond the limit
+    chunks = define_chunks('1hr', LEVELS, 'auto', max_fields=10)
+    assert len(chunks) == 12 * 3 * 31
+    assert all(len(chunk['day']) == 1 and len(chunk['level']) == 1 for chunk in chunks)
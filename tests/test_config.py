@@ -0,0 +1,15 @@
+"""Tests of the loading of the configuration file"""
+
+from config import load_config, DEFAULTS
+
+
+def test_load_config(tmp_path):
+    (tmp_path / 'config.yml').write_text("retrieve_mode : 'async'\nvarlist : ['2m_temperature']\n", encoding='utf8')
+    config = load_config(tmp_path / 'config.yml')
+    assert config['retrieve_mode'] == 'async' and config['varlist'] == ['2m_temperature']
+    assert config['poll_interval'] == DEFAULTS['poll_interval']
+
+
+def test_load_empty_config(tmp_path):
+    (tmp_path / 'config.yml').write_text('', encoding='utf8')
+    assert load_config(tmp_path / 'config.yml') == DEFAULTS
@@ -0,0 +1,18 @@
+"""Tests of the downloads of the CDS results, with stubs of the results of both cdsapi clients"""
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('requests')
+
+# pylint: disable=wrong-import-position
+from downloader import request_id
+
+
+def test_request_id():
+    # legacy cdsapi Result, current CDS API Remote and Results, and a request served by the cache
+    assert request_id(SimpleNamespace(reply={'request_id': 'abc'})) == 'abc'
+    assert request_id(SimpleNamespace(request_uid='def')) == 'def'
+    assert request_id(SimpleNamespace(url='https://cds.example/api/retrieve/v1/jobs/ghi/results')) == 'ghi'
+    assert request_id(None) is None
@@ -0,0 +1,105 @@
+"""Tests of the GRIB header scanner on hand-built messages"""
+
+import random
+import datetime
+
+import pytest
+
+from grib_scan import scan_grib, check_grib, month_expvers, GribError
+from fake_cds import grib1_message
+
+GRID = (10.0, 0.0, 0.0, 10.0, 5.0)
+
+
+def _section(number, body):
+    return (5 + len(body)).to_bytes(4, 'big') + bytes([number]) + body
+
+
+def _datetime(date):
+    return date.year.to_bytes(2, 'big') + bytes([date.month, date.day, date.hour, date.minute, date.second])
+
+
+def grib2_message(template, reftime, end=None, step=0, expver=None, discipline=0, category=1, number=8):
+    """
+    Build a GRIB2 message with the sections read by the scanner (1, 2 and 4), on no grid and with no data.
+    The templates 4.8 and 4.11 are accumulations over one hour ending at end.
+    """
+
+    sec1 = (98).to_bytes(2, 'big') + bytes(2) + bytes([28, 0, 1]) + _datetime(reftime) + bytes([0, 1])
+    sections = _section(1, sec1)
+    if expver is not None:
+        # ECMWF local definition 1: class, type, stream and expver
+        sections += _section(2, (1).to_bytes(2, 'big') + bytes([1, 2]) + (1025).to_bytes(2, 'big') + expver.encode())
+
+    product = bytes([category, number, 2, 0, 0]) + bytes(3) + bytes([1]) + step.to_bytes(4, 'big') \
+        + bytes([1, 0]) + bytes(4) + bytes([255, 0]) + bytes(4)
+    if template == 11:
+        # perturbed forecast 3 of an ensemble of 10
+        product += bytes([3, 3, 10])
+    if template in [8, 11]:
+        product += _datetime(end) + bytes([1]) + bytes(4) + bytes([1, 2, 1]) + (1).to_bytes(4, 'big') \
+            + bytes([1]) + bytes(4)
+    sections += _section(4, bytes(2) + template.to_bytes(2, 'big') + product)
+
+    body = sections + b'7777'
+    return b'GRIB' + bytes(2) + bytes([discipline, 2]) + (16 + len(body)).to_bytes(8, 'big') + body
+
+
+def _write(path, messages):
+    path.write_bytes(b''.join(messages))
+    return path
+
+
+def test_grib1_fields(tmp_path):
+    rng = random.Random(0)
+    date = datetime.datetime(2020, 3, 1, 6)
+    gribfile = _write(tmp_path / 'a.grib', [grib1_message(date, 130, 500, GRID, rng, '0005'),
+                                            grib1_message(date, 228, 0, GRID, rng)])
+    fields = list(scan_grib(gribfile))
+    assert [(f['edition'], f['param'], f['level'], f['validity'], f['expver']) for f in fields] == \
+        [(1, 130, 500, date, '0005'), (1, 228, 0, date, '0001')]
+    assert fields[1]['offset'] == fields[0]['length']
+
+
+def test_grib2_instantaneous(tmp_path):
+    reftime = datetime.datetime(2020, 3, 1, 0)
+    gribfile = _write(tmp_path / 'a.grib', [grib2_message(0, reftime, step=6, expver='0001')])
+    field, = scan_grib(gribfile)
+    assert field['param'] == '0.1.8'
+    assert field['validity'] == datetime.datetime(2020, 3, 1, 6)
+    assert field['expver'] == '0001'
+
+
+@pytest.mark.parametrize('template', [8, 11])
+def test_grib2_end_of_interval(tmp_path, template):
+    reftime = datetime.datetime(2020, 3, 1, 6)
+    end = datetime.datetime(2020, 3, 1, 7)
+    gribfile = _write(tmp_path / 'a.grib', [grib2_message(template, reftime, end=end)])
+    field, = scan_grib(gribfile)
+    assert field['reftime'] == reftime
+    assert field['validity'] == end
+    assert field['expver'] is None
+
+
+def test_grib2_ensemble_accumulations_complete(tmp_path):
+    reftime = datetime.datetime(2020, 1, 1, 0)
+    ends = [reftime + datetime.timedelta(hours=hour) for hour in range(1, 4)]
+    gribfile = _write(tmp_path / 'a.grib', [grib2_message(11, reftime, end=end) for end in ends])
+    expected = {(end.year, end.month, end.day, end.hour) for end in ends}
+    assert check_grib(gribfile, expected)[0]
+
+
+def test_month_expvers(tmp_path):
+    rng = random.Random(0)
+    gribfile = _write(tmp_path / 'a.grib', [
+        grib1_message(datetime.datetime(2020, 5, 31, 23), 167, 0, GRID, rng, '0001'),
+        grib1_message(datetime.datetime(2020, 6, 1, 0), 167, 0, GRID, rng, '0005'),
+        grib2_message(0, datetime.datetime(2020, 6, 1, 1), expver='0001')])
+    assert month_expvers(gribfile) == {(2020, 5): {'0001'}, (2020, 6): {'0001', '0005'}}
+
+
+def test_truncated(tmp_path):
+    message = grib2_message(8, datetime.datetime(2020, 1, 1), end=datetime.datetime(2020, 1, 1, 1))
+    gribfile = _write(tmp_path / 'a.grib', [message, message[:-10]])
+    with pytest.raises(GribError):
+        list(scan_grib(gribfile))
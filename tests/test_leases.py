@@ -0,0 +1,81 @@
+"""Tests of the leases of the tasks shared by several workers"""
+
+import os
+import time
+
+import pytest
+
+from leases import Leases, LeaseBusy, leased, SKIPPED
+from state import StateDB, product_key
+
+LEASE = ('convert', '2m_temperature', 2000)
+
+
+def expire(leases, lease):
+    """Make a lease look abandoned by its holder"""
+    old = time.time() - leases.ttl - 1
+    os.utime(leases._path(lease), (old, old))  # pylint: disable=protected-access
+
+
+def test_acquire_release(tmp_path):
+    leases = Leases(tmp_path, ttl=60)
+    owner = leases.acquire(LEASE)
+    assert owner is not None and leases.owner(LEASE) == owner
+    assert leases.acquire(LEASE) is None
+    # only the owner releases it
+    leases.release(LEASE, 'someone-else')
+    assert leases.owner(LEASE) == owner
+    leases.release(LEASE, owner)
+    assert leases.owner(LEASE) is None
+    assert leases.acquire(LEASE) is not None
+
+
+def test_contention(tmp_path):
+    leases = Leases(tmp_path, ttl=60)
+    with leases.hold(LEASE) as owner:
+        with pytest.raises(LeaseBusy, match=owner):
+            with leases.hold(LEASE):
+                pass
+        # other leases are independent
+        with leases.hold(('convert', '2m_temperature', 2001)):
+            pass
+    assert leases.owner(LEASE) is None
+
+
+def test_stale_lease(tmp_path):
+    leases = Leases(tmp_path, ttl=60)
+    dead = leases.acquire(LEASE)
+    expire(leases, LEASE)
+    owner = leases.acquire(LEASE)
+    assert owner not in [None, dead] and leases.owner(LEASE) == owner
+    # the former holder can neither renew nor release it anymore
+    expire(leases, LEASE)
+    leases.renew(LEASE, dead)
+    assert time.time() - leases._path(LEASE).stat().st_mtime > 60  # pylint: disable=protected-access
+    leases.release(LEASE, dead)
+    assert leases.owner(LEASE) == owner
+
+
+def test_renew(tmp_path):
+    leases = Leases(tmp_path, ttl=60)
+    owner = leases.acquire(LEASE)
+    expire(leases, LEASE)
+    leases.renew(LEASE, owner)
+    assert leases.acquire(LEASE) is None
+
+
+def test_heartbeat(tmp_path):
+    leases = Leases(tmp_path, ttl=0.4)
+    with leases.hold(LEASE):
+        # renewed every ttl / 4 while held
+        time.sleep(1)
+        assert leases.acquire(LEASE) is None
+
+
+def test_leased_skip(tmp_path):
+    state = StateDB(tmp_path / 'state.sqlite')
+    product = product_key('ERA5', '2m_temperature', 'mon', '1x1', 'sfc', 'global')
+    leases = Leases(tmp_path / 'leases')
+    assert leased(leases, LEASE, lambda x: x * 2, 21, skip_if=(state, [(product, 2000)], 'converted')) == 42
+    state.mark(product, 2000, 'converted')
+    assert leased(leases, LEASE, lambda x: x * 2, 21, skip_if=(state, [(product, 2000)], 'converted')) == SKIPPED
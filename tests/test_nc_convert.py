@@ -0,0 +1,61 @@
+"""Tests of the native conversion of GRIB files to NetCDF4"""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+eccodes = pytest.importorskip('eccodes')
+netCDF4 = pytest.importorskip('netCDF4')
+
+# pylint: disable=wrong-import-position
+from nc_convert import grib_to_netcdf, UnsupportedGrid
+from fake_cds import synthetic_grib
+
+REQUEST = {'product_type': 'monthly_averaged_reanalysis', 'variable': '2m_temperature', 'year': '2000',
+           'month': ['01', '02', '03'], 'day': '01', 'time': '00:00', 'grid': ['30', '30']}
+
+
+def grib_values(gribfile):
+    """The values of the fields of a GRIB file, in order"""
+    values = []
+    with open(gribfile, 'rb') as grib:
+        while (handle := eccodes.codes_grib_new_from_file(grib)) is not None:
+            values.append(eccodes.codes_get_values(handle))
+            eccodes.codes_release(handle)
+    return values
+
+
+@pytest.mark.parametrize('chunks', ['map', 'time'])
+def test_single_level(tmp_path, chunks):
+    synthetic_grib(REQUEST, tmp_path / 'a.grib', resolution=30)
+    grib_to_netcdf(tmp_path / 'a.grib', tmp_path / 'a.nc', {'chunks': chunks})
+    with netCDF4.Dataset(tmp_path / 'a.nc') as nc:
+        # named by the eccodes shortName
+        assert set(nc.variables) == {'time', 'lat', 'lon', '2t'}
+        dates = netCDF4.num2date(nc['time'][:], nc['time'].units, nc['time'].calendar)
+        assert [(date.year, date.month) for date in dates] == [(2000, 1), (2000, 2), (2000, 3)]
+        assert nc['2t'].shape == (3, len(nc['lat']), len(nc['lon']))
+        assert nc['2t'].code == 167
+        expected = [values.reshape(nc['2t'].shape[1:]) for values in grib_values(tmp_path / 'a.grib')]
+        assert np.allclose(nc['2t'][:], expected)
+    assert not (tmp_path / 'a.nc.part').exists()
+
+
+def test_pressure_levels(tmp_path):
+    request = {**REQUEST, 'variable': 'temperature', 'pressure_level': ['500', '850'],
+               'product_type': 'monthly_averaged_reanalysis'}
+    synthetic_grib(request, tmp_path / 'a.grib', resolution=30)
+    grib_to_netcdf(tmp_path / 'a.grib', tmp_path / 'a.nc')
+    with netCDF4.Dataset(tmp_path / 'a.nc') as nc:
+        assert list(nc['plev'][:]) == [85000, 50000]
+        assert nc['t'].dimensions == ('time', 'plev', 'lat', 'lon')
+        assert nc['t'].shape[:2] == (3, 2)
+
+
+def test_unsupported_grid(tmp_path):
+    handle = eccodes.codes_grib_new_from_samples('reduced_gg_pl_32_grib1')
+    with open(tmp_path / 'a.grib', 'wb') as grib:
+        eccodes.codes_write(handle, grib)
+    eccodes.codes_release(handle)
+    with pytest.raises(UnsupportedGrid, match='reduced_gg'):
+        grib_to_netcdf(tmp_path / 'a.grib', tmp_path / 'a.nc')
+    assert not (tmp_path / 'a.nc').exists()
@@ -0,0 +1,154 @@
+"""Tests of the merge of the yearly NetCDF files into the multi-year ones, on small synthetic files"""
+
+import shutil
+import datetime
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+netCDF4 = pytest.importorskip('netCDF4')
+
+# pylint: disable=wrong-import-position
+from CDS_retriever import create_filename
+from postproc import splice_years, merge_monthly, aggregate_daily, file_years, consecutive
+from state import StateDB, product_key
+
+needs_cdo = pytest.mark.skipif(shutil.which('cdo') is None or importlib.util.find_spec('cdo') is None,
+                               reason='the cdo binary or its python bindings are not installed')
+
+MONTHLY = ('ERA5', '2m_temperature', 'mon', '1x1', 'sfc', 'global')
+HOURLY = ('ERA5', '2m_temperature', '1hr', '1x1', 'sfc', 'global')
+
+
+def write_nc(filename, times, value):
+    """A NetCDF file of 2x2 fields at the given times, all equal to value, with an unlimited time"""
+    with netCDF4.Dataset(filename, 'w') as nc:
+        nc.createDimension('time', None)
+        nc.createDimension('lat', 2)
+        nc.createDimension('lon', 2)
+        time = nc.createVariable('time', 'f8', ('time',))
+        time.units = 'hours since 1900-01-01 00:00:00'
+        time.calendar = 'standard'
+        time.standard_name = 'time'
+        nc.createVariable('lat', 'f4', ('lat',))[:] = [0, 1]
+        nc.createVariable('lon', 'f4', ('lon',))[:] = [0, 1]
+        time[:] = netCDF4.date2num(times, time.units, time.calendar)
+        nc.createVariable('t2m', 'f4', ('time', 'lat', 'lon'))[:] = value
+    return str(filename)
+
+
+def read_nc(filename):
+    """The times and the value of each field of a file"""
+    with netCDF4.Dataset(filename) as nc:
+        dates = netCDF4.num2date(nc['time'][:], nc['time'].units, nc['time'].calendar)
+        return [(date.year, date.month, date.day, date.hour) for date in dates], list(nc['t2m'][:, 0, 0])
+
+
+def months(year):
+    return [datetime.datetime(year, month, 1) for month in range(1, 13)]
+
+
+def hours(year):
+    # the first two days of each year are enough for the daily means
+    return [datetime.datetime(year, 1, 1) + datetime.timedelta(hours=hour) for hour in range(48)]
+
+
+def product_file(product, folder, years):
+    return Path(folder, create_filename(*product, years) + '.nc')
+
+
+def convert(state, product, folder, year, value, times=months):
+    """A converted yearly file"""
+    write_nc(product_file(product, folder, str(year)), times(year), value)
+    state.mark(product_key(*product), year, 'converted')
+
+
+def test_file_years():
+    assert file_years('/a/ERA5_2m_temperature_mon_1x1_sfc_1990-1993.nc') == [1990, 1991, 1992, 1993]
+    assert consecutive([2001, 2002], 2002) and not consecutive([2000, 2002], 2002)
+    assert not consecutive([2000, 2001], 2002) and not consecutive([], 2002)
+
+
+def test_splice_years(tmp_path):
+    big = write_nc(tmp_path / 'big.nc', months(2000) + months(2001), 1)
+    # the last year updated, extended by the first months of the next one
+    new = write_nc(tmp_path / 'new.nc', months(2001), 2)
+    nrt = write_nc(tmp_path / 'nrt.nc', months(2002)[:3], 3)
+    splice_years(big, [new, nrt])
+    times, values = read_nc(big)
+    assert times == [(date.year, date.month, 1, 0) for date in months(2000) + months(2001) + months(2002)[:3]]
+    assert values == [1] * 12 + [2] * 12 + [3] * 3
+
+    # years before the end of the file cannot be spliced
+    with pytest.raises(ValueError, match='cannot be spliced'):
+        splice_years(big, [write_nc(tmp_path / 'old.nc', months(2000), 4)])
+
+
+@needs_cdo
+def test_merge_monthly(tmp_path):
+    state = StateDB(tmp_path / 'state.sqlite')
+    destdir = tmp_path / 'mon'
+    destdir.mkdir()
+    product = product_key(*MONTHLY)
+
+    def merge():
+        merge_monthly(*MONTHLY, destdir, tmp_path, True, False, state)
+        files = sorted(destdir.glob('*.nc'))
+        assert len(files) == 1
+        return files[0].name, read_nc(files[0])[1]
+
+    # first run: merged in time order
+    for year in [2001, 2000]:
+        convert(state, MONTHLY, destdir, year, year)
+    assert merge() == (product_file(MONTHLY, destdir, '2000-2001').name, [2000] * 12 + [2001] * 12)
+    assert state.years(product, 'merged') == [2000, 2001]
+
+    # a new year appended
+    convert(state, MONTHLY, destdir, 2002, 2002)
+    assert merge() == (product_file(MONTHLY, destdir, '2000-2002').name, [2000] * 12 + [2001] * 12 + [2002] * 12)
+
+    # the last year updated in place
+    convert(state, MONTHLY, destdir, 2002, 3002)
+    assert merge()[1] == [2000] * 12 + [2001] * 12 + [3002] * 12
+
+    # a year before the end rebuilt without its previous records
+    convert(state, MONTHLY, destdir, 2000, 3000)
+    name, values = merge()
+    assert name == product_file(MONTHLY, destdir, '2000-2002').name
+    assert values == [3000] * 12 + [2001] * 12 + [3002] * 12
+    assert state.years(product, 'merged') == [2000, 2001, 2002]
+
+
+@needs_cdo
+def test_aggregate_daily(tmp_path):
+    state = StateDB(tmp_path / 'state.sqlite')
+    destdir = tmp_path / '1hr'
+    destdir.mkdir()
+    daily = product_key(HOURLY[0], HOURLY[1], 'day', *HOURLY[3:])
+
+    def aggregate():
+        aggregate_daily(*HOURLY, destdir, tmp_path, state)
+        files = sorted(Path(tmp_path, HOURLY[1], 'day').glob('*.nc'))
+        assert len(files) == 1
+        return files[0].name, read_nc(files[0])[1]
+
+    def dayfile(years):
+        return Path(create_filename(HOURLY[0], HOURLY[1], 'day', *HOURLY[3:], years) + '.nc').name
+
+    for year in [2000, 2001]:
+        convert(state, HOURLY, destdir, year, year, hours)
+    assert aggregate() == (dayfile('2000-2001'), [2000, 2000, 2001, 2001])
+    # the daily means are cached by year
+    assert len(list(Path(tmp_path, HOURLY[1], 'day', 'yearly').glob('*.nc'))) == 2
+
+    # a new year appended
+    convert(state, HOURLY, destdir, 2002, 2002, hours)
+    assert aggregate() == (dayfile('2000-2002'), [2000, 2000, 2001, 2001, 2002, 2002])
+
+    # the last year updated in place, and a year before the end rebuilt
+    convert(state, HOURLY, destdir, 2002, 3002, hours)
+    assert aggregate()[1] == [2000, 2000, 2001, 2001, 3002, 3002]
+    convert(state, HOURLY, destdir, 2000, 3000, hours)
+    assert aggregate()[1] == [3000, 3000, 2001, 2001, 3002, 3002]
+    assert state.years(daily, 'merged') == [2000, 2001, 2002]
@@ -0,0 +1,35 @@
+"""Tests of the permissions of the shared request cache"""
+
+import os
+import stat
+
+import pytest
+
+from request_cache import RequestCache, request_hash
+
+REQUEST = {'variable': '2m_temperature', 'year': '2000', 'month': ['02', '01']}
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+@pytest.mark.parametrize('link', ['hardlink', 'copy'])
+def test_store(tmp_path, link):
+    download = tmp_path / 'download.grib'
+    download.write_bytes(b'GRIB' + bytes(100) + b'7777')
+    os.chmod(download, 0o644)
+    cache = RequestCache(tmp_path / 'cache', {'link': link})
+    cache.store('reanalysis-era5-single-levels', REQUEST, download)
+
+    # the downloaded file is still writable, only a copy in the cache is read-only
+    assert _mode(download) == 0o644
+    key = request_hash('reanalysis-era5-single-levels', {**REQUEST, 'month': ['01', '02']})
+    data = tmp_path / 'cache' / key[:2] / f'{key}.grib'
+    assert _mode(data) == (0o644 if link == 'hardlink' else 0o444)
+    # the folders are shared with the group
+    assert _mode(data.parent) == 0o2775 and _mode(tmp_path / 'cache') == 0o2775
+
+    target = tmp_path / 'target.grib'
+    assert cache.fetch('reanalysis-era5-single-levels', REQUEST, target) == download.stat().st_size
+    assert target.read_bytes() == download.read_bytes()
@@ -0,0 +1,53 @@
+"""Tests of the cdo chains deriving the coarser frequencies from the 1hr archive"""
+
+import pytest
+
+from resample import reduction
+
+SERIES = '-selyear,2000 -shifttime,-1hour -mergetime [ in.nc -seltimestep,1 next.nc ]'
+
+
+@pytest.mark.parametrize('freq, chain', [
+    ('6hrs', '-selhour,0,6,12,18 in.nc'),
+    ('day', '-daymean in.nc'),
+    ('mon', '-monmean in.nc'),
+])
+def test_instantaneous(freq, chain):
+    # the next year is not needed
+    assert reduction('ERA5', '2m_temperature', freq, 2000, 'in.nc') == chain
+
+
+@pytest.mark.parametrize('freq, chain', [
+    ('6hrs', f'-timselsum,6 {SERIES}'),
+    ('day', f'-daysum {SERIES}'),
+    ('mon', f'-mulc,24 -monmean {SERIES}'),
+])
+def test_accumulated(freq, chain):
+    assert reduction('ERA5', 'total_precipitation', freq, 2000, 'in.nc', 'next.nc') == chain
+
+
+@pytest.mark.parametrize('freq, chain', [
+    ('day', f'-shifttime,-23hours -selhour,23 {SERIES}'),
+    ('mon', f'-monmean -shifttime,-23hours -selhour,23 {SERIES}'),
+])
+def test_accumulated_land(freq, chain):
+    assert reduction('ERA5-Land', 'total_precipitation', freq, 2000, 'in.nc', 'next.nc') == chain
+
+
+def test_accumulated_land_6hrs():
+    with pytest.raises(ValueError, match='6hrs accumulations of ERA5-Land'):
+        reduction('ERA5-Land', 'total_precipitation', '6hrs', 2000, 'in.nc', 'next.nc')
+
+
+@pytest.mark.parametrize('var, freq, chain', [
+    ('maximum_2m_temperature_since_previous_post_processing', '6hrs', f'-timselmax,6 {SERIES}'),
+    ('minimum_2m_temperature_since_previous_post_processing', 'day', f'-daymin {SERIES}'),
+    ('10m_wind_gust_since_previous_post_processing', 'mon', f'-monmean -daymax {SERIES}'),
+])
+def test_extremes(var, freq, chain):
+    assert reduction('ERA5', var, freq, 2000, 'in.nc', 'next.nc') == chain
+
+
+def test_next_year_needed():
+    with pytest.raises(ValueError, match='first time step of the next year'):
+        reduction('ERA5', 'total_precipitation', 'day', 2000, 'in.nc')
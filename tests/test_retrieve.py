@@ -0,0 +1,195 @@
+"""End-to-end tests of the blocking and async retrieval against the fake CDS"""
+
+import time
+import asyncio
+from pathlib import Path
+
+import pytest
+
+cdsapi = pytest.importorskip('cdsapi')
+pytest.importorskip('requests')
+
+# pylint: disable=wrong-import-position
+import CDS_retriever
+from CDS_retriever import year_retrieve, year_requests, create_filename
+from async_retrieve import retrieve_async, run_async_retrieve
+from grib_scan import scan_grib
+from state import StateDB, product_key
+from throttle import ADAPTIVE_OPTIONS
+from fake_cds import start_server, synthetic_grib
+
+# a year of monthly means of a surface variable on a coarse grid: 12 small fields
+PRODUCT = ('ERA5', '2m_temperature', 'mon', '30x30', 'sfc', 'global')
+YEAR = '2000'
+
+# throttled submissions retried at once, so that the tests are fast
+ADAPTIVE = {**ADAPTIVE_OPTIONS, 'backoff_base': 0.2, 'backoff_cap': 0.5, 'cooldown': 0}
+
+
+@pytest.fixture(name='server')
+def fixture_server(tmp_path, monkeypatch):
+    """A fake CDS, used by the cdsapi clients created by the test"""
+    server = start_server(tmp_path / 'server', queue_delay=0.2)
+    monkeypatch.setenv('CDSAPI_URL', server.url)
+    monkeypatch.setenv('CDSAPI_KEY', '1:test')
+    # the blocking client of this thread, retrying the refused requests after half a second
+    monkeypatch.setattr(CDS_retriever._local, 'client',  # pylint: disable=protected-access
+                        cdsapi.Client(quiet=True, sleep_max=0.5), raising=False)
+    yield server
+    server.shutdown()
+
+
+class StubResults:
+    """The Results of the current CDS API: a location and a size, no reply"""
+
+    def __init__(self, server, rid):
+        reply = server.reply(rid)
+        self.url = f'{server.url}/retrieve/v1/jobs/{rid}/results'
+        self.location = reply['location']
+        self.content_length = reply['content_length']
+
+
+class StubRemote:
+    """The Remote of the requests submitted without waiting to the current CDS API"""
+
+    def __init__(self, server, rid):
+        self.server = server
+        self.request_uid = rid
+        self.reply = None
+        self.update()
+
+    def update(self):
+        reply = self.server.reply(self.request_uid)
+        self.reply = {**reply, 'state': 'accepted' if reply['state'] == 'queued' else reply['state']}
+
+    def make_results(self, wait=True):
+        assert not wait
+        return StubResults(self.server, self.request_uid)
+
+
+class StubClient:
+    """A client of the current CDS API on the fake CDS, blocking or not"""
+
+    def __init__(self, server, wait_until_complete=True):
+        self.server = server
+        self.wait_until_complete = wait_until_complete
+
+    def retrieve(self, name, request):
+        rid = self.server.submit(name, request)['request_id']
+        if not self.wait_until_complete:
+            return StubRemote(self.server, rid)
+        while self.server.reply(rid)['state'] not in ['completed', 'failed']:
+            time.sleep(0.1)
+        return StubResults(self.server, rid)
+
+
+def yearfile(outdir):
+    dataset, var, freq, grid, levelout, area = PRODUCT
+    return Path(outdir, create_filename(dataset, var, freq, grid, levelout, area, YEAR) + '.grib')
+
+
+def chunk(outdir, request='yearly'):
+    dataset, var, freq, grid, levelout, area = PRODUCT
+    return (dataset, var, freq, YEAR, grid, levelout, area, outdir, request)
+
+
+def nfields(filename):
+    return len(list(scan_grib(filename)))
+
+
+def occupy(server, seconds=1.0):
+    """Fill the only slot of the fake CDS with another request for a while"""
+    server.queue_delay = seconds
+    server.submit('other', {'year': YEAR, 'month': '01', 'variable': 'other', 'grid': ['30', '30']})
+    server.queue_delay = 0.2
+
+
+def test_blocking(server, tmp_path):  # pylint: disable=unused-argument
+    state = StateDB(tmp_path / 'state.sqlite')
+    year_retrieve(*chunk(tmp_path), state=state)
+    assert nfields(yearfile(tmp_path)) == 12
+    assert state.status(product_key(*PRODUCT), YEAR) == 'verified'
+
+
+def test_blocking_new_api(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(CDS_retriever._local, 'client', StubClient(server))  # pylint: disable=protected-access
+    state = StateDB(tmp_path / 'state.sqlite')
+    year_retrieve(*chunk(tmp_path), state=state)
+    assert nfields(yearfile(tmp_path)) == 12
+    assert state.status(product_key(*PRODUCT), YEAR) == 'verified'
+
+
+def test_blocking_monthly_throttled(server, tmp_path):
+    server.max_active = 1
+    occupy(server)
+    year_retrieve(*chunk(tmp_path, 'monthly'))
+    assert server.refused > 0
+    assert nfields(yearfile(tmp_path)) == 12
+
+
+def test_blocking_failed(server, tmp_path):
+    server.fail_rate = 1
+    with pytest.raises(Exception, match='not valid'):
+        year_retrieve(*chunk(tmp_path))
+    assert not yearfile(tmp_path).exists()
+
+
+def test_blocking_resumed(server, tmp_path):
+    # an interrupted download of the same request, whose first bytes are kept
+    dataset, var, freq, grid, levelout, area = PRODUCT
+    _, retrieve_dict = CDS_retriever.build_request(dataset, var, freq, YEAR, grid, levelout, area,
+                                                   [f'{month:02d}' for month in range(1, 13)])
+    synthetic_grib(retrieve_dict, tmp_path / 'previous.grib', seed=1)
+    head = (tmp_path / 'previous.grib').read_bytes()[:1000]
+    Path(str(yearfile(tmp_path)) + '.part').write_bytes(head)
+
+    year_retrieve(*chunk(tmp_path))
+    assert yearfile(tmp_path).read_bytes()[:1000] == head
+    assert not Path(str(yearfile(tmp_path)) + '.part').exists()
+    assert nfields(yearfile(tmp_path)) == 12
+
+
+def test_async_throttled(server, tmp_path):
+    server.max_active = 2
+    occupy(server)
+    state = StateDB(tmp_path / 'state.sqlite')
+    started = time.monotonic()
+    done, failed = retrieve_async([chunk(tmp_path, 'monthly')], poll_interval=0.1, state=state, adaptive=ADAPTIVE)
+    assert time.monotonic() - started < 60
+    assert not failed and list(done) == [('2m_temperature', YEAR)]
+    assert server.refused > 0
+    assert nfields(yearfile(tmp_path)) == 12
+    assert state.status(product_key(*PRODUCT), YEAR) == 'verified'
+
+
+def test_async_new_api(server, tmp_path):
+    jobs = [{'key': ('2m_temperature', YEAR), 'kind': kind, 'request': retrieve_dict, 'outfile': outfile,
+             'group': ['2m_temperature'], 'args': chunk(tmp_path)}
+            for kind, retrieve_dict, outfile in year_requests(*chunk(tmp_path))]
+    client = StubClient(server, wait_until_complete=False)
+    done, failed = asyncio.run(run_async_retrieve(jobs, client, poll_interval=0.1, adaptive=ADAPTIVE))
+    assert not failed and list(done) == [('2m_temperature', YEAR)]
+    assert nfields(done[('2m_temperature', YEAR)]) == 12
+
+
+def test_async_failed(server, tmp_path):
+    server.fail_rate = 1
+    done, failed = retrieve_async([chunk(tmp_path)], poll_interval=0.1, adaptive=ADAPTIVE)
+    assert not done
+    assert 'not valid' in failed[('2m_temperature', YEAR)]
+    assert not yearfile(tmp_path).exists()
+
+
+def test_async_grouped(server, tmp_path):
+    dataset, _, freq, grid, levelout, area = PRODUCT
+    variables = ['2m_temperature', 'total_precipitation']
+    for var in variables:
+        (tmp_path / var).mkdir()
+    done, failed = retrieve_async([(dataset, variables, freq, YEAR, grid, levelout, area, tmp_path, 'yearly')],
+                                  poll_interval=0.1, adaptive=ADAPTIVE)
+    assert not failed and sorted(done) == [(var, YEAR) for var in variables]
+    assert len(server.tasks) == 1
+    for var in variables:
+        gribfile = Path(tmp_path, var, create_filename(dataset, var, freq, grid, levelout, area, YEAR) + '.grib')
+        assert nfields(gribfile) == 12
+        assert {field['param'] for field in scan_grib(gribfile)} == {CDS_retriever.PARAM_IDS[var]}
@@ -0,0 +1,88 @@
+"""Tests of the work-queue scheduler, with tasks run in worker processes"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+from scheduler import Task, run_tasks, run_stages
+from leases import LeaseBusy
+
+
+def double(x):
+    return 2 * x
+
+
+def busy_once(marker, x):
+    """Leased by another job at the first attempt"""
+    if not Path(marker).exists():
+        Path(marker).touch()
+        raise LeaseBusy(f'{x} is leased by another job')
+    return 2 * x
+
+
+def broken(x):
+    raise ValueError(f'{x} is broken')
+
+
+def leave(x):
+    sys.exit(f'{x} left')
+
+
+def crash(x):
+    """A worker killed, e.g. by the out-of-memory killer"""
+    time.sleep(0.2)
+    os._exit(x)  # pylint: disable=protected-access
+
+
+def test_run_tasks():
+    done, failed = run_tasks([Task((x,), double, (x,)) for x in range(5)], 2)
+    assert done == {(x,): 2 * x for x in range(5)} and not failed
+
+
+def test_run_tasks_deferred(tmp_path):
+    tasks = [Task(('leased',), busy_once, (tmp_path / 'marker', 3)), Task(('free',), double, (4,))]
+    started = time.monotonic()
+    done, failed = run_tasks(tasks, 1, retry=0.5)
+    assert done == {('leased',): 6, ('free',): 8} and not failed
+    assert time.monotonic() - started >= 0.5
+
+
+def test_run_tasks_failed():
+    tasks = [Task(('broken',), broken, (1,)), Task(('exit',), leave, (2,)), Task(('ok',), double, (3,))]
+    done, failed = run_tasks(tasks, 2)
+    assert done == {('ok',): 6}
+    assert failed[('broken',)] == 'ValueError: 1 is broken'
+    assert failed[('exit',)] == 'SystemExit: 2 left'
+
+
+def test_run_tasks_crashed():
+    # the crash takes down the tasks running in the same pool, the queued ones get a new pool
+    tasks = [Task(('crash',), crash, (1,)), Task(('lost',), time.sleep, (1,))]
+    tasks += [Task((x,), double, (x,)) for x in range(4)]
+    done, failed = run_tasks(tasks, 2)
+    assert sorted(failed) == [('crash',), ('lost',)]
+    assert 'worker process crashed' in failed[('crash',)]
+    assert done == {(x,): 2 * x for x in range(4)}
+
+
+def test_run_stages(tmp_path):
+    finished = []
+
+    def on_done(stage, key, ok):
+        finished.append((stage, key, ok))
+        if stage == 'first' and ok:
+            return [('second', Task(key, double, (key[0],)))]
+        return []
+
+    initial = [('first', Task((x,), double, (x,))) for x in range(3)]
+    initial += [('first', Task(('crash',), crash, (1,))), ('first', Task(('broken',), broken, (1,))),
+                ('first', Task(('leased',), busy_once, (tmp_path / 'marker', 5)))]
+    done, failed = run_stages(initial, on_done, {'first': 1, 'second': 2}, retry=0.2)
+    assert done['first'] == {(0,): 0, (1,): 2, (2,): 4, ('leased',): 10}
+    assert done['second'] == {(0,): 0, (1,): 2, (2,): 4, ('leased',): 'leasedleased'}
+    assert 'worker process crashed' in failed['first'][('crash',)]
+    assert failed['first'][('broken',)] == 'ValueError: 1 is broken'
+    # the failed tasks are reported to on_done as well, the leased one once
+    assert ('first', ('crash',), False) in finished and ('first', ('broken',), False) in finished
+    assert [key for _, key, _ in finished].count(('leased',)) == 2
@@ -0,0 +1,59 @@
+"""Tests of the byte budget of the download folder"""
+
+import os
+from pathlib import Path
+
+import pytest
+
+from CDS_retriever import create_filename
+from scratch import Scratch, GB
+from state import StateDB, product_key
+
+PRODUCT = ('ERA5', '2m_temperature', 'mon', '30x30', 'sfc', 'global')
+
+
+def scratch_folder(tmp_path, budget, years=()):
+    """A scratch with a budget in bytes and the converted yearly files of 1000 bytes of some years"""
+    state = StateDB(tmp_path / 'state.sqlite')
+    dataset, var, freq, grid, levelout, area = PRODUCT
+    tmpdir = tmp_path / 'tmp'
+    (tmpdir / var).mkdir(parents=True)
+    files = []
+    for year in years:
+        path = Path(tmpdir, var, create_filename(dataset, var, freq, grid, levelout, area, str(year)) + '.grib')
+        path.write_bytes(bytes(1000))
+        state.mark(product_key(*PRODUCT), year, 'converted')
+        files.append(path)
+    scratch = Scratch(tmpdir, state, [PRODUCT], {'budget': budget / GB, 'min_free': 0, 'poll': 0.01})
+    return scratch, files
+
+
+def test_reserve_evicts(tmp_path):
+    scratch, files = scratch_folder(tmp_path, 2500, [2000, 2001])
+    with scratch.reserve(1000, tmp_path / 'tmp' / 'new.grib'):
+        assert scratch.reserved() == 1000
+        assert not files[0].exists() and files[1].exists()
+    assert scratch.reserved() == 0
+
+
+def test_reserve_beyond_budget(tmp_path):
+    scratch, _ = scratch_folder(tmp_path, 2500)
+    with pytest.raises(IOError, match='beyond the budget'):
+        with scratch.reserve(3000, tmp_path / 'tmp' / 'new.grib'):
+            pass
+
+
+def test_reserve_nothing_to_evict(tmp_path):
+    scratch, _ = scratch_folder(tmp_path, 2500)
+    (tmp_path / 'tmp' / 'other.grib').write_bytes(bytes(2000))
+    with pytest.raises(IOError, match='nothing to evict'):
+        with scratch.reserve(1000, tmp_path / 'tmp' / 'new.grib'):
+            pass
+
+
+def test_evict_hardlinked(tmp_path):
+    scratch, files = scratch_folder(tmp_path, 10000, [2000, 2001])
+    os.link(files[0], tmp_path / 'cached.grib')
+    # the hardlinked file frees no disk space
+    assert scratch.evict(2000) == 1000
+    assert not any(path.exists() for path in files)
@@ -0,0 +1,96 @@
+"""Tests of the state database of the retrieval"""
+
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+from state import StateDB, product_key, month_expver, reached, FINAL, PRELIMINARY
+
+PRODUCT = product_key('ERA5', '2m_temperature', '1hr', '0.25x0.25', 'sfc', 'global')
+OTHER = product_key('ERA5', 'total_precipitation', '1hr', '0.25x0.25', 'sfc', [60, -10, 30, 40])
+
+
+def test_mark_and_query(tmp_path):
+    state = StateDB(tmp_path / 'state.sqlite')
+    state.mark(PRODUCT, 2000, 'converted', path='a.grib', nbytes=10)
+    state.mark(PRODUCT, 2001, 'downloaded')
+    state.mark(PRODUCT, 2002, 'merged')
+    state.mark(PRODUCT, 2003, 'submitted', month=5, request_id='abc')
+    state.mark(OTHER, 2000, 'merged')
+
+    assert state.status(PRODUCT, 2000) == 'converted'
+    assert state.status(PRODUCT, 2003, month=5) == 'submitted'
+    assert state.status(PRODUCT, 2004) is None
+    # only the whole-year chunks
+    assert state.statuses(PRODUCT) == {2000: 'converted', 2001: 'downloaded', 2002: 'merged'}
+    assert state.years(PRODUCT, 'converted') == [2000, 2002]
+    assert state.years(PRODUCT, 'planned') == [2000, 2001, 2002]
+    assert OTHER[-1] == '60_-10_30_40'
+    with pytest.raises(ValueError):
+        state.mark(PRODUCT, 2000, 'unknown')
+
+
+def test_mark_keeps_fields(tmp_path):
+    state = StateDB(tmp_path / 'state.sqlite')
+    state.mark(PRODUCT, 2000, 'downloaded', nbytes=10, request_id='abc')
+    state.mark(PRODUCT, 2000, 'verified', checksum='ff')
+    with closing(sqlite3.connect(tmp_path / 'state.sqlite')) as db:
+        row = db.execute('SELECT status, nbytes, request_id, checksum FROM chunks').fetchone()
+    assert row == ('verified', 10, 'abc', 'ff')
+
+
+def test_expvers(tmp_path):
+    state = StateDB(tmp_path / 'state.sqlite')
+    state.mark(PRODUCT, 2023, 'downloaded', month=11, expver=FINAL)
+    state.mark(PRODUCT, 2023, 'downloaded', month=12, expver=PRELIMINARY)
+    state.mark(PRODUCT, 2024, 'downloaded', month=1, expver=PRELIMINARY)
+    state.mark(PRODUCT, 2022, 'downloaded', month=12, expver=FINAL)
+    state.mark(PRODUCT, 2023, 'verified')
+    assert state.expvers(PRODUCT, 2023) == {11: FINAL, 12: PRELIMINARY}
+    assert state.preliminary_years(PRODUCT) == [2023, 2024]
+    # the preliminary months replaced by the final data
+    state.mark(PRODUCT, 2023, 'downloaded', month=12, expver=FINAL)
+    assert state.preliminary_years(PRODUCT) == [2024]
+    assert month_expver({FINAL, PRELIMINARY}) == PRELIMINARY
+    assert month_expver({FINAL}) == FINAL and month_expver(set()) is None
+
+
+def old_database(path):
+    """A database created before the near-real-time updates, without the expver column"""
+    with closing(sqlite3.connect(path)) as db, db:
+        db.execute('CREATE TABLE chunks (dataset TEXT, var TEXT, freq TEXT, grid TEXT, level TEXT, area TEXT, '
+                   'year INTEGER, month INTEGER, status TEXT, request_id TEXT, nbytes INTEGER, '
+                   'checksum TEXT, path TEXT, updated REAL, '
+                   'PRIMARY KEY (dataset, var, freq, grid, level, area, year, month))')
+        db.execute('INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, 2000, 0, ?, NULL, NULL, NULL, NULL, 0)',
+                   PRODUCT + ('converted',))
+
+
+def test_readonly_old_database(tmp_path):
+    old_database(tmp_path / 'state.sqlite')
+    state = StateDB(tmp_path / 'state.sqlite', readonly=True)
+    assert state.statuses(PRODUCT) == {2000: 'converted'}
+    assert state.expvers(PRODUCT, 2000) == {}
+    assert state.preliminary_years(PRODUCT) == []
+    with pytest.raises(sqlite3.OperationalError):
+        state.mark(PRODUCT, 2001, 'planned')
+    # not migrated
+    with closing(sqlite3.connect(tmp_path / 'state.sqlite')) as db:
+        assert 'expver' not in [row[1] for row in db.execute('PRAGMA table_info(chunks)')]
+
+
+def test_migration(tmp_path):
+    old_database(tmp_path / 'state.sqlite')
+    state = StateDB(tmp_path / 'state.sqlite', shared=True)
+    assert state.status(PRODUCT, 2000) == 'converted'
+    state.mark(PRODUCT, 2000, 'downloaded', month=12, expver=PRELIMINARY)
+    assert state.preliminary_years(PRODUCT) == [2000]
+    # opening it again does not add the column twice
+    StateDB(tmp_path / 'state.sqlite')
+    assert state.expvers(PRODUCT, 2000) == {12: PRELIMINARY}
+
+
+def test_reached():
+    assert reached('merged', 'converted') and reached('converted', 'converted')
+    assert not reached('downloaded', 'converted') and not reached(None, 'planned')
@@ -0,0 +1,100 @@
+"""Tests of the adaptive concurrency of the CDS requests and of the downloads"""
+
+import pytest
+
+import throttle
+from throttle import RequestController, DownloadController, status_code, transient_error
+
+
+@pytest.fixture(name='clock')
+def fixture_clock(monkeypatch):
+    """A clock of the throttle module moved by hand"""
+    now = [1000.0]
+    monkeypatch.setattr(throttle.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_requests_raised_when_all_running(clock):  # pylint: disable=unused-argument
+    requests = RequestController(1, 4, 2)
+    requests.polled(queued=0, running=2)
+    assert requests.limit == 3
+    requests.polled(queued=0, running=2)
+    assert requests.limit == 3
+    for _ in range(3):
+        requests.polled(queued=0, running=4)
+    assert requests.limit == 4
+
+
+def test_requests_lowered_when_queued_by_the_user_limit(clock):  # pylint: disable=unused-argument
+    requests = RequestController(1, 16, 8)
+    requests.polled(queued=5, running=2)
+    assert requests.limit == 3
+    # with none running the whole CDS is busy: the limit is kept
+    requests = RequestController(1, 16, 8)
+    requests.polled(queued=8, running=0)
+    assert requests.limit == 8
+
+
+def test_requests_throttled_cooldown(clock):
+    requests = RequestController(1, 16, 8, cooldown=60)
+    requests.throttled(429)
+    assert requests.limit == 4
+    requests.polled(queued=0, running=4)
+    assert requests.limit == 4
+    clock[0] += 61
+    requests.polled(queued=0, running=4)
+    assert requests.limit == 5
+    for _ in range(5):
+        requests.throttled(503)
+    assert requests.limit == 1
+
+
+def test_requests_latency():
+    requests = RequestController(1, 16, 8, latency_factor=2.0)
+    requests.completed(10)
+    requests.completed(10)
+    assert requests.limit == 8
+    requests.completed(100)
+    assert requests.limit == 7
+    # the reference follows the slower regime
+    requests.completed(37)
+    assert requests.limit == 7
+
+
+def test_downloads_hill_climbing(clock):
+    downloads = DownloadController(1, 8, 2)
+    # a first rate, then a faster one: the limit keeps growing
+    clock[0] += 10
+    downloads.downloaded(100)
+    downloads.downloaded(100)
+    assert downloads.limit == 3
+    clock[0] += 10
+    for _ in range(3):
+        downloads.downloaded(200)
+    assert downloads.limit == 4
+    # a slower rate turns back
+    clock[0] += 10
+    for _ in range(4):
+        downloads.downloaded(10)
+    assert downloads.limit == 3 and downloads.direction == -1
+
+
+def test_downloads_throttled():
+    downloads = DownloadController(1, 8, 6)
+    downloads.throttled(429)
+    assert downloads.limit == 3 and downloads.direction == -1
+    downloads.throttled(429)
+    downloads.throttled(429)
+    assert downloads.limit == 1
+
+
+def test_status_code():
+    class Response:  # pylint: disable=too-few-public-methods
+        status_code = 503
+
+    error = Exception('service unavailable')
+    error.response = Response()
+    assert status_code(error) == 503
+    assert status_code(Exception('429 Client Error: Too Many Requests')) == 429
+    assert status_code(Exception('not valid')) is None
+    assert transient_error(error) and not transient_error(ValueError('not valid'))
@@ -0,0 +1,151 @@
+"""Adaptive concurrency of the CDS requests and of the downloads, with backoff and jitter"""
+
+import os
+import re
+import time
+import random
+
+from metrics import event
+
+# default options of the adaptive concurrency
+ADAPTIVE_OPTIONS = {
+    'min_requests': 1,       # bounds and initial number of the requests in the CDS at the same time
+    'max_requests': 16,
+    'start_requests': 2,
+    'min_downloads': 1,      # bounds and initial number of the concurrent downloads
+    'max_downloads': 8,
+    'start_downloads': 2,
+    'latency_factor': 2.0,   # fewer requests when their latency grows beyond this factor of the best one
+    'cooldown': 120,         # seconds without increase after a throttling response
+    'backoff_base': 5,       # seconds of the first retry of a throttled submission, doubled at each attempt
+    'backoff_cap': 300,      # maximum seconds between two attempts
+    'max_attempts': 8,       # attempts of a submission before it is failed
+}
+
+# HTTP status codes of the responses which are worth a retry
+TRANSIENT_CODES = [429, 500, 502, 503, 504]
+
+# HTTP status codes of the responses which mean that the CDS is overloaded
+THROTTLE_CODES = [429, 503]
+
+
+def backoff(attempt, base=5, cap=300):
+    """Seconds to wait before the attempt-th retry: exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def status_code(error):
+    """
+    The HTTP status code of an error raised by cdsapi or requests, None if unknown.
+    The legacy cdsapi turns the HTTP errors into plain exceptions, so the message is checked too.
+    """
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) is not None:
+        return response.status_code
+    for code in TRANSIENT_CODES:
+        if re.search(rf'\b{code}\b', str(error)):
+            return code
+    return None
+
+
+def transient_error(error):
+    """Check if an error is likely to disappear by trying again later"""
+    if status_code(error) in TRANSIENT_CODES:
+        return True
+    name = type(error).__name__
+    return name in ['ConnectionError', 'Timeout', 'ReadTimeout', 'ConnectTimeout', 'ChunkedEncodingError']
+
+
+def cpu_workers():
+    """Number of cores available to this process, e.g. those allotted by SLURM"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class RequestController:
+    """
+    Number of CDS requests in flight, adapted to the behaviour of the CDS.
+
+    It is halved on throttling responses (429/503), lowered when some requests run and all the
+    others beyond one are left queued (the per-user limit of the CDS is reached) or when their latency grows
+    beyond latency_factor times the best one, and raised by one when all of them are running.
+    """
+
+    def __init__(self, low, high, start, latency_factor=2.0, cooldown=120):
+        self.low, self.high = low, high
+        self.limit = min(max(start, low), high)
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.latency, self.best = None, None
+        self.quiet_after = 0
+
+    def _set(self, limit, reason):
+        limit = min(max(limit, self.low), self.high)
+        if limit != self.limit:
+            print(f'CDS requests in flight: {self.limit} -> {limit} ({reason})')
+            event('concurrency', kind='requests', limit=limit, reason=reason)
+            self.limit = limit
+
+    def throttled(self, code=None):
+        """The CDS refused a request or a poll because of its load"""
+        self._set(self.limit // 2, f'throttled {code or ""}'.strip())
+        self.quiet_after = time.monotonic() + self.cooldown
+
+    def completed(self, latency):
+        """A request has been completed after latency seconds"""
+        self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+        self.best = self.latency if self.best is None else min(self.best, self.latency)
+        if self.latency > self.latency_factor * self.best:
+            self._set(self.limit - 1, f'latency {self.latency:.0f}s, best {self.best:.0f}s')
+            # the reference follows the slower regime, so that the limit is not lowered at every request
+            self.best = self.latency / self.latency_factor
+
+    def polled(self, queued, running):
+        """State of the requests in flight after a poll"""
+        # with none running the whole CDS is busy, not only the requests of this user
+        if queued > 1 and running > 0 and self.limit > running + 1:
+            self._set(running + 1, f'{queued} requests queued by the CDS')
+        elif queued == 0 and running >= self.limit and time.monotonic() > self.quiet_after:
+            self._set(self.limit + 1, 'all requests running')
+
+
+class DownloadController:
+    """
+    Number of concurrent downloads, tuned by hill climbing on the total bandwidth:
+    the limit keeps moving in the same direction while the bandwidth grows and turns back when it drops.
+    """
+
+    def __init__(self, low, high, start):
+        self.low, self.high = low, high
+        self.limit = min(max(start, low), high)
+        self.direction = 1
+        self.rate = None
+        self.nbytes, self.count, self.start = 0, 0, time.monotonic()
+
+    def _set(self, limit, reason):
+        limit = min(max(limit, self.low), self.high)
+        if limit != self.limit:
+            print(f'Concurrent downloads: {self.limit} -> {limit} ({reason})')
+            event('concurrency', kind='downloads', limit=limit, reason=reason)
+            self.limit = limit
+
+    def throttled(self, code=None):
+        """A download has been refused because of the load of the server"""
+        self.direction = -1
+        self._set(self.limit // 2, f'throttled {code or ""}'.strip())
+
+    def downloaded(self, nbytes):
+        """A download has been completed: the limit is revised after as many downloads as the limit"""
+        self.nbytes += nbytes
+        self.count += 1
+        if self.count < self.limit:
+            return
+        rate = self.nbytes / max(time.monotonic() - self.start, 1e-3)
+        if self.rate is not None and rate < 0.9 * self.rate:
+            self.direction = -self.direction
+        if self.rate is None or abs(rate - self.rate) > 0.1 * self.rate:
+            self._set(self.limit + self.direction, f'{rate / 1024**2:.1f} MB/s')
+        self.rate = rate
+        self.nbytes, self.count, self.start = 0, 0, time.monotonic()
@@ -0,0 +1,117 @@
+"""Zarr output: the yearly NetCDF files appended along time to a consolidated store per product"""
+
+import os
+import shutil
+from pathlib import Path
+
+# default chunk length along time for each frequency, the maps are not split
+TIME_CHUNKS = {'1hr': 24, '6hrs': 28, 'day': 31, 'mon': 12, 'instant': 12}
+
+# default options of the zarr output
+ZARR_OPTIONS = {
+    'compressor': 'blosc-zstd',  # 'blosc-zstd', 'blosc-lz4' or 'zstd'
+    'clevel': 3,                 # compression level
+    'chunks': None,              # dimension -> chunk length, e.g. {'time': 24, 'lat': 181, 'lon': 360}
+}
+
+
+def _import_backend():
+    """Import the optional dependencies of the zarr output"""
+    try:
+        # pylint: disable=import-outside-toplevel
+        import xarray as xr
+        import zarr
+        import numcodecs
+    except ImportError as e:
+        raise ImportError(f'The zarr output requires xarray, zarr and numcodecs: {e}') from e
+    return xr, zarr, numcodecs
+
+
+def zarr_path(dataset, var, freq, grid, levelout, area, destdir):
+    """The store of a product, with the same naming of create_filename but without years"""
+    name = '_'.join([dataset, var, freq, grid, levelout])
+    if area != 'global':
+        name = name + '_' + '_'.join([str(x) for x in area])
+    return Path(destdir, name + '.zarr')
+
+
+def _compressor(numcodecs, options):
+    """Build the numcodecs compressor from the options"""
+    if options['compressor'] == 'zstd':
+        return numcodecs.Zstd(level=options['clevel'])
+    if options['compressor'].startswith('blosc-'):
+        return numcodecs.Blosc(cname=options['compressor'].split('-', 1)[1], clevel=options['clevel'],
+                               shuffle=numcodecs.Blosc.BITSHUFFLE)
+    raise ValueError(f"Unknown compressor {options['compressor']}")
+
+
+def _truncate(xr, zarr, store, first_time):
+    """
+    Drop the records of a store from first_time on, e.g. those of an interrupted append,
+    so that appending the same year again does not duplicate it.
+
+    The arrays are read without the consolidated metadata, which still has the length of the
+    store before an interrupted append, and only the increasing times before first_time are kept,
+    so that the records resized but never written are dropped as well.
+
+    Returns:
+        int: the number of records left in the store
+    """
+    times = xr.open_zarr(store, consolidated=False)['time'].values
+    valid = times < first_time
+    valid[1:] &= times[1:] > times[:-1]
+    keep = len(times) if valid.all() else int(valid.argmin())
+    group = zarr.open_group(str(store), mode='r+')
+    if keep < len(times):
+        print(f'Dropping {len(times) - keep} records of {store} from {first_time}')
+        for _, array in group.arrays():
+            dims = array.attrs.get('_ARRAY_DIMENSIONS', [])
+            if dims and dims[0] == 'time':
+                array.resize((keep,) + array.shape[1:])
+    # the consolidated metadata may still describe the store before an interrupted append
+    zarr.consolidate_metadata(str(store))
+    return keep
+
+
+def append_years(ncfiles, store, freq, options=None):
+    """
+    Append yearly NetCDF files, in time order, along the time dimension of a Zarr store.
+    The store is created with the first file, with the chunks and the compressor of the options.
+
+    Parameters:
+        ncfiles (list): the yearly files, sorted by time
+        store (str or Path): the Zarr store
+        freq (str): frequency of the data, for the default time chunks
+        options (dict): overrides of ZARR_OPTIONS
+
+    Returns:
+        int: the number of records written
+    """
+
+    xr, zarr, numcodecs = _import_backend()
+    options = {**ZARR_OPTIONS, **(options or {})}
+    chunks = {'time': TIME_CHUNKS.get(freq, 24), 'plev': 1, **(options['chunks'] or {})}
+    compressor = _compressor(numcodecs, options)
+
+    written = 0
+    for ncfile in ncfiles:
+        with xr.open_dataset(ncfile) as ds:
+            ds = ds.chunk({dim: size for dim, size in chunks.items() if dim in ds.dims})
+            if Path(store, '.zmetadata').exists():
+                existing = _truncate(xr, zarr, store, ds['time'].values[0])
+                # the first dask chunk fills the last zarr chunk, so that no zarr chunk is written twice
+                tchunk, ntime = chunks['time'], ds.sizes['time']
+                first = min(-existing % tchunk or tchunk, ntime)
+                rest = ntime - first
+                bounds = [first] + [tchunk] * (rest // tchunk) + ([rest % tchunk] if rest % tchunk else [])
+                ds = ds.chunk({'time': tuple(bounds)})
+                ds.to_zarr(store, append_dim='time', consolidated=True)
+            else:
+                if os.path.exists(store):
+                    # a store whose creation was interrupted
+                    shutil.rmtree(store)
+                encoding = {name: {'compressor': compressor} for name in ds.data_vars}
+                ds.to_zarr(store, mode='w-', encoding=encoding, consolidated=True)
+            written += ds.sizes['time']
+        print(f'Appended {ncfile} to {store}')
+    return written